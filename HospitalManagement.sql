@@ -164,6 +164,20 @@ WHERE
 ORDER BY
     a.date, tsu.created_at;
     
+-- Patient history without the appointments x services fan-out (history.py):
+-- one indexed query per source, merged into a single timeline by the application.
+CREATE INDEX idx_appointments_patient_date ON appointments (patient_id, date);
+CREATE INDEX idx_billing_patient_date ON billing (patient_id, billing_date);
+CREATE INDEX idx_billed_services_patient_time ON billed_services (patient_id, billed_at);
+CREATE INDEX idx_temp_service_usage_patient_time ON temp_service_usage (patient_id, created_at);
+
+SELECT a.date, a.appt_id, a.doctor_id, d.name, d.specialization, a.diagnosis, a.consulting_charge
+FROM appointments a LEFT JOIN doctors d ON d.doctor_id = a.doctor_id
+WHERE a.patient_id = 1001 ORDER BY a.date, a.appt_id;
+SELECT billing_date, bill_id, total_amount FROM billing WHERE patient_id = 1001 ORDER BY billing_date, bill_id;
+SELECT billed_at, bill_id, service_id, service_name, cost FROM billed_services WHERE patient_id = 1001 ORDER BY billed_at, id;
+SELECT created_at, service_id, service_name, cost FROM temp_service_usage WHERE patient_id = '1001' ORDER BY created_at, id;
+
 -- Task Descriptiom : Add reporting features: daily visits, most consulted doctors - SQL Aggregates
 -- 1. Daily visits report
 select date, count(*) as visit_count from appointments group by date order by date desc;
@@ -186,3 +200,201 @@ order by
 desc;
  
 
+-- Archival (archive.py): rows older than the retention window move here in small batches.
+-- Same columns as the hot tables, no foreign keys so patients/doctors can still be removed.
+CREATE INDEX idx_appointments_date ON appointments (date);
+CREATE INDEX idx_billing_date ON billing (billing_date);
+
+CREATE TABLE appointments_archive (
+    appt_id VARCHAR(10) PRIMARY KEY,
+    patient_id INT,
+    doctor_id VARCHAR(10),
+    date DATE,
+    diagnosis VARCHAR(255),
+    consulting_charge DECIMAL(7,2) DEFAULT 0,
+    archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    INDEX idx_appointments_archive_patient_date (patient_id, date)
+);
+
+CREATE TABLE billing_archive (
+    bill_id VARCHAR(10) PRIMARY KEY,
+    patient_id INT,
+    total_amount decimal(10,2),
+    billing_date DATE,
+    archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    INDEX idx_billing_archive_patient_date (patient_id, billing_date)
+);
+
+CREATE TABLE billed_services_archive (
+    id INT PRIMARY KEY,
+    bill_id VARCHAR(10),
+    patient_id INT,
+    service_id VARCHAR(10),
+    service_name VARCHAR(100),
+    cost DECIMAL(10,2),
+    billed_at TIMESTAMP,
+    archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    INDEX idx_billed_services_archive_bill (bill_id),
+    INDEX idx_billed_services_archive_patient_time (patient_id, billed_at)
+);
+
+-- Change data capture (changelog.py): one row per entity mutation, written in the same
+-- transaction as the change. Consumers tail by seq from their saved checkpoint.
+CREATE TABLE change_log (
+    seq BIGINT AUTO_INCREMENT PRIMARY KEY,
+    entity VARCHAR(20) NOT NULL,
+    entity_key VARCHAR(20) NOT NULL,
+    op ENUM('insert','update','delete') NOT NULL,
+    changed_fields JSON,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    INDEX idx_change_log_entity_key (entity, entity_key)
+);
+
+CREATE TABLE change_log_checkpoints (
+    consumer VARCHAR(50) PRIMARY KEY,
+    last_seq BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+);
+
+-- Optimistic concurrency: every update bumps version, and an update made with the version the
+-- client read only applies if the row still has that version (compare-and-set, no row locks held
+-- between the read and the write).
+ALTER TABLE patients ADD COLUMN version INT NOT NULL DEFAULT 1;
+ALTER TABLE doctors ADD COLUMN version INT NOT NULL DEFAULT 1;
+ALTER TABLE services ADD COLUMN version INT NOT NULL DEFAULT 1;
+ALTER TABLE appointments ADD COLUMN version INT NOT NULL DEFAULT 1;
+ALTER TABLE billing ADD COLUMN version INT NOT NULL DEFAULT 1;
+
+-- Bill adjustments (Bill.add_line_item / Bill.void_line_item): voided lines stay in
+-- billed_services with voided_at set, and every change to a bill total is audited here.
+ALTER TABLE billed_services ADD COLUMN voided_at TIMESTAMP NULL DEFAULT NULL;
+ALTER TABLE billed_services_archive ADD COLUMN voided_at TIMESTAMP NULL DEFAULT NULL;
+
+CREATE TABLE bill_adjustments (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    bill_id VARCHAR(10) NOT NULL,
+    line_id INT,
+    action ENUM('add','void') NOT NULL,
+    service_id VARCHAR(10),
+    amount DECIMAL(10,2) NOT NULL,
+    reason VARCHAR(255),
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    INDEX idx_bill_adjustments_bill (bill_id, created_at)
+);
+
+-- Soft delete: Patient.delete / Doctor.delete only stamp deleted_at and read paths skip those
+-- rows; purge.py removes the dependent rows in small batches and then the row itself.
+ALTER TABLE patients ADD COLUMN deleted_at TIMESTAMP NULL DEFAULT NULL, ADD INDEX idx_patients_deleted (deleted_at);
+ALTER TABLE doctors ADD COLUMN deleted_at TIMESTAMP NULL DEFAULT NULL, ADD INDEX idx_doctors_deleted (deleted_at);
+
+-- Caller identification (contacts.py): contact numbers are stored as digits only, and every
+-- live patient and doctor has a row here. contact_rev holds the digits reversed so a
+-- last-N-digits match is an index prefix scan. Run `python contacts.py --backfill` once to
+-- normalize the stored numbers (contacts.normalize_contact) and fill contact_index.
+ALTER TABLE doctors ADD CONSTRAINT unique_contact_no UNIQUE (contact_no);
+
+CREATE TABLE contact_index (
+    entity ENUM('patient','doctor') NOT NULL,
+    entity_key VARCHAR(20) NOT NULL,
+    name VARCHAR(100),
+    contact_no VARCHAR(20) NOT NULL,
+    contact_rev VARCHAR(20) NOT NULL,
+    PRIMARY KEY (entity, entity_key),
+    INDEX idx_contact_index_contact (contact_no),
+    INDEX idx_contact_index_contact_rev (contact_rev)
+);
+
+-- Duplicate patients (dedup.py): name_key is the sorted Soundex codes of the name, used as a
+-- blocking key; run `python dedup.py --backfill` once to fill it for existing rows. Likely
+-- duplicates are stored as (newer registration, older registration) pairs for review.
+ALTER TABLE patients ADD COLUMN name_key VARCHAR(100),
+    ADD INDEX idx_patients_name_key (name_key),
+    ADD INDEX idx_patients_name (name),
+    ADD INDEX idx_patients_contact (contact_no);
+
+CREATE TABLE duplicate_candidates (
+    patient_id INT NOT NULL,
+    duplicate_of INT NOT NULL,
+    score DECIMAL(4,3) NOT NULL,
+    match_pass VARCHAR(20),
+    status ENUM('open','merged','dismissed') NOT NULL DEFAULT 'open',
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    PRIMARY KEY (patient_id, duplicate_of),
+    INDEX idx_duplicate_candidates_of (duplicate_of, status)
+);
+
+-- Billing runs (billing_run.py): a run bills every patient with pending usage up to
+-- max_usage_id. Planning fixes each patient's shard and bill ID in billing_run_items; items
+-- move from pending to billed in the same transaction as their bills, so a run can resume.
+CREATE TABLE billing_runs (
+    run_id INT AUTO_INCREMENT PRIMARY KEY,
+    billing_date DATE NOT NULL,
+    max_usage_id INT NOT NULL,
+    shards INT NOT NULL,
+    status ENUM('running','done') NOT NULL DEFAULT 'running',
+    bills INT NOT NULL DEFAULT 0,
+    total_amount DECIMAL(14,2) NOT NULL DEFAULT 0,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    finished_at TIMESTAMP NULL DEFAULT NULL,
+    INDEX idx_billing_runs_status (status)
+);
+
+CREATE TABLE billing_run_items (
+    run_id INT NOT NULL,
+    patient_id INT NOT NULL,
+    shard INT NOT NULL,
+    bill_id VARCHAR(10) NOT NULL,
+    status ENUM('pending','billed','skipped','failed') NOT NULL DEFAULT 'pending',
+    PRIMARY KEY (run_id, patient_id),
+    INDEX idx_billing_run_items_shard (run_id, shard, status, patient_id),
+    INDEX idx_billing_run_items_status (status, bill_id)
+);
+
+-- Stored procedures for HOSPITAL_BILLING_MODE=procedure (hm_bill_add, hm_bill_update,
+-- hm_compute_total_billing) are defined in stored_procs.py and installed with
+-- `python stored_procs.py --install` or `hospital_main.py procedures install`.
+
+-- Pending charges (charges.py) replace temp_service_usage: patient_id is an INT with foreign
+-- keys to patients and services, so lookups and the billing joins use the (patient_id,
+-- charge_id) index without a cast. The name comes from the catalog; the cost is kept per row
+-- because it is the price when the service was used. pending_charge_totals holds each
+-- patient's count and total, updated in the same transaction as every ledger write.
+CREATE TABLE pending_charges (
+    charge_id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    patient_id INT NOT NULL,
+    service_id VARCHAR(10) NOT NULL,
+    cost DECIMAL(10,2) NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    INDEX idx_pending_charges_patient (patient_id, charge_id),
+    FOREIGN KEY (patient_id) REFERENCES patients(patient_id) ON DELETE CASCADE,
+    FOREIGN KEY (service_id) REFERENCES services(service_id)
+);
+
+CREATE TABLE pending_charge_totals (
+    patient_id INT PRIMARY KEY,
+    charge_count INT NOT NULL,
+    total_amount DECIMAL(12,2) NOT NULL,
+    FOREIGN KEY (patient_id) REFERENCES patients(patient_id) ON DELETE CASCADE
+);
+
+-- Carry over unbilled usage; rows naming a patient or service that no longer exists are dropped
+INSERT INTO pending_charges (patient_id, service_id, cost, created_at)
+SELECT p.patient_id, s.service_id, u.cost, u.created_at
+FROM temp_service_usage u
+JOIN patients p ON p.patient_id = CAST(u.patient_id AS UNSIGNED) AND u.patient_id REGEXP '^[0-9]+$'
+JOIN services s ON s.service_id = u.service_id
+ORDER BY u.id;
+
+INSERT INTO pending_charge_totals (patient_id, charge_count, total_amount)
+SELECT patient_id, COUNT(*), SUM(cost) FROM pending_charges GROUP BY patient_id;
+
+-- billing_runs.max_usage_id now holds a pending_charges.charge_id
+ALTER TABLE billing_runs MODIFY max_usage_id BIGINT NOT NULL;
+
+DROP TABLE temp_service_usage;
+
+SELECT c.created_at, c.service_id, s.service_name, c.cost
+FROM pending_charges c JOIN services s ON s.service_id = c.service_id
+WHERE c.patient_id = 1001 ORDER BY c.charge_id;
+SELECT total_amount FROM pending_charge_totals WHERE patient_id = 1001;
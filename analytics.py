@@ -0,0 +1,394 @@
+import os
+import threading
+import time
+
+from db_config import get_connection
+from archive import with_archive
+from changelog import ChangeConsumer
+from mysql.connector import Error
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# In-memory columnar copy of appointments, billing and billed_services (hot and archived rows)
+# for repeated ad-hoc rollups. Loaded once, then kept current from change_log.
+ANALYTICS_FETCH_ROWS = int(os.environ.get('HOSPITAL_ANALYTICS_FETCH_ROWS', '10000'))
+# Seconds between change_log polls; a query never sees data older than this
+ANALYTICS_REFRESH_INTERVAL = float(os.environ.get('HOSPITAL_ANALYTICS_REFRESH_INTERVAL', '5'))
+# Full rebuild interval, a backstop for rows changed outside the application
+ANALYTICS_RELOAD_INTERVAL = float(os.environ.get('HOSPITAL_ANALYTICS_RELOAD_INTERVAL', '3600'))
+
+# table -> query, typed columns, row key, the entity whose events change it, the column those
+# event keys refer to, and the date column time buckets use. Strings are dictionary-encoded
+# ('category'), money is held in integer cents.
+ANALYTICS_TABLES = {
+    'appointments': {
+        'sql': "SELECT appt_id, patient_id, doctor_id, date, consulting_charge FROM appointments",
+        'columns': [('appt_id', 'category'), ('patient_id', 'int'), ('doctor_id', 'category'),
+                    ('date', 'date'), ('consulting_charge', 'money')],
+        'key': 'appt_id', 'entity': 'appointment', 'event_column': 'appt_id', 'date': 'date',
+    },
+    'billing': {
+        'sql': "SELECT bill_id, patient_id, billing_date, total_amount FROM billing",
+        'columns': [('bill_id', 'category'), ('patient_id', 'int'), ('billing_date', 'date'), ('total_amount', 'money')],
+        'key': 'bill_id', 'entity': 'bill', 'event_column': 'bill_id', 'date': 'billing_date',
+    },
+    'billed_services': {
+        'sql': "SELECT id, bill_id, patient_id, service_id, cost, billed_at FROM billed_services WHERE voided_at IS NULL",
+        'columns': [('id', 'int'), ('bill_id', 'category'), ('patient_id', 'int'), ('service_id', 'category'),
+                    ('cost', 'money'), ('billed_at', 'date')],
+        'key': 'id', 'entity': 'bill', 'event_column': 'bill_id', 'date': 'billed_at',
+    },
+}
+
+ANALYTICS_QUERIES = {
+    'visits_by_specialization_weekly': {
+        'title': "Visits per specialization per week", 'kind': 'rollup',
+        'table': 'appointments', 'by': ('specialization',), 'freq': 'week', 'measure': 'count',
+        'columns': ('Week', 'Specialization', 'Visits'),
+    },
+    'revenue_by_service_monthly': {
+        'title': "Billed revenue per service per month", 'kind': 'rollup',
+        'table': 'billed_services', 'by': ('service_name',), 'freq': 'month', 'measure': 'cost',
+        'columns': ('Month', 'Service', 'Revenue'),
+    },
+    'revenue_by_doctor_monthly': {
+        'title': "Consulting revenue per doctor per month", 'kind': 'rollup',
+        'table': 'appointments', 'by': ('doctor_id',), 'freq': 'month', 'measure': 'consulting_charge',
+        'columns': ('Month', 'Doctor ID', 'Revenue'),
+    },
+    'billing_rolling_7d': {
+        'title': "Billed amount, rolling 7 days", 'kind': 'rolling',
+        'table': 'billing', 'by': (), 'freq': 'day', 'window': 7, 'measure': 'total_amount',
+        'columns': ('Day', 'Billed (7 days)'),
+    },
+    'visits_by_specialization_rolling_4w': {
+        'title': "Visits per specialization, rolling 4 weeks", 'kind': 'rolling',
+        'table': 'appointments', 'by': ('specialization',), 'freq': 'week', 'window': 4, 'measure': 'count',
+        'columns': ('Week', 'Specialization', 'Visits (4 weeks)'),
+    },
+}
+
+_DTYPES = {'category': 'int32', 'int': 'int64', 'money': 'int64', 'date': 'datetime64[D]'}
+
+class ColumnTable:
+    # Growable column arrays plus a live mask; rows are updated in place and deleted by
+    # clearing their live flag, so positions stay stable
+    def __init__(self, columns, key):
+        self.names = [name for name, _ in columns]
+        self.kinds = dict(columns)
+        self.key_index = self.names.index(key)
+        self.size = 0
+        self.data = {name: np.empty(0, dtype=_DTYPES[kind]) for name, kind in columns}
+        self.live = np.empty(0, dtype=bool)
+        self.categories = {name: ([], {}) for name, kind in columns if kind == 'category'}  # labels, label -> code
+        self.positions = {}   # key -> row position
+        self.keys = []        # row position -> key
+
+    def column(self, name):
+        return self.data[name][:self.size]
+
+    def live_mask(self):
+        return self.live[:self.size].copy()
+
+    def labels(self, name):
+        return self.categories[name][0]
+
+    def _encode(self, name, values):
+        labels, codes = self.categories[name]
+        out = np.empty(len(values), dtype=np.int32)
+        for i, value in enumerate(values):
+            code = codes.get(value)
+            if code is None:
+                code = codes[value] = len(labels)
+                labels.append(value)
+            out[i] = code
+        return out
+
+    def _convert(self, name, values):
+        kind = self.kinds[name]
+        if kind == 'category':
+            return self._encode(name, values)
+        if kind == 'int':
+            return np.array([-1 if v is None else v for v in values], dtype=np.int64)
+        if kind == 'money':
+            return np.rint(np.array([0.0 if v is None else float(v) for v in values]) * 100).astype(np.int64)
+        return np.array(values, dtype='datetime64[D]')
+
+    def _reserve(self, count):
+        if self.size + count <= len(self.live):
+            return
+        capacity = max(2 * len(self.live), self.size + count, 1024)
+        for name, array in self.data.items():
+            grown = np.empty(capacity, dtype=array.dtype)
+            grown[:self.size] = array[:self.size]
+            self.data[name] = grown
+        live = np.zeros(capacity, dtype=bool)
+        live[:self.size] = self.live[:self.size]
+        self.live = live
+
+    def upsert(self, rows):
+        # Existing keys are overwritten in place, new keys appended
+        if not rows:
+            return
+        new = [row for row in rows if row[self.key_index] not in self.positions]
+        self._reserve(len(new))
+        targets = []
+        for row in rows:
+            key = row[self.key_index]
+            position = self.positions.get(key)
+            if position is None:
+                position = self.positions[key] = len(self.keys)
+                self.keys.append(key)
+            targets.append(position)
+        targets = np.array(targets, dtype=np.int64)
+        for i, name in enumerate(self.names):
+            self.data[name][targets] = self._convert(name, [row[i] for row in rows])
+        self.live[targets] = True
+        self.size = len(self.keys)
+
+    def replace(self, column, values, rows):
+        # After this, the live rows whose `column` is in `values` are exactly `rows`
+        codes = self.categories[column][1]
+        targets = [codes[v] for v in values if v in codes]
+        if targets:
+            current = np.flatnonzero(np.isin(self.column(column), targets) & self.live[:self.size])
+            keep = {row[self.key_index] for row in rows}
+            stale = [p for p in current if self.keys[p] not in keep]
+            self.live[stale] = False
+        self.upsert(rows)
+
+def _codes(values):
+    # Dense codes for arbitrary values: (codes, labels)
+    labels, codes = np.unique(values, return_inverse=True)
+    return codes.astype(np.int64), labels.tolist()
+
+def _time_codes(dates, freq):
+    # Bucket numbers since the epoch, and the label of each bucket used
+    valid = ~np.isnat(dates)
+    if freq == 'month':
+        buckets = dates.astype('datetime64[M]').astype(np.int64)
+        label = lambda b: str(np.datetime64(int(b), 'M'))
+    else:
+        buckets = dates.astype(np.int64)
+        if freq == 'week':
+            # 1970-01-01 was a Thursday; weeks start on Monday and are labelled by it
+            buckets = (buckets + 3) // 7
+            label = lambda b: str(np.datetime64(int(b) * 7 - 3, 'D'))
+        elif freq == 'day':
+            label = lambda b: str(np.datetime64(int(b), 'D'))
+        else:
+            raise ValueError("freq must be 'day', 'week' or 'month'")
+    return np.where(valid, buckets, -1), label
+
+class AnalyticsCache:
+    def __init__(self):
+        self.tables = {}
+        self.specializations = {}   # doctor_id -> specialization
+        self.service_names = {}     # service_id -> service_name
+        self.consumer = None
+        self.loaded_at = None
+        self.refreshed_at = None
+        self.lock = threading.Lock()
+
+    def _load_lookups(self, cursor):
+        cursor.execute("SELECT doctor_id, specialization FROM doctors")
+        self.specializations = {doctor_id: spec or 'N/A' for doctor_id, spec in cursor.fetchall()}
+        cursor.execute("SELECT service_id, service_name FROM services")
+        self.service_names = {service_id: name for service_id, name in cursor.fetchall()}
+
+    def load(self):
+        started = time.perf_counter()
+        conn = get_connection(read_only=True)
+        cursor = conn.cursor()
+        try:
+            # Events after this point are replayed over the snapshot; replaying one that the
+            # snapshot already contains is harmless because events re-read rows by key
+            cursor.execute("SELECT COALESCE(MAX(seq), 0) FROM change_log")
+            seq = cursor.fetchone()[0]
+            tables = {}
+            for name, spec in ANALYTICS_TABLES.items():
+                table = ColumnTable(spec['columns'], spec['key'])
+                cursor.execute(with_archive(spec['sql'], name, True))
+                while True:
+                    rows = cursor.fetchmany(ANALYTICS_FETCH_ROWS)
+                    if not rows:
+                        break
+                    table.upsert(rows)
+                tables[name] = table
+            self._load_lookups(cursor)
+        finally:
+            cursor.close()
+            conn.close()
+        self.tables = tables
+        entities = sorted({spec['entity'] for spec in ANALYTICS_TABLES.values()} | {'doctor', 'service'})
+        self.consumer = ChangeConsumer('analytics', entities=entities, persistent=False)
+        self.consumer.position = seq
+        self.loaded_at = self.refreshed_at = time.monotonic()
+        print(f"Analytics cache loaded: " + ", ".join(f"{name} {table.size}" for name, table in tables.items()) +
+              f" rows in {time.perf_counter() - started:.1f}s.")
+
+    def refresh(self):
+        # Applies change_log events since the last refresh by re-reading the rows they name
+        while True:
+            events = self.consumer.poll()
+            if not events:
+                break
+            keys = {}
+            for event in events:
+                keys.setdefault(event['entity'], []).append(event['key'])
+            conn = get_connection(read_only=True)
+            cursor = conn.cursor()
+            try:
+                if 'doctor' in keys or 'service' in keys:
+                    self._load_lookups(cursor)
+                for name, spec in ANALYTICS_TABLES.items():
+                    changed = list(dict.fromkeys(keys.get(spec['entity'], [])))
+                    for start in range(0, len(changed), 1000):
+                        chunk = changed[start:start + 1000]
+                        where = "AND" if " WHERE " in spec['sql'] else "WHERE"
+                        # Archived rows too: archiving records an event for the rows it moves
+                        sql = f"{spec['sql']} {where} {spec['event_column']} IN ({', '.join(['%s'] * len(chunk))})"
+                        cursor.execute(with_archive(sql, name, True), tuple(chunk) * 2)
+                        self.tables[name].replace(spec['event_column'], chunk, cursor.fetchall())
+            finally:
+                cursor.close()
+                conn.close()
+            self.consumer.commit()
+        self.refreshed_at = time.monotonic()
+
+    def ensure_fresh(self):
+        now = time.monotonic()
+        if self.loaded_at is None or now - self.loaded_at > ANALYTICS_RELOAD_INTERVAL:
+            self.load()
+        elif now - self.refreshed_at > ANALYTICS_REFRESH_INTERVAL:
+            self.refresh()
+
+    def _dimension(self, table_name, table, name):
+        # (codes per row, -1 where unknown; labels) for a grouping column
+        if name == 'specialization' and table_name == 'appointments':
+            doctors = table.labels('doctor_id')
+            spec_codes, spec_labels = _codes(np.array([self.specializations.get(d, 'N/A') for d in doctors] or ['N/A']))
+            return spec_codes[table.column('doctor_id')], spec_labels
+        if name == 'service_name' and table_name == 'billed_services':
+            services = table.labels('service_id')
+            name_codes, names = _codes(np.array([self.service_names.get(s) or str(s) for s in services] or ['']))
+            return name_codes[table.column('service_id')], names
+        if name not in table.kinds:
+            raise ValueError(f"Unknown column '{name}' for {table_name}")
+        if table.kinds[name] == 'category':
+            return table.column(name).astype(np.int64), table.labels(name)
+        return _codes(table.column(name))
+
+    def _grouped(self, table_name, by, measure, freq, start, end):
+        # Groups live rows by the time bucket (if any) then `by`; returns the group tuples of
+        # codes, their labels, and per-group counts and sums of `measure`
+        spec = ANALYTICS_TABLES[table_name]
+        table = self.tables[table_name]
+        mask = table.live_mask()
+        dates = table.column(spec['date'])
+        if start:
+            mask &= dates >= np.datetime64(str(start), 'D')
+        if end:
+            mask &= dates < np.datetime64(str(end), 'D')
+        dims = []
+        if freq:
+            # Buckets are renumbered from the first one in range, so the labels cover every
+            # bucket between the first and last, empty ones included
+            buckets, label = _time_codes(dates, freq)
+            used = buckets[mask & (buckets >= 0)]
+            offset = int(used.min()) if len(used) else 0
+            size = int(used.max()) - offset + 1 if len(used) else 0
+            dims.append((np.where(buckets >= 0, buckets - offset, -1), [label(offset + i) for i in range(size)]))
+        dims += [self._dimension(table_name, table, name) for name in by]
+        for codes, _ in dims:
+            mask &= codes >= 0
+        weights = None if measure == 'count' else table.column(measure)[mask]
+        # np.unique compacts the (possibly huge) space of code combinations to the groups that
+        # occur, so bincount's output is one slot per group
+        shape = [max(len(labels), 1) for _, labels in dims] or [1]
+        if dims:
+            flat = np.ravel_multi_index([codes[mask] for codes, _ in dims], shape)
+        else:
+            flat = np.zeros(int(mask.sum()), dtype=np.int64)
+        groups, inverse = np.unique(flat, return_inverse=True)
+        sums = np.bincount(inverse, weights=weights, minlength=len(groups))
+        return np.unravel_index(groups, shape), [labels for _, labels in dims], sums
+
+    def rollup(self, table_name, by=(), measure='count', freq=None, start=None, end=None):
+        # One row per non-empty group: (time bucket if freq, *by labels, count or sum of measure)
+        group_codes, labels, sums = self._grouped(table_name, by, measure, freq, start, end)
+        rows = []
+        for i in range(len(sums)):
+            row = [labels[d][group_codes[d][i]] for d in range(len(labels))]
+            rows.append(tuple(row) + (_value(measure, sums[i]),))
+        return rows
+
+    def rolling(self, table_name, window, by=(), measure='count', freq='day', start=None, end=None):
+        # Sum over the trailing `window` buckets for every bucket and group, empty buckets included
+        group_codes, labels, sums = self._grouped(table_name, by, measure, freq, start, end)
+        periods = labels[0]
+        groups = labels[1:]
+        shape = [max(len(g), 1) for g in groups]
+        if groups:
+            group_index = np.ravel_multi_index(group_codes[1:], shape)
+        else:
+            group_index = np.zeros(len(sums), dtype=np.int64)
+        # Only groups that occur get a row of the dense (group x bucket) matrix
+        present, row_of = np.unique(group_index, return_inverse=True)
+        dense = np.zeros((len(present), len(periods)))
+        dense[row_of, group_codes[0]] = sums
+        totals = np.cumsum(dense, axis=1)
+        totals[:, window:] = totals[:, window:] - totals[:, :-window].copy()
+        rows = []
+        for r, g in enumerate(present):
+            names = [groups[d][c] for d, c in enumerate(np.unravel_index(g, shape))] if groups else []
+            for p, period in enumerate(periods):
+                rows.append((period, *names, _value(measure, totals[r, p])))
+        return rows
+
+def _value(measure, value):
+    return int(value) if measure == 'count' else round(float(value) / 100, 2)
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_cache():
+    global _cache
+    if np is None:
+        print("In-memory analytics needs numpy. Install it with: pip install numpy")
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = AnalyticsCache()
+        _cache.ensure_fresh()
+        return _cache
+
+def run_query(name, start=None, end=None):
+    query = ANALYTICS_QUERIES[name]
+    cache = get_cache()
+    if cache is None:
+        return None
+    with cache.lock:
+        if query['kind'] == 'rolling':
+            return cache.rolling(query['table'], query['window'], query['by'], query['measure'], query['freq'], start, end)
+        return cache.rollup(query['table'], query['by'], query['measure'], query['freq'], start, end)
+
+def print_query(name, start=None, end=None):
+    try:
+        started = time.perf_counter()
+        rows = run_query(name, start, end)
+        if rows is None:
+            return
+        print(f"\n{ANALYTICS_QUERIES[name]['title']} ({(time.perf_counter() - started) * 1000:.1f} ms)")
+        print(" | ".join(ANALYTICS_QUERIES[name]['columns']))
+        if not rows:
+            print("No data for this query.")
+        for row in rows:
+            print(" | ".join(str(x) for x in row))
+    except Error as e:
+        print("Database error while refreshing analytics:", e)
+    except Exception as e:
+        print("Unexpected error while running analytics:", e)
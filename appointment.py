@@ -1,40 +1,80 @@
+import csv
+import datetime
 import re
-from db_config import get_connection
+from db_config import get_connection, prepared_cursor, row_version, live_patient
+from retry import retrying
+import history
+from changelog import record_change
+from bulk import BULK_CHUNK_SIZE, upsert_rows, format_counts
+from refcheck import reject_unknown_references
+from archive import with_archive
+from assignment import load_index
 import mysql.connector
 from mysql.connector import IntegrityError, Error
 
 class Appointment:
-    def __init__(self, appt_id, patient_id, doctor_id, date, diagnosis):
+    def __init__(self, appt_id, patient_id, doctor_id, date, diagnosis, version=None):
         self.appt_id = appt_id
         self.patient_id = patient_id
         self.doctor_id = doctor_id
         self.date = date
         self.diagnosis = diagnosis
+        # Row version as last read; update() only applies if the row still has it
+        self.version = version
+        self.conflict = False
+        self.current_version = None
 
-    def add(self):
+    def _validate(self):
+        # Returns the first validation error, or None if the appointment can be saved
         # Validate patient_id
         if not self.patient_id or not str(self.patient_id).isdigit():
-            print("Invalid Patient ID.")
-            return False
+            return "Invalid Patient ID."
         # Validate doctor_id
         if not self.doctor_id or not isinstance(self.doctor_id, str):
-            print("Invalid Doctor ID.")
-            return False
+            return "Invalid Doctor ID."
         # Validate date
         if not self.date or not re.match(r'^\d{4}-\d{2}-\d{2}$', self.date):
-            print("Invalid Date. Use YYYY-MM-DD format.")
-            return False
+            return "Invalid Date. Use YYYY-MM-DD format."
         # Validate diagnosis
         if not self.diagnosis or not isinstance(self.diagnosis, str):
-            print("Invalid Diagnosis.")
+            return "Invalid Diagnosis."
+        return None
+
+    def _check_references(self, conn):
+        # The patient and doctor must exist and not be soft-deleted. Their rows stay share-locked
+        # until the write commits, so neither can be soft-deleted in between.
+        sql = "SELECT 1 FROM patients WHERE patient_id=%s AND deleted_at IS NULL LOCK IN SHARE MODE"
+        cursor = prepared_cursor(conn, sql)
+        cursor.execute(sql, (self.patient_id,))
+        if not cursor.fetchall():
+            return "Patient ID does not exist."
+        sql = "SELECT 1 FROM doctors WHERE doctor_id=%s AND deleted_at IS NULL LOCK IN SHARE MODE"
+        cursor = prepared_cursor(conn, sql)
+        cursor.execute(sql, (self.doctor_id,))
+        if not cursor.fetchall():
+            return "Doctor ID does not exist."
+        return None
+
+    @retrying
+    def add(self):
+        error = self._validate()
+        if error:
+            print(error)
             return False
 
         try:
             conn = get_connection()
-            cursor = conn.cursor()
+            error = self._check_references(conn)
+            if error:
+                print(error)
+                return False
             sql = "INSERT INTO appointments (appt_id, patient_id, doctor_id, date, diagnosis) VALUES (%s, %s, %s, %s, %s)"
+            cursor = prepared_cursor(conn, sql)
             cursor.execute(sql, (self.appt_id, self.patient_id, self.doctor_id, self.date, self.diagnosis))
+            record_change(conn, 'appointment', self.appt_id, 'insert', {'patient_id': self.patient_id, 'doctor_id': self.doctor_id, 'date': self.date, 'diagnosis': self.diagnosis})
             conn.commit()
+            history.invalidate(self.patient_id)
+            load_index.move(new=(self.doctor_id, self.date))
             return True
         except mysql.connector.errors.IntegrityError as e:
             if "PRIMARY" in str(e):
@@ -46,39 +86,56 @@ class Appointment:
             print("Unexpected error while adding appointment:", e)
             return False
         finally:
-            if 'cursor' in locals(): cursor.close()
             if 'conn' in locals(): conn.close()
 
+    @retrying
     def update(self):
-        # Validate patient_id
-        if not self.patient_id or not str(self.patient_id).isdigit():
-            print("Invalid Patient ID.")
+        error = self._validate()
+        if error:
+            print(error)
             return False
-        # Validate doctor_id
-        if not self.doctor_id or not isinstance(self.doctor_id, str):
-            print("Invalid Doctor ID.")
-            return False
-        # Validate date
-        if not self.date or not re.match(r'^\d{4}-\d{2}-\d{2}$', self.date):
-            print("Invalid Date. Use YYYY-MM-DD format.")
-            return False
-        # Validate diagnosis
-        if not self.diagnosis or not isinstance(self.diagnosis, str):
-            print("Invalid Diagnosis.")
+        # Version validation (no version means overwrite unconditionally)
+        try:
+            version = None if self.version is None else int(self.version)
+        except ValueError:
+            print("Invalid Version. Must be a number.")
             return False
 
+        self.conflict = False
         try:
             conn = get_connection()
-            cursor = conn.cursor()
-            sql = "UPDATE appointments SET patient_id=%s, doctor_id=%s, date=%s, diagnosis=%s WHERE appt_id=%s"
-            cursor.execute(sql, (self.patient_id, self.doctor_id, self.date, self.diagnosis, self.appt_id))
-            conn.commit()
-            if cursor.rowcount == 0:
-                print("Appointment ID not found.")
+            error = self._check_references(conn)
+            if error:
+                print(error)
                 return False
+            previous = load_index.slot(conn, self.appt_id)
+            params = (self.patient_id, self.doctor_id, self.date, self.diagnosis, self.appt_id)
+            if version is None:
+                sql = "UPDATE appointments SET patient_id=%s, doctor_id=%s, date=%s, diagnosis=%s, version=version+1 WHERE appt_id=%s"
             else:
-                print("Appointment updated successfully.")
-                return True
+                # Compare-and-set: matches only if nobody has updated the row since it was read
+                sql = "UPDATE appointments SET patient_id=%s, doctor_id=%s, date=%s, diagnosis=%s, version=version+1 WHERE appt_id=%s AND version=%s"
+                params += (version,)
+            cursor = prepared_cursor(conn, sql)
+            cursor.execute(sql, params)
+            if cursor.rowcount == 0:
+                current = row_version(conn, 'appointments', 'appt_id', self.appt_id)
+                if current is None:
+                    print("Appointment ID not found.")
+                else:
+                    self.conflict = True
+                    self.current_version = current
+                    print(f"Update conflict: appointment '{self.appt_id}' was changed by someone else "
+                          f"(your version {version}, current version {current}). Reload it and try again.")
+                return False
+            record_change(conn, 'appointment', self.appt_id, 'update', {'patient_id': self.patient_id, 'doctor_id': self.doctor_id, 'date': self.date, 'diagnosis': self.diagnosis})
+            conn.commit()
+            history.invalidate()
+            load_index.move(previous, (self.doctor_id, self.date))
+            if version is not None:
+                self.version = version + 1
+            print("Appointment updated successfully.")
+            return True
         except Error as e:
             print("Database error while updating appointment:", e)
             return False
@@ -86,18 +143,24 @@ class Appointment:
             print("Unexpected error while updating appointment:", e)
             return False
         finally:
-            if 'cursor' in locals(): cursor.close()
             if 'conn' in locals(): conn.close()
 
     @staticmethod
+    @retrying
     def delete(appt_id):
         # No validation for appt_id since it's system-generated
         try:
             conn = get_connection()
-            cursor = conn.cursor()
+            previous = load_index.slot(conn, appt_id)
             sql = "DELETE FROM appointments WHERE appt_id=%s"
+            cursor = prepared_cursor(conn, sql)
             cursor.execute(sql, (appt_id,))
+            if cursor.rowcount:
+                record_change(conn, 'appointment', appt_id, 'delete')
             conn.commit()
+            history.invalidate()
+            if cursor.rowcount:
+                load_index.move(old=previous)
             if cursor.rowcount == 0:
                 print("Appointment ID not found.")
                 return False
@@ -111,17 +174,68 @@ class Appointment:
             print("Unexpected error while deleting appointment:", e)
             return False
         finally:
-            if 'cursor' in locals(): cursor.close()
             if 'conn' in locals(): conn.close()
 
     @staticmethod
-    def view():
+    def bulk_upsert(rows, chunk_size=BULK_CHUNK_SIZE):
+        # Appointment feed sync: rows are dicts with appt_id, patient_id, doctor_id, date and
+        # diagnosis. Rows naming an unknown patient or doctor are rejected before any write.
+        # Safe to re-run; returns inserted/updated/unchanged/failed/invalid/rejected counts.
+        valid, invalid = [], 0
+        for row in rows:
+            appt = Appointment(str(row.get('appt_id') or ''), str(row.get('patient_id') or ''),
+                               row.get('doctor_id'), row.get('date'), row.get('diagnosis'))
+            error = appt._validate() if appt.appt_id else "Missing Appointment ID."
+            if error:
+                print(f"Skipped appointment '{appt.appt_id}': {error}")
+                invalid += 1
+                continue
+            try:
+                # Values in the types the driver returns, so unchanged rows compare equal
+                day = datetime.datetime.strptime(appt.date, "%Y-%m-%d").date()
+            except ValueError:
+                print(f"Skipped appointment '{appt.appt_id}': Invalid Date. Use YYYY-MM-DD format.")
+                invalid += 1
+                continue
+            valid.append((appt.appt_id, (int(appt.patient_id), appt.doctor_id, day, appt.diagnosis)))
+        # The foreign keys catch the filter's rare false positives, so hits aren't re-checked
+        valid, rejected = reject_unknown_references(valid, 'appointment', {'patient': 0, 'doctor': 1}, exact=False)
+        counts = upsert_rows('appointments', 'appointment', 'appt_id', ('patient_id', 'doctor_id', 'date', 'diagnosis'), valid, chunk_size)
+        counts['invalid'] = invalid
+        counts['rejected'] = rejected
+        if counts['inserted'] or counts['updated']:
+            history.invalidate()
+            load_index.invalidate()
+        print("Appointment sync:", format_counts(counts))
+        return counts
+
+    @staticmethod
+    def get(appt_id):
+        # Reads the primary, so the version is current enough to update with
         try:
             conn = get_connection()
+            sql = "SELECT appt_id, patient_id, doctor_id, date, diagnosis, version FROM appointments WHERE appt_id=%s"
+            cursor = prepared_cursor(conn, sql)
+            cursor.execute(sql, (appt_id,))
+            rows = cursor.fetchall()
+            if not rows:
+                return None
+            appt_id, patient_id, doctor_id, date, diagnosis, version = rows[0]
+            return Appointment(appt_id, str(patient_id), doctor_id, str(date), diagnosis, version)
+        except Error as e:
+            print("Database error while fetching appointment:", e)
+            return None
+        finally:
+            if 'conn' in locals(): conn.close()
+
+    @staticmethod
+    def view():
+        try:
+            conn = get_connection(read_only=True)
             cursor = conn.cursor()
-            cursor.execute("SELECT * FROM appointments")
+            cursor.execute(f"SELECT * FROM appointments WHERE {live_patient()}")
             rows = cursor.fetchall()
-            print("Appointment_ID | Patient_ID | Doctor_ID | Date | Diagnosis")
+            print("Appointment_ID | Patient_ID | Doctor_ID | Date | Diagnosis | Consulting Charge | Version")
             for row in rows:
                 print(" | ".join(str(x) for x in row))
         except Error as e:
@@ -135,11 +249,11 @@ class Appointment:
     @staticmethod
     def filter_appointments():
         try:
-            conn = get_connection()
+            conn = get_connection(read_only=True)
             cursor = conn.cursor()
             start_date = input("Enter start date(YYYY-MM-DD): ")
             end_date = input("Enter end date(YYYY-MM-DD):")
-            cursor.execute("SELECT * FROM appointments WHERE date BETWEEN %s and %s", (start_date, end_date))
+            cursor.execute(f"SELECT * FROM appointments WHERE date BETWEEN %s and %s AND {live_patient()}", (start_date, end_date))
             for row in cursor.fetchall():
                 print(row)
         except Error as e:
@@ -151,11 +265,13 @@ class Appointment:
             if 'conn' in locals(): conn.close()
             
     @staticmethod
-    def days_between_appointments(patient_id):
-        conn = get_connection()
+    def days_between_appointments(patient_id, include_archived=False):
+        conn = get_connection(read_only=True)
         cursor = conn.cursor()
         try:
-            cursor.execute("SELECT date FROM appointments WHERE patient_id=%s ORDER BY date", (patient_id,))
+            sql = with_archive(f"SELECT date FROM appointments WHERE patient_id=%s AND {live_patient()}", 'appointments', include_archived)
+            params = (patient_id, patient_id) if include_archived else (patient_id,)
+            cursor.execute(sql + " ORDER BY date", params)
             rows = cursor.fetchall()
             dates = [row[0] for row in rows if row[0]]
             if len(dates) < 2:
@@ -176,11 +292,12 @@ class Appointment:
             conn.close()
 
     @staticmethod
-    def export_appointment_summary_to_csv(filename="appointment_summary.csv"):
-        conn = get_connection()
+    def export_appointment_summary_to_csv(filename="appointment_summary.csv", include_archived=False):
+        conn = get_connection(read_only=True)
         cursor = conn.cursor()
         try:
-            cursor.execute("SELECT appt_id, patient_id, doctor_id, date, diagnosis, consulting_charge FROM appointments")
+            cursor.execute(with_archive(f"SELECT appt_id, patient_id, doctor_id, date, diagnosis, consulting_charge FROM appointments WHERE {live_patient()}",
+                                        'appointments', include_archived))
             rows = cursor.fetchall()
             if not rows:
                 print("No appointment records to export.")
@@ -201,7 +318,9 @@ def generate_next_appointment_id():
     from db_config import get_connection
     conn = get_connection()
     cursor = conn.cursor()
-    cursor.execute("SELECT appt_id FROM appointments WHERE appt_id LIKE 'A%'")
+    # Archived IDs stay reserved so a moved appointment can't be re-issued
+    cursor.execute("SELECT appt_id FROM appointments WHERE appt_id LIKE 'A%' "
+                   "UNION ALL SELECT appt_id FROM appointments_archive WHERE appt_id LIKE 'A%'")
     ids = [int(row[0][1:]) for row in cursor.fetchall() if row[0][1:].isdigit()]
     cursor.close()
     conn.close()
@@ -0,0 +1,102 @@
+import datetime
+import os
+import sys
+import time
+
+from db_config import get_connection
+from changelog import record_changes
+import history
+from assignment import load_index
+from mysql.connector import Error
+
+# Rows dated before today - retention are moved out of the hot tables
+ARCHIVE_RETENTION_DAYS = int(os.environ.get('HOSPITAL_ARCHIVE_RETENTION_DAYS', '730'))
+# Rows moved per transaction, and the pause between transactions, keep lock time short
+ARCHIVE_BATCH_SIZE = int(os.environ.get('HOSPITAL_ARCHIVE_BATCH_SIZE', '500'))
+ARCHIVE_PAUSE = float(os.environ.get('HOSPITAL_ARCHIVE_PAUSE', '0.05'))
+
+# Hot table -> archive table with the same columns plus archived_at
+ARCHIVE_TABLES = {
+    'appointments': 'appointments_archive',
+    'billing': 'billing_archive',
+    'billed_services': 'billed_services_archive',
+}
+
+APPOINTMENT_COLUMNS = "appt_id, patient_id, doctor_id, date, diagnosis, consulting_charge"
+BILLING_COLUMNS = "bill_id, patient_id, total_amount, billing_date"
+BILLED_SERVICE_COLUMNS = "id, bill_id, patient_id, service_id, service_name, cost, billed_at, voided_at"
+
+def with_archive(select_sql, table, include_archived):
+    # Same SELECT over the hot table, optionally UNION ALL'd with its archive
+    if not include_archived:
+        return select_sql
+    return f"{select_sql} UNION ALL {select_sql.replace(f' FROM {table}', f' FROM {ARCHIVE_TABLES[table]}', 1)}"
+
+def _placeholders(values):
+    return ", ".join(["%s"] * len(values))
+
+def _archive_appointment_batch(conn, cursor, cutoff, batch_size):
+    cursor.execute("SELECT appt_id FROM appointments WHERE date < %s ORDER BY date, appt_id LIMIT %s",
+                   (cutoff, batch_size))
+    ids = [row[0] for row in cursor.fetchall()]
+    if not ids:
+        return 0
+    marks = _placeholders(ids)
+    cursor.execute(f"INSERT INTO appointments_archive ({APPOINTMENT_COLUMNS}) "
+                   f"SELECT {APPOINTMENT_COLUMNS} FROM appointments WHERE appt_id IN ({marks}) AND date < %s",
+                   (*ids, cutoff))
+    cursor.execute(f"DELETE FROM appointments WHERE appt_id IN ({marks}) AND date < %s", (*ids, cutoff))
+    record_changes(conn, [('appointment', appt_id, 'update', {'archived': True}) for appt_id in ids])
+    return len(ids)
+
+def _archive_billing_batch(conn, cursor, cutoff, batch_size):
+    # The bills stay locked until the batch commits, so Bill.add_line_item / void_line_item
+    # (which lock the bill first) can't change a line between the copy and the cascade
+    cursor.execute("SELECT bill_id FROM billing WHERE billing_date < %s ORDER BY billing_date, bill_id LIMIT %s FOR UPDATE",
+                   (cutoff, batch_size))
+    ids = [row[0] for row in cursor.fetchall()]
+    if not ids:
+        return 0
+    marks = _placeholders(ids)
+    # Line items first: deleting the bill cascades to billed_services
+    cursor.execute(f"INSERT INTO billed_services_archive ({BILLED_SERVICE_COLUMNS}) "
+                   f"SELECT {BILLED_SERVICE_COLUMNS} FROM billed_services WHERE bill_id IN ({marks})", tuple(ids))
+    cursor.execute(f"INSERT INTO billing_archive ({BILLING_COLUMNS}) "
+                   f"SELECT {BILLING_COLUMNS} FROM billing WHERE bill_id IN ({marks}) AND billing_date < %s",
+                   (*ids, cutoff))
+    cursor.execute(f"DELETE FROM billing WHERE bill_id IN ({marks}) AND billing_date < %s", (*ids, cutoff))
+    record_changes(conn, [('bill', bill_id, 'update', {'archived': True}) for bill_id in ids])
+    return len(ids)
+
+def _archive_in_batches(label, archive_batch, cutoff, batch_size, pause):
+    moved = 0
+    while True:
+        try:
+            conn = get_connection()
+            cursor = conn.cursor()
+            count = archive_batch(conn, cursor, cutoff, batch_size)
+            conn.commit()
+        except Error as e:
+            print(f"Database error while archiving {label}:", e)
+            return moved
+        finally:
+            if 'cursor' in locals(): cursor.close()
+            if 'conn' in locals(): conn.close()
+        moved += count
+        if count < batch_size:
+            return moved
+        time.sleep(pause)
+
+def archive_old_records(retention_days=ARCHIVE_RETENTION_DAYS, batch_size=ARCHIVE_BATCH_SIZE, pause=ARCHIVE_PAUSE):
+    cutoff = datetime.date.today() - datetime.timedelta(days=int(retention_days))
+    appointments = _archive_in_batches("appointments", _archive_appointment_batch, cutoff, batch_size, pause)
+    bills = _archive_in_batches("bills", _archive_billing_batch, cutoff, batch_size, pause)
+    if appointments or bills:
+        history.invalidate()
+    if appointments:
+        load_index.invalidate()
+    print(f"Archived {appointments} appointment(s) and {bills} bill(s) dated before {cutoff}.")
+    return {'appointments': appointments, 'bills': bills, 'cutoff': cutoff}
+
+if __name__ == "__main__":
+    archive_old_records(int(sys.argv[1]) if len(sys.argv) > 1 else ARCHIVE_RETENTION_DAYS)
@@ -0,0 +1,179 @@
+import heapq
+import os
+import threading
+import time
+
+from db_config import get_connection, live_patient
+from mysql.connector import Error
+
+# Other terminals' appointments are only seen after the index is rebuilt
+ASSIGNMENT_INDEX_TTL = float(os.environ.get('HOSPITAL_ASSIGNMENT_INDEX_TTL', '300'))
+
+def _specialization(value):
+    return (value or '').strip().lower()
+
+def _day(value):
+    return str(value)[:10]
+
+class DoctorLoadIndex:
+    # Appointments per doctor per day, with a min-heap of (load, doctor_id) for every
+    # (specialization, day) that has been asked about. Changes push a fresh heap entry
+    # instead of re-heapifying; entries whose load or specialization no longer match
+    # are dropped when they reach the top.
+    def __init__(self, ttl=ASSIGNMENT_INDEX_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._loaded_at = None
+        self._today = None
+        self._doctors = {}     # doctor_id -> specialization
+        self._loads = {}       # (doctor_id, day) -> appointment count
+        self._days = set()     # days whose counts have been read
+        self._heaps = {}       # (specialization, day) -> [(load, doctor_id), ...]
+
+    @property
+    def active(self):
+        return self._loaded_at is not None
+
+    def hydrate(self):
+        # Doctors plus the counts for today onwards; earlier days are read when first asked for
+        conn = get_connection(read_only=True)
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT doctor_id, specialization FROM doctors WHERE deleted_at IS NULL")
+            doctors = {doctor_id: _specialization(spec) for doctor_id, spec in cursor.fetchall()}
+            cursor.execute(f"SELECT doctor_id, date, COUNT(*) FROM appointments "
+                           f"WHERE date >= CURDATE() AND doctor_id IS NOT NULL AND {live_patient()} GROUP BY doctor_id, date")
+            loads = {(doctor_id, _day(day)): count for doctor_id, day, count in cursor.fetchall()}
+            cursor.execute("SELECT CURDATE()")
+            today = _day(cursor.fetchone()[0])
+        finally:
+            cursor.close()
+            conn.close()
+        with self._lock:
+            self._doctors = doctors
+            self._loads = loads
+            self._days = {day for _, day in loads}
+            self._today = today
+            self._heaps = {}
+            self._loaded_at = time.monotonic()
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded_at = None
+
+    def _ensure_loaded(self):
+        if self._loaded_at is None or time.monotonic() - self._loaded_at > self.ttl:
+            self.hydrate()
+
+    def _ensure_day(self, day):
+        if day in self._days or day >= self._today:
+            return
+        conn = get_connection(read_only=True)
+        cursor = conn.cursor()
+        try:
+            cursor.execute(f"SELECT doctor_id, COUNT(*) FROM appointments "
+                           f"WHERE date = %s AND doctor_id IS NOT NULL AND {live_patient()} GROUP BY doctor_id", (day,))
+            rows = cursor.fetchall()
+        finally:
+            cursor.close()
+            conn.close()
+        with self._lock:
+            if day not in self._days:
+                for doctor_id, count in rows:
+                    self._loads[(doctor_id, day)] = count
+                self._days.add(day)
+
+    def _heap(self, specialization, day):
+        # Built once per (specialization, day) from the counts; caller holds the lock
+        key = (specialization, day)
+        heap = self._heaps.get(key)
+        if heap is None:
+            heap = [(self._loads.get((doctor_id, day), 0), doctor_id)
+                    for doctor_id, spec in self._doctors.items() if spec == specialization]
+            heapq.heapify(heap)
+            self._heaps[key] = heap
+        return heap
+
+    def _push(self, doctor_id, day):
+        # Caller holds the lock
+        key = (self._doctors.get(doctor_id), day)
+        heap = self._heaps.get(key)
+        if heap is None:
+            return
+        heapq.heappush(heap, (self._loads.get((doctor_id, day), 0), doctor_id))
+        if len(heap) > 2 * len(self._doctors) + 16:
+            # Too many stale entries below the top: rebuild from the counts
+            del self._heaps[key]
+            self._heap(*key)
+
+    def least_loaded(self, specialization, day):
+        # Doctor with the fewest appointments that day (ties go to the lowest ID), or None
+        self._ensure_loaded()
+        day = _day(day)
+        self._ensure_day(day)
+        specialization = _specialization(specialization)
+        with self._lock:
+            heap = self._heap(specialization, day)
+            while heap:
+                load, doctor_id = heap[0]
+                if self._doctors.get(doctor_id) == specialization and self._loads.get((doctor_id, day), 0) == load:
+                    return doctor_id
+                heapq.heappop(heap)
+            return None
+
+    def load(self, doctor_id, day):
+        self._ensure_loaded()
+        day = _day(day)
+        self._ensure_day(day)
+        return self._loads.get((doctor_id, day), 0)
+
+    def slot(self, conn, appt_id):
+        # (doctor_id, day) an appointment holds right now, read on the writer's connection
+        # before it is changed; None when the index isn't in use
+        if not self.active:
+            return None
+        cursor = conn.cursor()
+        try:
+            cursor.execute(f"SELECT doctor_id, date FROM appointments WHERE appt_id=%s AND {live_patient()}", (appt_id,))
+            row = cursor.fetchone()
+            return (row[0], _day(row[1])) if row else None
+        finally:
+            cursor.close()
+
+    def move(self, old=None, new=None):
+        # Applies a committed appointment change: old/new are (doctor_id, day) or None
+        if not self.active:
+            return
+        with self._lock:
+            for slot, delta in ((old, -1), (new, 1)):
+                if not slot or not slot[0]:
+                    continue
+                doctor_id, day = slot[0], _day(slot[1])
+                # Days never read will be counted from the database, change included
+                if day not in self._days and day < self._today:
+                    continue
+                key = (doctor_id, day)
+                self._loads[key] = max(self._loads.get(key, 0) + delta, 0)
+                self._push(doctor_id, day)
+
+    def doctor_changed(self, doctor_id, specialization=None):
+        # specialization None means the doctor was deleted
+        if not self.active:
+            return
+        with self._lock:
+            if specialization is None:
+                self._doctors.pop(doctor_id, None)
+                return
+            self._doctors[doctor_id] = _specialization(specialization)
+            for spec, day in list(self._heaps):
+                if spec == self._doctors[doctor_id]:
+                    self._push(doctor_id, day)
+
+load_index = DoctorLoadIndex()
+
+def least_loaded_doctor(specialization, day):
+    try:
+        return load_index.least_loaded(specialization, day)
+    except Error as e:
+        print("Database error while finding the least-loaded doctor:", e)
+        return None
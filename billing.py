@@ -1,177 +1,411 @@
-from db_config import get_connection
-from service import ServiceUsageDB
+from db_config import get_connection, prepared_cursor, row_version, live_patient
+from retry import retrying
+import history
+from changelog import record_change
+from archive import with_archive
+from charges import take_charges, remove_charges, pending_total
+import stored_procs
 import re
 import datetime
 import csv
 import os
+from decimal import Decimal, InvalidOperation
 
 import mysql.connector
 from mysql.connector import IntegrityError, Error
 
 class Bill:
-    def __init__(self, bill_id, patient_id, billing_date=None):
+    def __init__(self, bill_id, patient_id, billing_date=None, version=None):
         self.bill_id = bill_id
         self.patient_id = patient_id
         self.billing_date = billing_date or datetime.date.today().strftime("%Y-%m-%d")
+        # Row version as last read; update() only applies if the row still has it
+        self.version = version
+        self.conflict = False
+        self.current_version = None
 
+    @retrying
     def add(self):
         # Data validation
         if not self.bill_id or not isinstance(self.bill_id, str) or not re.match(r'^[A-Za-z0-9]+$', self.bill_id):
             print("Invalid Bill ID. It must be alphanumeric (no spaces or special characters).")
-            return
+            return False
 
         if not self.patient_id or not isinstance(self.patient_id, str) or not re.match(r'^[A-Za-z0-9]+$', self.patient_id):
             print("Invalid Patient ID. It must be alphanumeric (no spaces or special characters).")
-            return
+            return False
 
         try:
             datetime.datetime.strptime(self.billing_date, "%Y-%m-%d")
         except ValueError:
             print("Invalid Billing Date. Use YYYY-MM-DD format.")
-            return
+            return False
 
-        # Fetch all services used by this patient from temp_service_usage
-        services = ServiceUsageDB.get_services_for_patient(self.patient_id)
-        print("DEBUG: Services fetched from temp_service_usage:", services)
-        if not services:
-            print("No services to bill for this patient.")
-            return
-
-        # Calculate total amount
-        total_amount = sum(float(s[2]) for s in services)  # s[2] is cost
+        if stored_procs.procedure_mode():
+            return stored_procs.bill_add(self)
 
         try:
             conn = get_connection()
-            cursor = conn.cursor()
+            # Pending charges, locked until the bill commits so none is billed twice or lost
+            charges = take_charges(conn, self.patient_id)
+            services = [charge[1:] for charge in charges]
+            if not services:
+                print("No services to bill for this patient.")
+                return False
+
+            # Calculate total amount
+            total_amount = sum(float(s[2]) for s in services)  # s[2] is cost
+
             # Check patient exists
-            cursor.execute("SELECT 1 FROM patients WHERE patient_id=%s", (self.patient_id,))
-            if cursor.fetchone() is None:
+            sql = "SELECT 1 FROM patients WHERE patient_id=%s AND deleted_at IS NULL"
+            cursor = prepared_cursor(conn, sql)
+            cursor.execute(sql, (self.patient_id,))
+            if not cursor.fetchall():
                 print("Patient ID does not exist.")
-                return
+                return False
 
             # Insert bill
             sql = "INSERT INTO billing (bill_id, patient_id, total_amount, billing_date) VALUES (%s, %s, %s, %s)"
+            cursor = prepared_cursor(conn, sql)
             try:
                 cursor.execute(sql, (self.bill_id, self.patient_id, total_amount, self.billing_date))
             except IntegrityError:
                 print(f"Error: Duplicate Bill ID '{self.bill_id}'. Please use a unique ID.")
-                return
+                return False
 
             # Insert service details into billed_services
+            sql = "INSERT INTO billed_services (bill_id, patient_id, service_id, service_name, cost) VALUES (%s, %s, %s, %s, %s)"
+            cursor = prepared_cursor(conn, sql)
             for s in services:
                 try:
-                    cursor.execute(
-                        "INSERT INTO billed_services (bill_id, patient_id, service_id, service_name, cost) VALUES (%s, %s, %s, %s, %s)",
-                        (self.bill_id, self.patient_id, s[0], s[1], s[2])
-                    )
+                    cursor.execute(sql, (self.bill_id, self.patient_id, s[0], s[1], s[2]))
                 except IntegrityError:
                     print(f"Error: Duplicate service entry for bill {self.bill_id} and service {s[0]}. Skipping.")
+            remove_charges(conn, self.patient_id, charges)
+            record_change(conn, 'bill', self.bill_id, 'insert', {'patient_id': self.patient_id, 'total_amount': total_amount, 'billing_date': self.billing_date, 'services': [s[0] for s in services]})
             conn.commit()
+            history.invalidate(self.patient_id)
             print(f"Bill added successfully. Total amount: {total_amount}")
             print("Billed services recorded.")
+            print(f"Cleared services for patient {self.patient_id}")
         except Error as e:
             print("Database error while adding bill:", e)
+            return False
         except Exception as e:
             print("Unexpected error while adding bill:", e)
+            return False
         finally:
-            if 'cursor' in locals(): cursor.close()
             if 'conn' in locals(): conn.close()
-
-        # Clear temp service usage for this patient
-        try:
-            ServiceUsageDB.clear_services_for_patient(self.patient_id)
-        except Exception as e:
-            print("Error clearing temp service usage:", e)
+        return True
 
 
+    @retrying
     def update(self):
         # Data validation (same as add)
         if not self.bill_id or not isinstance(self.bill_id, str) or not re.match(r'^[A-Za-z0-9]+$', self.bill_id):
             print("Invalid Bill ID. It must be alphanumeric (no spaces or special characters).")
-            return
+            return False
 
         if not self.patient_id or not isinstance(self.patient_id, str) or not re.match(r'^[A-Za-z0-9]+$', self.patient_id):
             print("Invalid Patient ID. It must be alphanumeric (no spaces or special characters).")
-            return
+            return False
 
         try:
             datetime.datetime.strptime(self.billing_date, "%Y-%m-%d")
         except ValueError:
             print("Invalid Billing Date. Use YYYY-MM-DD format.")
-            return
+            return False
 
-        # Fetch all services used by this patient from temp_service_usage
-        services = ServiceUsageDB.get_services_for_patient(self.patient_id)
-        if not services:
-            print("No services to bill for this patient.")
-            return
+        # Version validation (no version means overwrite unconditionally)
+        try:
+            version = None if self.version is None else int(self.version)
+        except ValueError:
+            print("Invalid Version. Must be a number.")
+            return False
+        self.conflict = False
 
-        # Calculate total amount
-        total_amount = sum(float(s[2]) for s in services)  # s[2] is cost
+        if stored_procs.procedure_mode():
+            return stored_procs.bill_update(self, version)
 
         try:
             conn = get_connection()
+            # Pending charges, locked until the bill commits
+            charges = take_charges(conn, self.patient_id)
+            if not charges:
+                print("No services to bill for this patient.")
+                return False
+
             cursor = conn.cursor()
             # Check patient exists
-            cursor.execute("SELECT 1 FROM patients WHERE patient_id=%s", (self.patient_id,))
+            cursor.execute("SELECT 1 FROM patients WHERE patient_id=%s AND deleted_at IS NULL", (self.patient_id,))
             if cursor.fetchone() is None:
                 print("Patient ID does not exist.")
-                return
+                return False
 
-            # Update bill
-            sql = "UPDATE billing SET patient_id=%s, total_amount=%s, billing_date=%s WHERE bill_id=%s"
-            cursor.execute(sql, (self.patient_id, total_amount, self.billing_date, self.bill_id))
-            conn.commit()
-            if cursor.rowcount == 0:
+            bill_patient = Bill._lock_bill(conn, self.bill_id)
+            if bill_patient is None:
                 print("Bill ID not found.")
+                return False
+            if not self.patient_id.isdigit() or int(self.patient_id) != bill_patient:
+                print(f"Bill '{self.bill_id}' belongs to patient {bill_patient}, not {self.patient_id}.")
+                return False
+
+            # With a version this is a compare-and-set against the row as it was read
+            if version is None:
+                cursor.execute("UPDATE billing SET billing_date=%s, version=version+1 WHERE bill_id=%s",
+                               (self.billing_date, self.bill_id))
             else:
-                print("Bill updated successfully. Total amount:", total_amount)
+                cursor.execute("UPDATE billing SET billing_date=%s, version=version+1 WHERE bill_id=%s AND version=%s",
+                               (self.billing_date, self.bill_id, version))
+            if cursor.rowcount == 0:
+                current = row_version(conn, 'billing', 'bill_id', self.bill_id)
+                self.conflict = True
+                self.current_version = current
+                print(f"Update conflict: bill '{self.bill_id}' was changed by someone else "
+                      f"(your version {version}, current version {current}). Reload it and try again.")
+                return False
+
+            # Each charge becomes a line with its audited adjustment, as add_line_item does, so the
+            # total stays the sum of the live lines
+            sql = "INSERT INTO billed_services (bill_id, patient_id, service_id, service_name, cost) VALUES (%s, %s, %s, %s, %s)"
+            lines = prepared_cursor(conn, sql)
+            for _, service_id, service_name, cost in charges:
+                lines.execute(sql, (self.bill_id, self.patient_id, service_id, service_name, cost))
+                Bill._apply_adjustment(conn, self.bill_id, lines.lastrowid, 'add', service_id, cost, "Billed pending charges")
+            remove_charges(conn, self.patient_id, charges)
+            cursor.execute("SELECT total_amount, version FROM billing WHERE bill_id=%s", (self.bill_id,))
+            total_amount, current = cursor.fetchone()
+            record_change(conn, 'bill', self.bill_id, 'update', {'patient_id': self.patient_id, 'total_amount': total_amount, 'billing_date': self.billing_date})
+            conn.commit()
+            history.invalidate()
+            if version is not None:
+                self.version = current
+            print("Bill updated successfully. Total amount:", float(total_amount))
+            print(f"Cleared services for patient {self.patient_id}")
         except Error as e:
             print("Database error while updating bill:", e)
+            return False
         except Exception as e:
             print("Unexpected error while updating bill:", e)
+            return False
         finally:
             if 'cursor' in locals(): cursor.close()
             if 'conn' in locals(): conn.close()
-
-        # Clear temp service usage for this patient
-        try:
-            ServiceUsageDB.clear_services_for_patient(self.patient_id)
-        except Exception as e:
-            print("Error clearing temp service usage:", e)
+        return True
 
     @staticmethod
+    @retrying
     def delete(bill_id):
         if not bill_id or not isinstance(bill_id, str) or not re.match(r'^[A-Za-z0-9]+$', bill_id):
             print("Invalid Bill ID. It must be alphanumeric (no spaces or special characters).")
-            return
+            return False
 
         try:
             conn = get_connection()
             cursor = conn.cursor()
             sql = "DELETE FROM billing WHERE bill_id=%s"
             cursor.execute(sql, (bill_id,))
+            if cursor.rowcount:
+                record_change(conn, 'bill', bill_id, 'delete')
             conn.commit()
+            history.invalidate()
             if cursor.rowcount == 0:
                 print("Bill ID not found.")
+                return False
             else:
                 print("Bill deleted successfully.")
+                return True
         except Error as e:
             print("Database error while deleting bill:", e)
+            return False
         except Exception as e:
             print("Unexpected error while deleting bill:", e)
+            return False
         finally:
             if 'cursor' in locals(): cursor.close()
             if 'conn' in locals(): conn.close()
 
     @staticmethod
-    def view():
+    def get(bill_id):
+        # Reads the primary, so the version is current enough to update with
         try:
             conn = get_connection()
+            sql = "SELECT bill_id, patient_id, billing_date, version FROM billing WHERE bill_id=%s"
+            cursor = prepared_cursor(conn, sql)
+            cursor.execute(sql, (bill_id,))
+            rows = cursor.fetchall()
+            if not rows:
+                return None
+            bill_id, patient_id, billing_date, version = rows[0]
+            return Bill(bill_id, str(patient_id), str(billing_date), version)
+        except Error as e:
+            print("Database error while fetching bill:", e)
+            return None
+        finally:
+            if 'conn' in locals(): conn.close()
+
+    @staticmethod
+    def _apply_adjustment(conn, bill_id, line_id, action, service_id, delta, reason):
+        # Moves the bill total by delta and writes the audit row; runs in the caller's transaction
+        sql = "UPDATE billing SET total_amount = COALESCE(total_amount, 0) + %s, version = version + 1 WHERE bill_id=%s"
+        cursor = prepared_cursor(conn, sql)
+        cursor.execute(sql, (delta, bill_id))
+        sql = "INSERT INTO bill_adjustments (bill_id, line_id, action, service_id, amount, reason) VALUES (%s, %s, %s, %s, %s, %s)"
+        cursor = prepared_cursor(conn, sql)
+        cursor.execute(sql, (bill_id, line_id, action, service_id, delta, reason))
+        record_change(conn, 'bill', bill_id, 'update', {'adjustment': action, 'line_id': line_id, 'service_id': service_id, 'total_delta': delta})
+
+    @staticmethod
+    def _lock_bill(conn, bill_id):
+        # Both adjustments lock the bill row before any line item, so concurrent ones queue
+        # on it instead of deadlocking; returns the bill's patient_id or None
+        sql = "SELECT patient_id FROM billing WHERE bill_id=%s FOR UPDATE"
+        cursor = prepared_cursor(conn, sql)
+        cursor.execute(sql, (bill_id,))
+        rows = cursor.fetchall()
+        return rows[0][0] if rows else None
+
+    @staticmethod
+    @retrying
+    def add_line_item(bill_id, service_id, cost=None, reason=None):
+        # Adds one service line to an existing bill and raises the total by its cost. The work is
+        # the same whatever the size of the bill: one line inserted, one bill row updated.
+        if cost is not None:
+            try:
+                cost = Decimal(str(cost)).quantize(Decimal('0.01'))
+                if cost < 0 or cost > 5000:
+                    print("Cost must be between 0 and 5000.")
+                    return False
+            except InvalidOperation:
+                print("Invalid Cost. Enter a valid number.")
+                return False
+        try:
+            conn = get_connection()
+            patient_id = Bill._lock_bill(conn, bill_id)
+            if patient_id is None:
+                print("Bill ID not found.")
+                return False
+
+            sql = "SELECT service_name, cost FROM services WHERE service_id=%s"
+            cursor = prepared_cursor(conn, sql)
+            cursor.execute(sql, (service_id,))
+            rows = cursor.fetchall()
+            if not rows:
+                print("Service ID not found.")
+                return False
+            service_name, amount = rows[0]
+            if cost is not None:
+                amount = cost
+
+            sql = "INSERT INTO billed_services (bill_id, patient_id, service_id, service_name, cost) VALUES (%s, %s, %s, %s, %s)"
+            cursor = prepared_cursor(conn, sql)
+            try:
+                cursor.execute(sql, (bill_id, patient_id, service_id, service_name, amount))
+            except IntegrityError:
+                print(f"Error: Service {service_id} is already on bill {bill_id}.")
+                return False
+            line_id = cursor.lastrowid
+            Bill._apply_adjustment(conn, bill_id, line_id, 'add', service_id, amount, reason)
+            conn.commit()
+            history.invalidate(patient_id)
+            print(f"Added {service_name} ({amount}) to bill {bill_id} as line {line_id}.")
+            return True
+        except Error as e:
+            print("Database error while adjusting bill:", e)
+            return False
+        except Exception as e:
+            print("Unexpected error while adjusting bill:", e)
+            return False
+        finally:
+            if 'conn' in locals(): conn.close()
+
+    @staticmethod
+    @retrying
+    def void_line_item(bill_id, line_id, reason=None):
+        # Marks one line as voided (it stays for the record) and lowers the total by its cost
+        try:
+            conn = get_connection()
+            patient_id = Bill._lock_bill(conn, bill_id)
+            if patient_id is None:
+                print("Bill ID not found.")
+                return False
+
+            sql = "SELECT service_id, cost, voided_at FROM billed_services WHERE id=%s AND bill_id=%s FOR UPDATE"
+            cursor = prepared_cursor(conn, sql)
+            cursor.execute(sql, (line_id, bill_id))
+            rows = cursor.fetchall()
+            if not rows:
+                print(f"Line {line_id} not found on bill {bill_id}.")
+                return False
+            service_id, amount, voided_at = rows[0]
+            if voided_at is not None:
+                print(f"Line {line_id} was already voided at {voided_at}.")
+                return False
+
+            sql = "UPDATE billed_services SET voided_at = CURRENT_TIMESTAMP WHERE id=%s"
+            cursor = prepared_cursor(conn, sql)
+            cursor.execute(sql, (line_id,))
+            Bill._apply_adjustment(conn, bill_id, line_id, 'void', service_id, -amount, reason)
+            conn.commit()
+            history.invalidate(patient_id)
+            print(f"Voided line {line_id} on bill {bill_id}; total reduced by {amount}.")
+            return True
+        except Error as e:
+            print("Database error while adjusting bill:", e)
+            return False
+        except Exception as e:
+            print("Unexpected error while adjusting bill:", e)
+            return False
+        finally:
+            if 'conn' in locals(): conn.close()
+
+    @staticmethod
+    def line_items(bill_id):
+        try:
+            conn = get_connection(read_only=True)
             cursor = conn.cursor()
-            cursor.execute("SELECT * FROM billing")
+            cursor.execute("SELECT id, service_id, service_name, cost, billed_at, voided_at FROM billed_services "
+                           "WHERE bill_id=%s ORDER BY id", (bill_id,))
             rows = cursor.fetchall()
-            print("ID | Patient ID | Total Amount | Billing Date")
+            print("Line | Service ID | Service Name | Cost | Billed At | Voided At")
+            for row in rows:
+                print(" | ".join("" if x is None else str(x) for x in row))
+            return rows
+        except Error as e:
+            print("Database error while fetching bill lines:", e)
+            return []
+        finally:
+            if 'cursor' in locals(): cursor.close()
+            if 'conn' in locals(): conn.close()
+
+    @staticmethod
+    def adjustments(bill_id):
+        # Audit trail, oldest first
+        try:
+            conn = get_connection(read_only=True)
+            cursor = conn.cursor()
+            cursor.execute("SELECT id, action, line_id, service_id, amount, reason, created_at FROM bill_adjustments "
+                           "WHERE bill_id=%s ORDER BY created_at, id", (bill_id,))
+            rows = cursor.fetchall()
+            print("Adjustment | Action | Line | Service ID | Amount | Reason | At")
+            for row in rows:
+                print(" | ".join("" if x is None else str(x) for x in row))
+            return rows
+        except Error as e:
+            print("Database error while fetching bill adjustments:", e)
+            return []
+        finally:
+            if 'cursor' in locals(): cursor.close()
+            if 'conn' in locals(): conn.close()
+
+    @staticmethod
+    def view():
+        try:
+            conn = get_connection(read_only=True)
+            cursor = conn.cursor()
+            cursor.execute(f"SELECT * FROM billing WHERE {live_patient()}")
+            rows = cursor.fetchall()
+            print("ID | Patient ID | Total Amount | Billing Date | Version")
             for row in rows:
                 print(" | ".join(str(x) for x in row))
         except Error as e:
@@ -184,12 +418,15 @@ class Bill:
 
 
     def generate_invoice(self):
-        conn = get_connection()
+        conn = get_connection(read_only=True)
         cursor = conn.cursor(dictionary=True)
         try:
             # 1. Fetch patient details
-            cursor.execute("SELECT * FROM patients WHERE patient_id = %s", (self.patient_id,))
+            cursor.execute("SELECT * FROM patients WHERE patient_id = %s AND deleted_at IS NULL", (self.patient_id,))
             patient = cursor.fetchone()
+            if not patient:
+                print("Patient ID does not exist.")
+                return
 
             # 2. Fetch doctor and latest appointment details
             cursor.execute("""
@@ -206,7 +443,7 @@ class Bill:
                 SELECT s.service_name, bs.cost
                 FROM billed_services bs
                 JOIN services s ON bs.service_id = s.service_id
-                WHERE bs.bill_id = %s
+                WHERE bs.bill_id = %s AND bs.voided_at IS NULL
             """, (self.bill_id,))
             services = cursor.fetchall()
 
@@ -270,11 +507,12 @@ class Bill:
             if 'conn' in locals(): conn.close()
 
     @staticmethod
-    def export_billing_summary_to_csv(filename="billing_summary.csv"):
-        conn = get_connection()
+    def export_billing_summary_to_csv(filename="billing_summary.csv", include_archived=False):
+        conn = get_connection(read_only=True)
         cursor = conn.cursor()
         try:
-            cursor.execute("SELECT bill_id, patient_id, total_amount, billing_date FROM billing")
+            cursor.execute(with_archive(f"SELECT bill_id, patient_id, total_amount, billing_date FROM billing WHERE {live_patient()}",
+                                        'billing', include_archived))
             rows = cursor.fetchall()
             if not rows:
                 print("No billing records to export.")
@@ -291,16 +529,25 @@ class Bill:
             cursor.close()
             conn.close()
 
-def compute_total_billing(patient_id):
+def compute_total_billing(patient_id, include_archived=False):
     try:
-        conn = get_connection()
+        conn = get_connection(read_only=True)
+        sql = "SELECT 1 FROM patients WHERE patient_id=%s AND deleted_at IS NULL"
+        check = prepared_cursor(conn, sql)
+        check.execute(sql, (patient_id,))
+        if not check.fetchall():
+            print("Patient ID does not exist.")
+            return None
+        if stored_procs.procedure_mode():
+            service_total, consulting_total = stored_procs.compute_totals(patient_id, include_archived)
+            total_billing = service_total + consulting_total
+            print(f"Service Total: {service_total}")
+            print(f"Consulting Total: {consulting_total}")
+            print(f"Total Billing: {total_billing}")
+            return total_billing
+        # Pending service costs, kept per patient alongside the ledger
+        service_total = pending_total(conn, patient_id)
         cursor = conn.cursor()
-        # Sum service costs
-        cursor.execute(
-            "SELECT COALESCE(SUM(cost), 0) FROM temp_service_usage WHERE patient_id=%s",
-            (patient_id,)
-        )
-        service_total = cursor.fetchone()[0] or 0
 
         # Sum consulting charges
         cursor.execute(
@@ -308,6 +555,12 @@ def compute_total_billing(patient_id):
             (patient_id,)
         )
         consulting_total = cursor.fetchone()[0] or 0
+        if include_archived:
+            cursor.execute(
+                "SELECT COALESCE(SUM(consulting_charge), 0) FROM appointments_archive WHERE patient_id=%s",
+                (patient_id,)
+            )
+            consulting_total += cursor.fetchone()[0] or 0
 
         total_billing = service_total + consulting_total
         print(f"Service Total: {service_total}")
@@ -328,7 +581,11 @@ def generate_next_bill_id():
     from db_config import get_connection
     conn = get_connection()
     cursor = conn.cursor()
-    cursor.execute("SELECT bill_id FROM billing WHERE bill_id REGEXP '^B[0-9]+$'")
+    # Archived IDs stay reserved so a moved bill can't be re-issued, and so do the IDs a
+    # billing run (billing_run.py) has allocated but not used yet
+    cursor.execute("SELECT bill_id FROM billing WHERE bill_id REGEXP '^B[0-9]+$' "
+                   "UNION ALL SELECT bill_id FROM billing_archive WHERE bill_id REGEXP '^B[0-9]+$' "
+                   "UNION ALL SELECT bill_id FROM billing_run_items WHERE status = 'pending'")
     bill_ids = cursor.fetchall()
     cursor.close()
     conn.close()
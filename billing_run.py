@@ -0,0 +1,242 @@
+import datetime
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from db_config import get_connection
+import history
+from mysql.connector import Error, IntegrityError
+
+# Nightly billing: one bill per patient with pending usage, created by set-based statements over
+# batches of patients instead of one Bill.add per patient. A run is planned once (patients,
+# shards and bill IDs are fixed in billing_run_items) and each batch commits its bills together
+# with the items it completes, so an interrupted run picks up where it stopped.
+BILLING_RUN_WORKERS = int(os.environ.get('HOSPITAL_BILLING_RUN_WORKERS', '4'))
+BILLING_RUN_BATCH = int(os.environ.get('HOSPITAL_BILLING_RUN_BATCH', '500'))
+
+# Every statement covers the pending items of one shard with patient_id in [lo, hi], joined to
+# their charges on the (patient_id, charge_id) index. Only charges recorded before the run was
+# planned (charge_id <= max_usage_id) are billed; later ones wait for the next run.
+_RANGE = "i.run_id = %s AND i.shard = %s AND i.status = 'pending' AND i.patient_id BETWEEN %s AND %s"
+_ITEMS = ("FROM billing_run_items i JOIN pending_charges u "
+          "ON u.patient_id = i.patient_id AND u.charge_id <= %s "
+          "JOIN services s ON s.service_id = u.service_id WHERE " + _RANGE)
+
+BATCH_STEPS = [
+    "INSERT INTO billing (bill_id, patient_id, total_amount, billing_date) "
+    "SELECT i.bill_id, i.patient_id, SUM(u.cost), %s " + _ITEMS + " GROUP BY i.bill_id, i.patient_id",
+    "INSERT INTO billed_services (bill_id, patient_id, service_id, service_name, cost) "
+    "SELECT i.bill_id, i.patient_id, u.service_id, s.service_name, u.cost " + _ITEMS + " ORDER BY u.charge_id",
+    "INSERT INTO change_log (entity, entity_key, op, changed_fields) "
+    "SELECT 'bill', i.bill_id, 'insert', JSON_OBJECT('patient_id', i.patient_id, 'total_amount', SUM(u.cost), "
+    "'billing_date', %s, 'services', JSON_ARRAYAGG(u.service_id)) " + _ITEMS + " GROUP BY i.bill_id, i.patient_id",
+    # Billed charges come off the per-patient totals before they are deleted
+    "UPDATE pending_charge_totals t JOIN (SELECT i.patient_id, COUNT(*) AS n, SUM(u.cost) AS amount " + _ITEMS +
+    " GROUP BY i.patient_id) billed ON billed.patient_id = t.patient_id "
+    "SET t.charge_count = t.charge_count - billed.n, t.total_amount = t.total_amount - billed.amount",
+    "INSERT INTO change_log (entity, entity_key, op, changed_fields) "
+    "SELECT 'charge', i.patient_id, 'delete', JSON_OBJECT('count', COUNT(*), 'up_to', MAX(u.charge_id)) " + _ITEMS +
+    " GROUP BY i.patient_id",
+    "DELETE u " + _ITEMS,
+    "DELETE t FROM billing_run_items i JOIN pending_charge_totals t ON t.patient_id = i.patient_id "
+    "WHERE t.charge_count <= 0 AND " + _RANGE,
+]
+
+# Items whose usage was billed by hand after planning get no bill and are marked skipped
+FINISH_BATCH = ("UPDATE billing_run_items i SET i.status = IF(EXISTS (SELECT 1 FROM billing b WHERE b.bill_id = i.bill_id), "
+                "'billed', 'skipped') WHERE i.run_id = %s AND i.shard = %s AND i.status = 'pending' "
+                "AND i.patient_id BETWEEN %s AND %s")
+
+def _next_bill_number(cursor):
+    # Same numbering as generate_next_bill_id, read under the planning transaction
+    cursor.execute("SELECT COALESCE(MAX(CAST(SUBSTRING(bill_id, 2) AS UNSIGNED)), 0) FROM ("
+                   "SELECT bill_id FROM billing WHERE bill_id REGEXP '^B[0-9]+$' "
+                   "UNION ALL SELECT bill_id FROM billing_archive WHERE bill_id REGEXP '^B[0-9]+$' "
+                   "UNION ALL SELECT bill_id FROM billing_run_items WHERE status = 'pending') ids")
+    return int(cursor.fetchone()[0]) + 1
+
+def plan_run(billing_date=None, shards=BILLING_RUN_WORKERS):
+    # Fixes the run: the usage high-water mark, which patients are billed, their shard and
+    # their bill ID (allocated up front in patient order). Returns the run_id, or None if
+    # nobody has pending usage.
+    billing_date = billing_date or datetime.date.today().strftime("%Y-%m-%d")
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        # Two runs planned at once would otherwise allocate the same bill numbers
+        cursor.execute("SELECT GET_LOCK('billing_run_plan', 30)")
+        cursor.fetchone()
+        cursor.execute("SELECT MAX(charge_id) FROM pending_charges")
+        max_usage_id = cursor.fetchone()[0]
+        if max_usage_id is None:
+            return None
+        first_number = _next_bill_number(cursor)
+        cursor.execute("INSERT INTO billing_runs (billing_date, max_usage_id, shards, status) VALUES (%s, %s, %s, 'running')",
+                       (billing_date, max_usage_id, shards))
+        run_id = cursor.lastrowid
+        cursor.execute(
+            "INSERT INTO billing_run_items (run_id, patient_id, shard, bill_id, status) "
+            "SELECT %s, p.patient_id, MOD(p.patient_id, %s), "
+            "CONCAT('B', LPAD(n, GREATEST(3, LENGTH(n)), '0')), 'pending' FROM ("
+            "  SELECT p.patient_id, %s + ROW_NUMBER() OVER (ORDER BY p.patient_id) - 1 AS n "
+            "  FROM (SELECT DISTINCT patient_id FROM pending_charges WHERE charge_id <= %s) u "
+            "  JOIN patients p ON p.patient_id = u.patient_id AND p.deleted_at IS NULL"
+            ") p",
+            (run_id, shards, first_number, max_usage_id))
+        planned = cursor.rowcount
+        if not planned:
+            conn.rollback()
+            return None
+        conn.commit()
+        print(f"Planned billing run {run_id}: {planned} patient(s) in {shards} shard(s), usage up to #{max_usage_id}.")
+        return run_id
+    finally:
+        cursor.execute("SELECT RELEASE_LOCK('billing_run_plan')")
+        cursor.fetchone()
+        cursor.close()
+        conn.close()
+
+def _bill_range(cursor, run, shard, lo, hi):
+    run_id, billing_date, max_usage_id = run
+    items = (max_usage_id, run_id, shard, lo, hi)
+    cursor.execute(BATCH_STEPS[0], (billing_date,) + items)
+    bills = cursor.rowcount
+    cursor.execute(BATCH_STEPS[1], items)
+    cursor.execute(BATCH_STEPS[2], (billing_date,) + items)
+    cursor.execute(BATCH_STEPS[3], items)
+    cursor.execute(BATCH_STEPS[4], items)
+    cursor.execute(BATCH_STEPS[5], items)
+    cursor.execute(BATCH_STEPS[6], (run_id, shard, lo, hi))
+    cursor.execute(FINISH_BATCH, (run_id, shard, lo, hi))
+    return bills
+
+def _bill_shard(run, shard, batch_size):
+    # Worker: bills the shard's pending items batch by batch, one transaction per batch
+    run_id = run[0]
+    conn = get_connection()
+    cursor = conn.cursor()
+    bills = 0
+    try:
+        while True:
+            cursor.execute("SELECT patient_id FROM billing_run_items WHERE run_id = %s AND shard = %s AND status = 'pending' "
+                           "ORDER BY patient_id LIMIT %s FOR UPDATE", (run_id, shard, batch_size))
+            patients = [row[0] for row in cursor.fetchall()]
+            if not patients:
+                conn.commit()
+                break
+            try:
+                bills += _bill_range(cursor, run, shard, patients[0], patients[-1])
+                conn.commit()
+            except IntegrityError as e:
+                # Usually a bill ID taken by hand since planning: bill this batch one patient at a time
+                conn.rollback()
+                print(f"Run {run_id} shard {shard}: batch failed ({e}); billing it patient by patient.")
+                for patient_id in patients:
+                    bills += _bill_one(conn, cursor, run, shard, patient_id)
+    finally:
+        cursor.close()
+        conn.close()
+    return bills
+
+def _bill_one(conn, cursor, run, shard, patient_id):
+    try:
+        bills = _bill_range(cursor, run, shard, patient_id, patient_id)
+        conn.commit()
+        return bills
+    except IntegrityError as e:
+        conn.rollback()
+        print(f"Run {run[0]}: could not bill patient {patient_id}, left for the next run: {e}")
+        cursor.execute("UPDATE billing_run_items SET status = 'failed' WHERE run_id = %s AND patient_id = %s",
+                       (run[0], patient_id))
+        conn.commit()
+        return 0
+
+def _finish_run(run_id):
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT status, COUNT(*) FROM billing_run_items WHERE run_id = %s GROUP BY status", (run_id,))
+        counts = dict(cursor.fetchall())
+        cursor.execute("SELECT COALESCE(SUM(b.total_amount), 0) FROM billing_run_items i "
+                       "JOIN billing b ON b.bill_id = i.bill_id WHERE i.run_id = %s AND i.status = 'billed'", (run_id,))
+        total = cursor.fetchone()[0]
+        status = 'running' if counts.get('pending') else 'done'
+        cursor.execute("UPDATE billing_runs SET status = %s, bills = %s, total_amount = %s, "
+                       "finished_at = IF(%s = 'done', CURRENT_TIMESTAMP, NULL) WHERE run_id = %s",
+                       (status, counts.get('billed', 0), total, status, run_id))
+        conn.commit()
+        return {'run_id': run_id, 'status': status, 'billed': counts.get('billed', 0),
+                'skipped': counts.get('skipped', 0), 'failed': counts.get('failed', 0),
+                'pending': counts.get('pending', 0), 'total_amount': total}
+    finally:
+        cursor.close()
+        conn.close()
+
+def _unfinished_run():
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT run_id FROM billing_runs WHERE status = 'running' ORDER BY run_id LIMIT 1")
+        row = cursor.fetchone()
+        return row[0] if row else None
+    finally:
+        cursor.close()
+        conn.close()
+
+def execute_run(run_id, workers=BILLING_RUN_WORKERS, batch_size=BILLING_RUN_BATCH):
+    # Bills every pending item of the run, one worker thread per shard
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT run_id, billing_date, max_usage_id, shards FROM billing_runs WHERE run_id = %s", (run_id,))
+        row = cursor.fetchone()
+    finally:
+        cursor.close()
+        conn.close()
+    if row is None:
+        print(f"No billing run {run_id}.")
+        return None
+    run, shards = (row[0], row[1], row[2]), row[3]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, shards))) as executor:
+        futures = [executor.submit(_bill_shard, run, shard, batch_size) for shard in range(shards)]
+        errors = []
+        for future in futures:
+            try:
+                future.result()
+            except Error as e:
+                errors.append(e)
+    history.invalidate()
+    result = _finish_run(run_id)
+    print(f"Billing run {run_id}: {result['billed']} bill(s), total {result['total_amount']}, "
+          f"{result['skipped']} skipped, {result['failed']} failed, {result['pending']} pending "
+          f"({time.perf_counter() - started:.1f}s).")
+    for e in errors:
+        print("Database error in billing run worker:", e)
+    if result['pending']:
+        print(f"Run {run_id} is incomplete; run it again to resume.")
+    return result
+
+def run_billing(billing_date=None, workers=BILLING_RUN_WORKERS, batch_size=BILLING_RUN_BATCH):
+    # Resumes an interrupted run if there is one, otherwise plans and executes a new one
+    try:
+        run_id = _unfinished_run()
+        if run_id is not None:
+            print(f"Resuming billing run {run_id}.")
+        else:
+            run_id = plan_run(billing_date, workers)
+            if run_id is None:
+                print("No pending service usage to bill.")
+                return None
+        return execute_run(run_id, workers, batch_size)
+    except Error as e:
+        print("Database error during billing run:", e)
+        return None
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    workers = int(args[args.index('--workers') + 1]) if '--workers' in args else BILLING_RUN_WORKERS
+    billing_date = args[args.index('--date') + 1] if '--date' in args else None
+    result = run_billing(billing_date, workers)
+    sys.exit(0 if result and result['status'] == 'done' else 1)
@@ -0,0 +1,122 @@
+import os
+
+from db_config import get_connection
+from changelog import record_changes
+from mysql.connector import Error, IntegrityError
+
+# Rows per multi-row statement; each chunk is its own transaction
+BULK_CHUNK_SIZE = int(os.environ.get('HOSPITAL_BULK_CHUNK_SIZE', '1000'))
+
+def _row_marks(count, width):
+    row = "(" + ", ".join(["%s"] * width) + ")"
+    return ", ".join([row] * count)
+
+def _flatten(rows):
+    return tuple(value for key, values in rows for value in (key, *values))
+
+def _existing(cursor, table, key_column, columns, keys, deleted_column=None):
+    # Current values of the chunk's keys that already exist, locked until the chunk commits,
+    # and which of them are soft-deleted
+    selected = [key_column, *columns] + ([deleted_column] if deleted_column else [])
+    cursor.execute(f"SELECT {', '.join(selected)} FROM {table} "
+                   f"WHERE {key_column} IN ({', '.join(['%s'] * len(keys))}) FOR UPDATE", tuple(keys))
+    rows = cursor.fetchall()
+    width = len(columns) + 1
+    deleted = {row[0] for row in rows if deleted_column and row[width] is not None}
+    return {row[0]: tuple(row[1:width]) for row in rows}, deleted
+
+def _insert_sql(table, key_column, columns, count):
+    return f"INSERT INTO {table} ({key_column}, {', '.join(columns)}) VALUES {_row_marks(count, len(columns) + 1)}"
+
+def _upsert_sql(table, key_column, columns, count):
+    assignments = ", ".join(["version=version+1"] + [f"{c}=VALUES({c})" for c in columns])
+    return f"{_insert_sql(table, key_column, columns, count)} ON DUPLICATE KEY UPDATE {assignments}"
+
+def _write_chunk(cursor, table, key_column, columns, inserts, updates):
+    # New keys go through a plain INSERT: ON DUPLICATE KEY UPDATE would also fire on a clash
+    # with any other unique key of the table and overwrite that other row.
+    if inserts:
+        cursor.execute(_insert_sql(table, key_column, columns, len(inserts)), _flatten(inserts))
+    if updates:
+        cursor.execute(_upsert_sql(table, key_column, columns, len(updates)), _flatten(updates))
+
+def _write_rows(cursor, table, key_column, columns, inserts, updates):
+    # Row-at-a-time retry of a chunk that hit a constraint, so only the offending rows are lost
+    written = {'insert': [], 'update': []}
+    failed = 0
+    for op, rows, sql in (('insert', inserts, _insert_sql(table, key_column, columns, 1)),
+                          ('update', updates, _upsert_sql(table, key_column, columns, 1))):
+        for key, values in rows:
+            try:
+                cursor.execute(sql, (key, *values))
+                written[op].append((key, values))
+            except IntegrityError as e:
+                print(f"Skipped {table} row '{key}':", e)
+                failed += 1
+    return written['insert'], written['update'], failed
+
+def _rollback_chunk(cursor):
+    try:
+        cursor.execute("ROLLBACK TO SAVEPOINT bulk_chunk")
+    except Error:
+        # The connection is gone, and the transaction with it
+        pass
+
+def upsert_rows(table, entity, key_column, columns, rows, chunk_size=BULK_CHUNK_SIZE, on_written=None,
+                deleted_column=None):
+    # Idempotent bulk sync. rows are (key, values) pairs with values in `columns` order, already
+    # validated and converted to the types the driver returns so that unchanged rows are
+    # recognised and not written at all. A key given twice keeps its last values.
+    # on_written(conn, rows) runs before each chunk commits, with the rows that were written.
+    # With deleted_column, rows naming a soft-deleted key are not written and count as rejected.
+    latest = dict(rows)
+    keys = list(latest)
+    counts = {'inserted': 0, 'updated': 0, 'unchanged': 0, 'failed': 0}
+    if deleted_column:
+        counts['rejected'] = 0
+    try:
+        conn = get_connection()
+        cursor = conn.cursor()
+        for start in range(0, len(keys), chunk_size):
+            chunk = keys[start:start + chunk_size]
+            existing, deleted = _existing(cursor, table, key_column, columns, chunk, deleted_column)
+            for key in deleted:
+                print(f"Skipped {table} row '{key}': it was deleted")
+            chunk = [key for key in chunk if key not in deleted]
+            inserts = [(key, latest[key]) for key in chunk if key not in existing]
+            updates = [(key, latest[key]) for key in chunk if key in existing and existing[key] != latest[key]]
+            unchanged = len(chunk) - len(inserts) - len(updates)
+            failed = 0
+            # A savepoint rather than a rollback, so a caller's surrounding transaction survives
+            cursor.execute("SAVEPOINT bulk_chunk")
+            try:
+                try:
+                    _write_chunk(cursor, table, key_column, columns, inserts, updates)
+                except IntegrityError:
+                    cursor.execute("ROLLBACK TO SAVEPOINT bulk_chunk")
+                    inserts, updates, failed = _write_rows(cursor, table, key_column, columns, inserts, updates)
+                if on_written:
+                    on_written(conn, inserts + updates)
+                record_changes(conn, [(entity, key, 'insert', dict(zip(columns, values))) for key, values in inserts] +
+                                     [(entity, key, 'update', dict(zip(columns, values))) for key, values in updates])
+            except Error:
+                # None of the failed chunk may be left in a caller's transaction to be committed with it
+                _rollback_chunk(cursor)
+                raise
+            conn.commit()
+            counts['inserted'] += len(inserts)
+            counts['updated'] += len(updates)
+            counts['unchanged'] += unchanged
+            counts['failed'] += failed
+            if deleted:
+                counts['rejected'] += len(deleted)
+    except Error as e:
+        print(f"Database error during bulk upsert into {table}:", e)
+        counts['failed'] += len(keys) - sum(counts.values())
+    finally:
+        if 'cursor' in locals(): cursor.close()
+        if 'conn' in locals(): conn.close()
+    return counts
+
+def format_counts(counts):
+    return ", ".join(f"{value} {name}" for name, value in counts.items())
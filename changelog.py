@@ -0,0 +1,133 @@
+import json
+import os
+import time
+
+from db_config import get_connection, prepared_cursor
+from mysql.connector import Error
+
+# A missing sequence number is usually a transaction that hasn't committed yet; after this many
+# seconds it is treated as rolled back and skipped.
+CHANGE_LOG_GAP_TIMEOUT = float(os.environ.get('HOSPITAL_CHANGE_LOG_GAP_TIMEOUT', '10'))
+
+def record_change(conn, entity, key, op, fields=None):
+    # Must run on the caller's connection before its commit, so the event is part of the
+    # same transaction as the change it describes
+    sql = "INSERT INTO change_log (entity, entity_key, op, changed_fields) VALUES (%s, %s, %s, %s)"
+    cursor = prepared_cursor(conn, sql)
+    cursor.execute(sql, (entity, str(key), op, json.dumps(fields, default=str) if fields else None))
+
+def record_changes(conn, events):
+    # Bulk form of record_change for (entity, key, op, fields) tuples; one multi-row INSERT
+    if not events:
+        return
+    cursor = conn.cursor()
+    try:
+        cursor.executemany(
+            "INSERT INTO change_log (entity, entity_key, op, changed_fields) VALUES (%s, %s, %s, %s)",
+            [(entity, str(key), op, json.dumps(fields, default=str) if fields else None)
+             for entity, key, op, fields in events])
+    finally:
+        cursor.close()
+
+def read_changes(after_seq, limit=500, entities=None):
+    # Committed events with seq > after_seq, oldest first
+    sql = "SELECT seq, entity, entity_key, op, changed_fields, created_at FROM change_log WHERE seq > %s"
+    params = [after_seq]
+    if entities:
+        sql += f" AND entity IN ({', '.join(['%s'] * len(entities))})"
+        params += list(entities)
+    sql += " ORDER BY seq LIMIT %s"
+    params.append(limit)
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(sql, tuple(params))
+        return [
+            {'seq': seq, 'entity': entity, 'key': key, 'op': op,
+             'fields': json.loads(fields) if fields else None, 'at': created_at}
+            for seq, entity, key, op, fields, created_at in cursor.fetchall()
+        ]
+    finally:
+        cursor.close()
+        conn.close()
+
+class ChangeConsumer:
+    # Tails change_log from a named, persisted checkpoint. With persistent=False the position
+    # lives only in memory and must be set before the first poll().
+    def __init__(self, name, entities=None, batch_size=500, persistent=True):
+        self.name = name
+        self.entities = entities
+        self.batch_size = batch_size
+        self.persistent = persistent
+        self.position = None
+        self._last_seq = None
+        self._gap_seen_at = None
+
+    def load_checkpoint(self):
+        conn = get_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT last_seq FROM change_log_checkpoints WHERE consumer=%s", (self.name,))
+            row = cursor.fetchone()
+            self.position = row[0] if row else 0
+            return self.position
+        finally:
+            cursor.close()
+            conn.close()
+
+    def save_checkpoint(self, seq):
+        conn = get_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute("INSERT INTO change_log_checkpoints (consumer, last_seq) VALUES (%s, %s) "
+                           "ON DUPLICATE KEY UPDATE last_seq = VALUES(last_seq)", (self.name, seq))
+            conn.commit()
+            self.position = seq
+        finally:
+            cursor.close()
+            conn.close()
+
+    def poll(self):
+        # Next batch after the checkpoint. Sequence numbers are assigned at insert time, not at
+        # commit, so the batch stops at a hole until the hole is older than the gap timeout.
+        if self.position is None:
+            self.load_checkpoint()
+        events = read_changes(self.position, self.batch_size)
+        ready = []
+        expected = self.position + 1
+        for event in events:
+            if event['seq'] != expected:
+                if self._gap_seen_at is None:
+                    self._gap_seen_at = time.monotonic()
+                if time.monotonic() - self._gap_seen_at < CHANGE_LOG_GAP_TIMEOUT:
+                    break
+            self._gap_seen_at = None
+            ready.append(event)
+            expected = event['seq'] + 1
+        self._last_seq = ready[-1]['seq'] if ready else self.position
+        # Filtered only after the gap check, so other entities' events don't look like holes
+        if self.entities:
+            ready = [e for e in ready if e['entity'] in self.entities]
+        return ready
+
+    def commit(self):
+        # Marks everything returned by the last poll() as processed
+        if self._last_seq is not None and self._last_seq != self.position:
+            if self.persistent:
+                self.save_checkpoint(self._last_seq)
+            else:
+                self.position = self._last_seq
+
+    def tail(self, handler, poll_interval=1.0, should_stop=lambda: False):
+        # Calls handler(events) for each new batch, checkpointing after it returns
+        while not should_stop():
+            events = []
+            try:
+                events = self.poll()
+                if events:
+                    handler(events)
+                self.commit()
+            except Error as e:
+                print(f"Database error in change consumer '{self.name}':", e)
+            if not events:
+                time.sleep(poll_interval)
@@ -0,0 +1,85 @@
+from decimal import Decimal
+
+from db_config import prepared_cursor
+from changelog import record_change, record_changes
+
+# Pending charges: services used by a patient and not billed yet, one row per use at the price
+# of the day, with the patient's count and total kept beside them in pending_charge_totals.
+# Every function runs on the caller's connection, inside its transaction, so the ledger and the
+# totals always commit together, as do the 'charge' events (keyed by patient) they record.
+
+TOTALS_UPSERT = ("INSERT INTO pending_charge_totals (patient_id, charge_count, total_amount) VALUES (%s, %s, %s) "
+                 "ON DUPLICATE KEY UPDATE charge_count = charge_count + VALUES(charge_count), "
+                 "total_amount = total_amount + VALUES(total_amount)")
+
+def add_charge(conn, patient_id, service_id, cost):
+    sql = "INSERT INTO pending_charges (patient_id, service_id, cost) VALUES (%s, %s, %s)"
+    cursor = prepared_cursor(conn, sql)
+    cursor.execute(sql, (patient_id, service_id, cost))
+    cursor = prepared_cursor(conn, TOTALS_UPSERT)
+    cursor.execute(TOTALS_UPSERT, (patient_id, 1, cost))
+    record_change(conn, 'charge', patient_id, 'insert', {'service_id': service_id, 'cost': cost})
+
+def add_charges(conn, charges):
+    # Bulk form of add_charge for (patient_id, service_id, cost) tuples
+    if not charges:
+        return
+    totals = {}
+    for patient_id, _, cost in charges:
+        count, amount = totals.get(int(patient_id), (0, Decimal('0')))
+        totals[int(patient_id)] = (count + 1, amount + Decimal(str(cost)))
+    cursor = conn.cursor()
+    try:
+        cursor.executemany("INSERT INTO pending_charges (patient_id, service_id, cost) VALUES (%s, %s, %s)", charges)
+        # Totals rows in key order, so two imports touching the same patients can't deadlock
+        cursor.executemany(TOTALS_UPSERT, [(patient_id, count, amount) for patient_id, (count, amount) in sorted(totals.items())])
+    finally:
+        cursor.close()
+    record_changes(conn, [('charge', patient_id, 'insert', {'service_id': service_id, 'cost': cost})
+                          for patient_id, service_id, cost in charges])
+
+def take_charges(conn, patient_id):
+    # The patient's pending charges, oldest first, as (charge_id, service_id, service_name, cost);
+    # the rows stay locked until the caller commits or rolls back
+    sql = ("SELECT c.charge_id, c.service_id, s.service_name, c.cost FROM pending_charges c "
+           "JOIN services s ON s.service_id = c.service_id "
+           "WHERE c.patient_id = %s ORDER BY c.charge_id FOR UPDATE")
+    cursor = prepared_cursor(conn, sql)
+    cursor.execute(sql, (patient_id,))
+    return cursor.fetchall()
+
+def remove_charges(conn, patient_id, charges):
+    # Deletes charges returned by take_charges (once billed) and takes them off the patient's total
+    if not charges:
+        return
+    sql = "DELETE FROM pending_charges WHERE patient_id = %s AND charge_id <= %s"
+    cursor = prepared_cursor(conn, sql)
+    cursor.execute(sql, (patient_id, charges[-1][0]))
+    sql = ("UPDATE pending_charge_totals SET charge_count = charge_count - %s, total_amount = total_amount - %s "
+           "WHERE patient_id = %s")
+    cursor = prepared_cursor(conn, sql)
+    cursor.execute(sql, (len(charges), sum(Decimal(str(row[3])) for row in charges), patient_id))
+    sql = "DELETE FROM pending_charge_totals WHERE patient_id = %s AND charge_count <= 0"
+    cursor = prepared_cursor(conn, sql)
+    cursor.execute(sql, (patient_id,))
+    record_change(conn, 'charge', patient_id, 'delete', {'count': len(charges), 'up_to': charges[-1][0]})
+
+def clear_charges(conn, patient_id):
+    sql = "DELETE FROM pending_charges WHERE patient_id = %s"
+    cursor = prepared_cursor(conn, sql)
+    cursor.execute(sql, (patient_id,))
+    count = cursor.rowcount
+    sql = "DELETE FROM pending_charge_totals WHERE patient_id = %s"
+    cursor = prepared_cursor(conn, sql)
+    cursor.execute(sql, (patient_id,))
+    if count:
+        record_change(conn, 'charge', patient_id, 'delete', {'count': count})
+    return count
+
+def pending_total(conn, patient_id):
+    # One primary-key read instead of summing the ledger
+    sql = "SELECT total_amount FROM pending_charge_totals WHERE patient_id = %s"
+    cursor = prepared_cursor(conn, sql)
+    cursor.execute(sql, (patient_id,))
+    row = cursor.fetchone()
+    return Decimal(str(row[0])) if row else Decimal('0')
@@ -0,0 +1,105 @@
+import os
+
+from db_config import get_connection, live_patient
+from archive import with_archive
+from mysql.connector import Error
+
+# Rows pulled from the server per fetch; memory stays bounded by one row group
+EXPORT_FETCH_ROWS = int(os.environ.get('HOSPITAL_EXPORT_FETCH_ROWS', '10000'))
+EXPORT_ROW_GROUP_ROWS = int(os.environ.get('HOSPITAL_EXPORT_ROW_GROUP_ROWS', '131072'))
+EXPORT_COMPRESSION = os.environ.get('HOSPITAL_EXPORT_COMPRESSION', 'zstd')
+
+# table -> (query, columns with their SQL types)
+COLUMNAR_EXPORTS = {
+    'billing': (
+        f"SELECT bill_id, patient_id, total_amount, billing_date FROM billing WHERE {live_patient()}",
+        [('bill_id', 'string'), ('patient_id', 'int32'), ('total_amount', 'decimal(10,2)'), ('billing_date', 'date')],
+    ),
+    'appointments': (
+        f"SELECT appt_id, patient_id, doctor_id, date, diagnosis, consulting_charge FROM appointments WHERE {live_patient()}",
+        [('appt_id', 'string'), ('patient_id', 'int32'), ('doctor_id', 'string'), ('date', 'date'),
+         ('diagnosis', 'string'), ('consulting_charge', 'decimal(7,2)')],
+    ),
+    'billed_services': (
+        f"SELECT id, bill_id, patient_id, service_id, service_name, cost, billed_at, voided_at FROM billed_services WHERE {live_patient()}",
+        [('id', 'int32'), ('bill_id', 'string'), ('patient_id', 'int32'), ('service_id', 'string'),
+         ('service_name', 'string'), ('cost', 'decimal(10,2)'), ('billed_at', 'timestamp'), ('voided_at', 'timestamp')],
+    ),
+}
+
+def _arrow_type(pa, sql_type):
+    if sql_type.startswith('decimal('):
+        precision, scale = sql_type[len('decimal('):-1].split(',')
+        return pa.decimal128(int(precision), int(scale))
+    return {
+        'string': pa.string(),
+        'int32': pa.int32(),
+        'date': pa.date32(),
+        'timestamp': pa.timestamp('s'),
+    }[sql_type]
+
+def _open_writer(pa, path, schema, fmt):
+    if fmt == 'parquet':
+        import pyarrow.parquet as pq
+        return pq.ParquetWriter(path, schema, compression=EXPORT_COMPRESSION)
+    options = pa.ipc.IpcWriteOptions(compression=EXPORT_COMPRESSION)
+    return pa.ipc.new_file(path, schema, options=options)
+
+def export_columnar(table, filename, fmt=None, include_archived=False):
+    # Streams `table` into a Parquet (.parquet) or Arrow IPC (.arrow/.feather) file with native types
+    try:
+        import pyarrow as pa
+    except ImportError:
+        print("Columnar export needs pyarrow. Install it with: pip install pyarrow")
+        return False
+    if table not in COLUMNAR_EXPORTS:
+        print(f"Unknown table '{table}'. Choose from: {', '.join(COLUMNAR_EXPORTS)}")
+        return False
+    fmt = fmt or ('parquet' if filename.lower().endswith('.parquet') else 'arrow')
+    if fmt not in ('parquet', 'arrow'):
+        print("Invalid format. Use 'parquet' or 'arrow'.")
+        return False
+
+    sql, columns = COLUMNAR_EXPORTS[table]
+    schema = pa.schema([(name, _arrow_type(pa, sql_type)) for name, sql_type in columns])
+    tmp_path = filename + ".tmp"
+    rows_written = 0
+    try:
+        conn = get_connection(read_only=True)
+        cursor = conn.cursor()  # unbuffered: rows are streamed from the server
+        cursor.execute(with_archive(sql, table, include_archived))
+        writer = _open_writer(pa, tmp_path, schema, fmt)
+        try:
+            pending, pending_rows = [], 0
+            while True:
+                rows = cursor.fetchmany(EXPORT_FETCH_ROWS)
+                if rows:
+                    arrays = [pa.array(values, type=field.type) for values, field in zip(zip(*rows), schema)]
+                    pending.append(pa.RecordBatch.from_arrays(arrays, schema=schema))
+                    pending_rows += len(rows)
+                if pending and (not rows or pending_rows >= EXPORT_ROW_GROUP_ROWS):
+                    if fmt == 'parquet':
+                        # One row group per flush
+                        writer.write_table(pa.Table.from_batches(pending, schema=schema), row_group_size=pending_rows)
+                    else:
+                        for batch in pending:
+                            writer.write_batch(batch)
+                    rows_written += pending_rows
+                    pending, pending_rows = [], 0
+                if not rows:
+                    break
+        finally:
+            writer.close()
+        os.replace(tmp_path, filename)
+        print(f"Exported {rows_written} {table} row(s) to {filename} ({fmt}, {EXPORT_COMPRESSION})")
+        return True
+    except Error as e:
+        print(f"Database error while exporting {table}:", e)
+        return False
+    except Exception as e:
+        print(f"Unexpected error while exporting {table}:", e)
+        return False
+    finally:
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+        if 'cursor' in locals(): cursor.close()
+        if 'conn' in locals(): conn.close()
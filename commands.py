@@ -0,0 +1,627 @@
+import argparse
+import contextlib
+import csv
+import io
+import json
+import sys
+import time
+
+from db_config import get_connection, pinned_connection, start_session
+from retry import run_transaction, retry_stats
+
+# Non-interactive front end: every command is a plain function over the entity classes, usable
+# as a subcommand (`hospital_main.py patient add --name ...`) or as a JSON Lines batch record
+# (`{"cmd": "patient.add", "args": {"name": ...}}`).
+COMMANDS = {}
+
+def command(name, *params):
+    # Parameters prefixed with '?' are optional
+    def register(fn):
+        COMMANDS[name] = (fn, params)
+        return fn
+    return register
+
+def _flag(value):
+    return str(value).strip().lower() in ('1', 'true', 'yes', 'y')
+
+def _read_feed(filename):
+    # CSV with a header row, or JSON Lines; each record is a dict of column -> value
+    with open(filename, newline='', encoding='utf-8') as f:
+        if filename.lower().endswith(('.jsonl', '.json')):
+            return [json.loads(line) for line in f if line.strip()]
+        return list(csv.DictReader(f))
+
+def _update(entity):
+    # With a version the update is a compare-and-set; a lost race comes back as a conflict
+    result = {'ok': entity.update(), 'version': entity.version}
+    if entity.conflict:
+        result.update(conflict=True, current_version=entity.current_version)
+    return result
+
+# --- Patient ---
+@command('patient.add', 'name', 'age', 'gender', 'admission_date', 'contact_no', '?patient_id')
+def patient_add(name, age, gender, admission_date, contact_no, patient_id=None):
+    from patient import Patient, generate_next_patient_id
+    patient_id = patient_id or generate_next_patient_id()
+    return {'ok': Patient(patient_id, name, age, gender, admission_date, contact_no).add(), 'patient_id': patient_id}
+
+@command('patient.update', 'patient_id', 'name', 'age', 'gender', 'admission_date', 'contact_no', '?version')
+def patient_update(patient_id, name, age, gender, admission_date, contact_no, version=None):
+    from patient import Patient
+    return _update(Patient(patient_id, name, age, gender, admission_date, contact_no, version))
+
+@command('patient.get', 'patient_id')
+def patient_get(patient_id):
+    from patient import Patient
+    patient = Patient.get(patient_id)
+    if not patient:
+        return {'ok': False}
+    return {'ok': True, 'patient': {'patient_id': patient.patient_id, 'name': patient.name, 'age': patient.age,
+                                    'gender': patient.gender, 'admission_date': patient.admission_date,
+                                    'contact_no': patient.contact_no, 'version': patient.version}}
+
+@command('patient.sync', 'file', '?chunk_size')
+def patient_sync(file, chunk_size=None):
+    from patient import Patient
+    from bulk import BULK_CHUNK_SIZE
+    counts = Patient.bulk_upsert(_read_feed(file), int(chunk_size or BULK_CHUNK_SIZE))
+    return {'ok': counts['failed'] == 0, **counts}
+
+@command('patient.duplicates', 'patient_id', '?recheck')
+def patient_duplicates(patient_id, recheck=None):
+    # Open pairs from the last dedup run; --recheck compares the patient again first
+    import dedup
+    from mysql.connector import Error
+    if _flag(recheck):
+        try:
+            dedup.check_patients([patient_id])
+        except Error as e:
+            print("Database error while checking for duplicate patients:", e)
+            return {'ok': False}
+    pairs = dedup.stored_duplicates(patient_id)
+    return {'ok': True, 'pairs': pairs}
+
+@command('patient.delete', 'patient_id')
+def patient_delete(patient_id):
+    from patient import Patient
+    return {'ok': Patient.delete(patient_id)}
+
+@command('patient.view')
+def patient_view():
+    from patient import Patient
+    Patient.view()
+    return {'ok': True}
+
+@command('patient.search', 'name')
+def patient_search(name):
+    from patient import Patient
+    Patient.search_by_name(name)
+    return {'ok': True}
+
+@command('patient.history', 'patient_id', '?include_archived')
+def patient_history(patient_id, include_archived='no'):
+    from history import patient_history
+    return {'ok': True, 'events': list(patient_history(patient_id, _flag(include_archived)))}
+
+# --- Doctor ---
+@command('doctor.add', 'name', 'specialization', 'contact_no', '?doctor_id')
+def doctor_add(name, specialization, contact_no, doctor_id=None):
+    from doctor import Doctor, generate_next_doctor_id
+    doctor_id = doctor_id or generate_next_doctor_id()
+    return {'ok': Doctor(doctor_id, name, specialization, contact_no).add(), 'doctor_id': doctor_id}
+
+@command('doctor.update', 'doctor_id', 'name', 'specialization', 'contact_no', '?version')
+def doctor_update(doctor_id, name, specialization, contact_no, version=None):
+    from doctor import Doctor
+    return _update(Doctor(doctor_id, name, specialization, contact_no, version))
+
+@command('doctor.get', 'doctor_id')
+def doctor_get(doctor_id):
+    from doctor import Doctor
+    doctor = Doctor.get(doctor_id)
+    if not doctor:
+        return {'ok': False}
+    return {'ok': True, 'doctor': {'doctor_id': doctor.doctor_id, 'name': doctor.name, 'specialization': doctor.specialization,
+                                   'contact_no': doctor.contact_no, 'version': doctor.version}}
+
+@command('doctor.sync', 'file', '?chunk_size')
+def doctor_sync(file, chunk_size=None):
+    from doctor import Doctor
+    from bulk import BULK_CHUNK_SIZE
+    counts = Doctor.bulk_upsert(_read_feed(file), int(chunk_size or BULK_CHUNK_SIZE))
+    return {'ok': counts['failed'] == 0, **counts}
+
+@command('doctor.least_loaded', 'specialization', 'date')
+def doctor_least_loaded(specialization, date):
+    from assignment import load_index
+    doctor_id = load_index.least_loaded(specialization, date)
+    if doctor_id is None:
+        print(f"No doctor found with specialization '{specialization}'.")
+        return {'ok': False}
+    return {'ok': True, 'doctor_id': doctor_id, 'appointments': load_index.load(doctor_id, date)}
+
+@command('doctor.delete', 'doctor_id')
+def doctor_delete(doctor_id):
+    from doctor import Doctor
+    return {'ok': Doctor.delete(doctor_id)}
+
+@command('doctor.view')
+def doctor_view():
+    from doctor import Doctor
+    Doctor.view()
+    return {'ok': True}
+
+# --- Service ---
+@command('service.add', 'service_name', 'cost', '?service_id')
+def service_add(service_name, cost, service_id=None):
+    from service import Service, generate_next_service_id
+    service_id = service_id or generate_next_service_id()
+    return {'ok': Service(service_id, service_name, cost).add(), 'service_id': service_id}
+
+@command('service.update', 'service_id', 'service_name', 'cost', '?version')
+def service_update(service_id, service_name, cost, version=None):
+    from service import Service
+    return _update(Service(service_id, service_name, cost, version))
+
+@command('service.get', 'service_id')
+def service_get(service_id):
+    from service import Service
+    service = Service.get(service_id)
+    if not service:
+        return {'ok': False}
+    return {'ok': True, 'service': {'service_id': service.service_id, 'service_name': service.service_name,
+                                    'cost': str(service.cost), 'version': service.version}}
+
+@command('service.sync', 'file', '?chunk_size')
+def service_sync(file, chunk_size=None):
+    from service import Service
+    from bulk import BULK_CHUNK_SIZE
+    counts = Service.bulk_upsert(_read_feed(file), int(chunk_size or BULK_CHUNK_SIZE))
+    return {'ok': counts['failed'] == 0, **counts}
+
+@command('service.delete', 'service_id')
+def service_delete(service_id):
+    from service import Service
+    return {'ok': Service.delete(service_id)}
+
+@command('service.view')
+def service_view():
+    from service import Service
+    Service.view()
+    return {'ok': True}
+
+# --- Service usage ---
+@command('usage.add', 'patient_id', 'service_id')
+def usage_add(patient_id, service_id):
+    from service import Service, ServiceUsageDB
+    service = Service.get(service_id)
+    if not service:
+        print("Service ID not found.")
+        return {'ok': False}
+    ServiceUsageDB.add_service_for_patient(patient_id, service)
+    return {'ok': True}
+
+@command('usage.import', 'file', '?chunk_size')
+def usage_import(file, chunk_size=None):
+    from service import ServiceUsageDB
+    from bulk import BULK_CHUNK_SIZE
+    counts = ServiceUsageDB.bulk_add(_read_feed(file), int(chunk_size or BULK_CHUNK_SIZE))
+    return {'ok': counts['failed'] == 0, **counts}
+
+@command('usage.list', 'patient_id')
+def usage_list(patient_id):
+    from service import ServiceUsageDB
+    rows = ServiceUsageDB.get_services_for_patient(patient_id)
+    return {'ok': True, 'services': [[r[0], r[1], str(r[2])] for r in rows]}
+
+@command('usage.clear', 'patient_id')
+def usage_clear(patient_id):
+    from service import ServiceUsageDB
+    ServiceUsageDB.clear_services_for_patient(patient_id)
+    return {'ok': True}
+
+# --- Appointment ---
+@command('appointment.add', 'patient_id', 'date', 'diagnosis', '?doctor_id', '?specialization', '?appt_id')
+def appointment_add(patient_id, date, diagnosis, doctor_id=None, specialization=None, appt_id=None):
+    # Without a doctor_id the least-loaded doctor with the given specialization is assigned
+    from appointment import Appointment, generate_next_appointment_id
+    if not doctor_id:
+        if not specialization:
+            print("Give either doctor_id or specialization.")
+            return {'ok': False}
+        from assignment import least_loaded_doctor
+        doctor_id = least_loaded_doctor(specialization, date)
+        if doctor_id is None:
+            print(f"No doctor found with specialization '{specialization}'.")
+            return {'ok': False}
+    appt_id = appt_id or generate_next_appointment_id()
+    return {'ok': Appointment(appt_id, patient_id, doctor_id, date, diagnosis).add(), 'appt_id': appt_id, 'doctor_id': doctor_id}
+
+@command('appointment.update', 'appt_id', 'patient_id', 'doctor_id', 'date', 'diagnosis', '?version')
+def appointment_update(appt_id, patient_id, doctor_id, date, diagnosis, version=None):
+    from appointment import Appointment
+    return _update(Appointment(appt_id, patient_id, doctor_id, date, diagnosis, version))
+
+@command('appointment.sync', 'file', '?chunk_size')
+def appointment_sync(file, chunk_size=None):
+    from appointment import Appointment
+    from bulk import BULK_CHUNK_SIZE
+    counts = Appointment.bulk_upsert(_read_feed(file), int(chunk_size or BULK_CHUNK_SIZE))
+    return {'ok': counts['failed'] == 0, **counts}
+
+@command('appointment.get', 'appt_id')
+def appointment_get(appt_id):
+    from appointment import Appointment
+    appt = Appointment.get(appt_id)
+    if not appt:
+        return {'ok': False}
+    return {'ok': True, 'appointment': {'appt_id': appt.appt_id, 'patient_id': appt.patient_id, 'doctor_id': appt.doctor_id,
+                                        'date': appt.date, 'diagnosis': appt.diagnosis, 'version': appt.version}}
+
+@command('appointment.delete', 'appt_id')
+def appointment_delete(appt_id):
+    from appointment import Appointment
+    return {'ok': Appointment.delete(appt_id)}
+
+@command('appointment.view')
+def appointment_view():
+    from appointment import Appointment
+    Appointment.view()
+    return {'ok': True}
+
+# --- Billing ---
+@command('bill.add', 'patient_id', '?billing_date', '?bill_id')
+def bill_add(patient_id, billing_date=None, bill_id=None):
+    from billing import Bill, generate_next_bill_id
+    bill_id = bill_id or generate_next_bill_id()
+    return {'ok': Bill(bill_id, patient_id, billing_date).add(), 'bill_id': bill_id}
+
+@command('bill.update', 'bill_id', 'patient_id', '?billing_date', '?version')
+def bill_update(bill_id, patient_id, billing_date=None, version=None):
+    from billing import Bill
+    return _update(Bill(bill_id, patient_id, billing_date, version))
+
+@command('bill.get', 'bill_id')
+def bill_get(bill_id):
+    from billing import Bill
+    bill = Bill.get(bill_id)
+    if not bill:
+        return {'ok': False}
+    return {'ok': True, 'bill': {'bill_id': bill.bill_id, 'patient_id': bill.patient_id,
+                                 'billing_date': bill.billing_date, 'version': bill.version}}
+
+@command('bill.add_line', 'bill_id', 'service_id', '?cost', '?reason')
+def bill_add_line(bill_id, service_id, cost=None, reason=None):
+    from billing import Bill
+    return {'ok': Bill.add_line_item(bill_id, service_id, cost, reason)}
+
+@command('bill.void_line', 'bill_id', 'line_id', '?reason')
+def bill_void_line(bill_id, line_id, reason=None):
+    from billing import Bill
+    return {'ok': Bill.void_line_item(bill_id, line_id, reason)}
+
+@command('bill.lines', 'bill_id')
+def bill_lines(bill_id):
+    from billing import Bill
+    Bill.line_items(bill_id)
+    return {'ok': True}
+
+@command('bill.adjustments', 'bill_id')
+def bill_adjustments(bill_id):
+    from billing import Bill
+    Bill.adjustments(bill_id)
+    return {'ok': True}
+
+@command('bill.delete', 'bill_id')
+def bill_delete(bill_id):
+    from billing import Bill
+    return {'ok': Bill.delete(bill_id)}
+
+@command('bill.view')
+def bill_view():
+    from billing import Bill
+    Bill.view()
+    return {'ok': True}
+
+@command('bill.total', 'patient_id', '?include_archived')
+def bill_total(patient_id, include_archived='no'):
+    from billing import compute_total_billing
+    total = compute_total_billing(patient_id, _flag(include_archived))
+    return {'ok': total is not None, 'total': None if total is None else str(total)}
+
+@command('bill.run', '?billing_date', '?workers')
+def bill_run(billing_date=None, workers=None):
+    # Bills every patient with pending usage; resumes an interrupted run first
+    from billing_run import run_billing, BILLING_RUN_WORKERS
+    result = run_billing(billing_date, int(workers) if workers else BILLING_RUN_WORKERS)
+    if result is None:
+        return {'ok': False}
+    return {'ok': result['status'] == 'done' and not result['failed'], **result}
+
+@command('bill.invoice', 'bill_id')
+def bill_invoice(bill_id):
+    from billing import Bill
+    bill = Bill.get(bill_id)
+    if not bill:
+        print("Bill not found.")
+        return {'ok': False}
+    bill.generate_invoice()
+    return {'ok': True}
+
+# --- Export ---
+@command('export.billing', '?filename', '?include_archived')
+def export_billing(filename="billing_summary.csv", include_archived='no'):
+    from billing import Bill
+    Bill.export_billing_summary_to_csv(filename, _flag(include_archived))
+    return {'ok': True}
+
+@command('export.appointments', '?filename', '?include_archived')
+def export_appointments(filename="appointment_summary.csv", include_archived='no'):
+    from appointment import Appointment
+    Appointment.export_appointment_summary_to_csv(filename, _flag(include_archived))
+    return {'ok': True}
+
+@command('export.columnar', 'table', 'filename', '?format', '?include_archived')
+def export_columnar(table, filename, format=None, include_archived='no'):
+    from columnar_export import export_columnar
+    return {'ok': export_columnar(table, filename, format, _flag(include_archived))}
+
+# --- Reports ---
+@command('report.run', 'name', '?start', '?end', '?workers', '?shard_by', '?include_archived', '?processes')
+def report_run(name, start=None, end=None, workers=None, shard_by='date', include_archived='no', processes='no'):
+    import datetime
+    from reports import REPORTS, REPORT_WORKERS, run_report
+    if name not in REPORTS:
+        print(f"Unknown report '{name}'. Choose from: {', '.join(REPORTS)}")
+        return {'ok': False}
+    rows = run_report(name, start=datetime.date.fromisoformat(start) if start else None,
+                      end=datetime.date.fromisoformat(end) if end else None,
+                      workers=int(workers) if workers else REPORT_WORKERS, shard_by=shard_by,
+                      include_archived=_flag(include_archived), use_processes=_flag(processes))
+    return {'ok': True, 'columns': REPORTS[name]['columns'], 'rows': rows}
+
+@command('analytics.query', 'name', '?start', '?end')
+def analytics_query(name, start=None, end=None):
+    # Served from the in-memory cache; in batch mode it is loaded once for the whole stream
+    import datetime
+    from analytics import ANALYTICS_QUERIES, run_query
+    if name not in ANALYTICS_QUERIES:
+        print(f"Unknown analytics query '{name}'. Choose from: {', '.join(ANALYTICS_QUERIES)}")
+        return {'ok': False}
+    rows = run_query(name, datetime.date.fromisoformat(start) if start else None,
+                     datetime.date.fromisoformat(end) if end else None)
+    if rows is None:
+        return {'ok': False}
+    return {'ok': True, 'columns': ANALYTICS_QUERIES[name]['columns'], 'rows': rows}
+
+@command('analytics.rollup', 'table', '?by', '?measure', '?freq', '?start', '?end')
+def analytics_rollup(table, by=None, measure='count', freq=None, start=None, end=None):
+    # Ad-hoc group-by: --by is a comma-separated list of columns, --measure 'count' or a money column
+    from analytics import ANALYTICS_TABLES, get_cache
+    if table not in ANALYTICS_TABLES:
+        print(f"Unknown table '{table}'. Choose from: {', '.join(ANALYTICS_TABLES)}")
+        return {'ok': False}
+    cache = get_cache()
+    if cache is None:
+        return {'ok': False}
+    try:
+        with cache.lock:
+            rows = cache.rollup(table, tuple(c.strip() for c in by.split(',')) if by else (), measure, freq, start, end)
+    except (KeyError, ValueError) as e:
+        print("Invalid rollup:", e)
+        return {'ok': False}
+    return {'ok': True, 'rows': rows}
+
+# --- Stored procedures ---
+@command('procedures.install')
+def procedures_install():
+    from stored_procs import install_procedures
+    return {'ok': install_procedures()}
+
+@command('procedures.benchmark', '?bills', '?services')
+def procedures_benchmark(bills=None, services=None):
+    # Bill.add, Bill.update and compute_total_billing in client mode vs procedure mode
+    from stored_procs import benchmark
+    results = benchmark(int(bills or 50), int(services or 5))
+    return {'ok': results is not None}
+
+# --- Read-only snapshot ---
+@command('snapshot.export', '?path')
+def snapshot_export(path=None):
+    from snapshot import SNAPSHOT_PATH, export_snapshot
+    return {'ok': True, 'counts': export_snapshot(path or SNAPSHOT_PATH)}
+
+@command('snapshot.lookup', 'table', 'value', '?field', '?prefix', '?path')
+def snapshot_lookup(table, value, field=None, prefix=None, path=None):
+    # Served from the snapshot file, no database connection: by primary key, or with --field
+    # by an indexed column (--prefix for starts-with matches)
+    from snapshot import SNAPSHOT_PATH, SNAPSHOT_TABLES, open_snapshot
+    if table not in SNAPSHOT_TABLES:
+        print(f"Unknown table '{table}'. Choose from: {', '.join(SNAPSHOT_TABLES)}")
+        return {'ok': False}
+    snapshot = open_snapshot(path or SNAPSHOT_PATH)
+    if snapshot is None:
+        return {'ok': False}
+    if field is None:
+        try:
+            record = snapshot.get(table, value)
+        except ValueError:
+            print(f"Invalid key for {table}: {value}")
+            return {'ok': False}
+        return {'ok': record is not None, 'matches': [record] if record else []}
+    try:
+        matches = snapshot.find(table, field, value, prefix=_flag(prefix))
+    except ValueError as e:
+        print(e)
+        return {'ok': False}
+    return {'ok': bool(matches), 'matches': matches}
+
+# --- Caller identification ---
+@command('contact.lookup', 'number', '?last_digits')
+def contact_lookup(number, last_digits=None):
+    # Exact match, falling back to the trailing digits; --last-digits N matches only the last N
+    import contacts
+    if last_digits:
+        matches = contacts.find_by_last_digits(number, int(last_digits))
+    else:
+        matches = contacts.identify_caller(number)
+    return {'ok': bool(matches), 'matches': matches}
+
+# --- Duplicate patients ---
+@command('dedup.run', '?full')
+def dedup_run(full=None):
+    # Incremental pass over patients changed since the last run; --full rescans everyone
+    import dedup
+    if _flag(full):
+        pairs = dedup.find_all_duplicates()
+        return {'ok': pairs is not None, 'pairs': pairs}
+    return {'ok': True, **dedup.run_incremental()}
+
+# --- Archive ---
+@command('archive.run', '?retention_days')
+def archive_run(retention_days=None):
+    from archive import archive_old_records, ARCHIVE_RETENTION_DAYS
+    result = archive_old_records(int(retention_days) if retention_days else ARCHIVE_RETENTION_DAYS)
+    return {'ok': True, 'appointments': result['appointments'], 'bills': result['bills']}
+
+@command('purge.run', '?batch_size')
+def purge_run(batch_size=None):
+    # One pass; run purge.py on its own for the continuous background worker
+    from purge import purge_deleted, PURGE_BATCH_SIZE
+    return {'ok': True, **purge_deleted(int(batch_size) if batch_size else PURGE_BATCH_SIZE)}
+
+def run_command(name, args):
+    if name not in COMMANDS:
+        print(f"Unknown command '{name}'.")
+        return {'ok': False}
+    fn, params = COMMANDS[name]
+    known = {p.lstrip('?') for p in params}
+    unknown = set(args) - known
+    if unknown:
+        print(f"Unknown argument(s) for {name}: {', '.join(sorted(unknown))}")
+        return {'ok': False}
+    missing = [p for p in params if not p.startswith('?') and args.get(p) is None]
+    if missing:
+        print(f"Missing argument(s) for {name}: {', '.join(missing)}")
+        return {'ok': False}
+    # Same types the interactive menus pass: everything arrives as text
+    return fn(**{k: str(v) for k, v in args.items() if v is not None})
+
+# --- Batch mode ---
+def run_batch(stream, out, group_size=0):
+    # One process, one connection. group_size > 0 commits every N commands as one transaction;
+    # a command that raises rolls its whole group back.
+    processed = failed = 0
+    start = time.perf_counter()
+    start_session(read_your_writes=True)
+    with pinned_connection():
+        group = []
+        for line_no, line in enumerate(stream, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            group.append((line_no, line))
+            if len(group) >= max(group_size, 1):
+                failed += _run_group(group, out, group_size > 0)
+                processed += len(group)
+                group = []
+        if group:
+            failed += _run_group(group, out, group_size > 0)
+            processed += len(group)
+    elapsed = time.perf_counter() - start
+    rate = processed / elapsed if elapsed else 0.0
+    retries = retry_stats()
+    print(f"Processed {processed} command(s), {failed} failed, in {elapsed:.2f}s ({rate:,.0f} ops/s), "
+          f"{retries['retries']} retries, {retries['gave_up']} gave up", file=sys.stderr)
+    return failed == 0
+
+def _drop_caches(error=None):
+    # A replayed group may have updated in-process caches from writes that were rolled back
+    import history
+    from assignment import load_index
+    history.invalidate()
+    load_index.invalidate()
+
+def _run_group(group, out, grouped):
+    # A group that hits a deadlock or a dropped connection is rolled back and replayed whole;
+    # ungrouped commands are retried one entity call at a time
+    results = []
+    def run_lines():
+        results.clear()
+        for line_no, line in group:
+            results.append(_run_line(line_no, line))
+            if grouped and 'exception' in results[-1]:
+                raise RuntimeError(results[-1]['exception'])
+            if not grouped:
+                # A command that failed part-way must not leave writes or locks for the next one
+                get_connection().discard_uncommitted()
+    try:
+        if grouped:
+            # Retry notes go to stderr with the summary, not into the JSON results
+            with contextlib.redirect_stdout(sys.stderr):
+                run_transaction(run_lines, on_retry=_drop_caches)
+        else:
+            run_lines()
+    except RuntimeError:
+        for result in results:
+            result['ok'] = False
+            result['rolled_back'] = True
+    for result in results:
+        out.write(json.dumps(result, default=str) + "\n")
+    out.flush()
+    return sum(1 for r in results if not r['ok'])
+
+def _run_line(line_no, line):
+    captured = io.StringIO()
+    try:
+        record = json.loads(line)
+        name = record['cmd']
+        args = record.get('args', {})
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        result = {'ok': False, 'exception': f"Invalid command record: {e}"}
+        return dict(result, line=line_no, cmd=None, output=[])
+    try:
+        with contextlib.redirect_stdout(captured):
+            result = run_command(name, args)
+    except Exception as e:
+        result = {'ok': False, 'exception': str(e)}
+    result = dict(result, line=line_no, cmd=name, output=captured.getvalue().splitlines())
+    result['ok'] = bool(result['ok'])
+    return result
+
+# --- Argument parsing ---
+def build_parser():
+    parser = argparse.ArgumentParser(prog='hospital_main.py', description="Hospital Management CLI. Run without arguments for the interactive menu.")
+    subparsers = parser.add_subparsers(dest='entity', required=True)
+    by_entity = {}
+    for name, (_, params) in COMMANDS.items():
+        entity, action = name.split('.')
+        if entity not in by_entity:
+            by_entity[entity] = subparsers.add_parser(entity).add_subparsers(dest='action', required=True)
+        action_parser = by_entity[entity].add_parser(action)
+        for param in params:
+            option = '--' + param.lstrip('?').replace('_', '-')
+            action_parser.add_argument(option, required=not param.startswith('?'))
+
+    batch = subparsers.add_parser('batch', help="Run JSON Lines commands from a file or stdin")
+    batch.add_argument('file', nargs='?', default='-', help="Input file, '-' for stdin")
+    batch.add_argument('--group-size', type=int, default=0, help="Commit every N commands as one transaction")
+    batch.add_argument('--output', default='-', help="Where to write JSON results, '-' for stdout")
+    return parser
+
+def main(argv):
+    args = build_parser().parse_args(argv)
+    if args.entity == 'batch':
+        stream = sys.stdin if args.file == '-' else open(args.file, encoding='utf-8')
+        out = sys.stdout if args.output == '-' else open(args.output, 'w', encoding='utf-8')
+        try:
+            return 0 if run_batch(stream, out, args.group_size) else 1
+        finally:
+            if stream is not sys.stdin: stream.close()
+            if out is not sys.stdout: out.close()
+    values = {k: v for k, v in vars(args).items() if k not in ('entity', 'action')}
+    result = run_command(f"{args.entity}.{args.action}", values)
+    extra = {k: v for k, v in result.items() if k != 'ok'}
+    if extra:
+        print(json.dumps(extra, default=str))
+    return 0 if result['ok'] else 1
@@ -0,0 +1,130 @@
+import os
+import re
+import sys
+
+# No driver import here: snapshot readers use normalize_contact without a database
+from db_config import driver, get_connection, prepared_cursor
+
+# Trailing digits compared when an incoming number doesn't match exactly (e.g. it carries a
+# country code the stored number doesn't); fewer than the minimum would match too many rows
+CALLER_ID_DIGITS = int(os.environ.get('HOSPITAL_CALLER_ID_DIGITS', '10'))
+MIN_LAST_DIGITS = 4
+# Digits in a number dialled without country code or trunk prefix
+NATIONAL_DIGITS = int(os.environ.get('HOSPITAL_NATIONAL_DIGITS', '10'))
+# contact_no is a VARCHAR(15), the longest number E.164 allows
+MAX_CONTACT_DIGITS = 15
+
+def normalize_contact(value):
+    # Digits only. An international '00' prefix is dropped, and so is a single trunk '0' on a
+    # number longer than a national one; any other leading zero is part of the number:
+    # "+91 98765-43210" -> "919876543210", "09876543210" -> "9876543210", "0987654321" stays.
+    digits = re.sub(r'\D', '', str(value or ''))
+    if digits.startswith('00') and len(digits) - 2 > NATIONAL_DIGITS:
+        return digits[2:]
+    if digits.startswith('0') and len(digits) > NATIONAL_DIGITS:
+        return digits[1:]
+    return digits
+
+def index_contact(conn, entity, key, name, contact_no):
+    # Keeps contact_index in step with a patient/doctor write; runs in the writer's transaction
+    sql = ("INSERT INTO contact_index (entity, entity_key, name, contact_no, contact_rev) VALUES (%s, %s, %s, %s, %s) "
+           "ON DUPLICATE KEY UPDATE name = VALUES(name), contact_no = VALUES(contact_no), contact_rev = VALUES(contact_rev)")
+    cursor = prepared_cursor(conn, sql)
+    contact_no = normalize_contact(contact_no)
+    cursor.execute(sql, (entity, str(key), name, contact_no, contact_no[::-1]))
+
+def index_contacts(conn, entity, rows):
+    # Bulk form of index_contact for (key, name, contact_no) tuples
+    if not rows:
+        return
+    cursor = conn.cursor()
+    try:
+        cursor.executemany(
+            "INSERT INTO contact_index (entity, entity_key, name, contact_no, contact_rev) VALUES (%s, %s, %s, %s, %s) "
+            "ON DUPLICATE KEY UPDATE name = VALUES(name), contact_no = VALUES(contact_no), contact_rev = VALUES(contact_rev)",
+            [(entity, str(key), name, normalize_contact(contact_no), normalize_contact(contact_no)[::-1])
+             for key, name, contact_no in rows])
+    finally:
+        cursor.close()
+
+def unindex_contact(conn, entity, key):
+    sql = "DELETE FROM contact_index WHERE entity=%s AND entity_key=%s"
+    cursor = prepared_cursor(conn, sql)
+    cursor.execute(sql, (entity, str(key)))
+
+def _lookup(sql, value):
+    try:
+        conn = get_connection(read_only=True)
+        cursor = prepared_cursor(conn, sql)
+        cursor.execute(sql, (value,))
+        return [{'entity': entity, 'key': key, 'name': name, 'contact_no': contact_no}
+                for entity, key, name, contact_no in cursor.fetchall()]
+    except driver().Error as e:
+        print("Database error while looking up contact number:", e)
+        return []
+    finally:
+        if 'conn' in locals(): conn.close()
+
+def find_by_contact(number):
+    # Exact match on the normalized number; one index probe
+    sql = "SELECT entity, entity_key, name, contact_no FROM contact_index WHERE contact_no = %s"
+    return _lookup(sql, normalize_contact(number))
+
+def find_by_last_digits(number, digits=CALLER_ID_DIGITS):
+    # Matches on the last `digits` digits. The digits are stored reversed, so this is a
+    # prefix range scan on an index rather than a LIKE '%...' over every row.
+    tail = normalize_contact(number)[-digits:]
+    if len(tail) < MIN_LAST_DIGITS:
+        print(f"Give at least {MIN_LAST_DIGITS} digits.")
+        return []
+    sql = "SELECT entity, entity_key, name, contact_no FROM contact_index WHERE contact_rev LIKE %s"
+    return _lookup(sql, tail[::-1] + '%')
+
+def identify_caller(number):
+    # Exact match first, then the trailing digits
+    return find_by_contact(number) or find_by_last_digits(number)
+
+def backfill(batch_size=1000):
+    # Rewrites stored patient and doctor numbers with normalize_contact and fills contact_index,
+    # a batch per transaction; run once after the schema migration
+    total = 0
+    for entity, table, key_column in (('patient', 'patients', 'patient_id'), ('doctor', 'doctors', 'doctor_id')):
+        conn = get_connection()
+        cursor = conn.cursor()
+        try:
+            after = None
+            while True:
+                where = f"WHERE {key_column} > %s " if after is not None else ""
+                cursor.execute(f"SELECT {key_column}, name, contact_no, deleted_at FROM {table} {where}"
+                               f"ORDER BY {key_column} LIMIT %s FOR UPDATE",
+                               (after, batch_size) if after is not None else (batch_size,))
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+                live = []
+                for key, name, contact_no, deleted_at in rows:
+                    if contact_no is None:
+                        continue
+                    digits = normalize_contact(contact_no)
+                    if digits != contact_no:
+                        try:
+                            cursor.execute(f"UPDATE {table} SET contact_no = %s WHERE {key_column} = %s", (digits, key))
+                            total += 1
+                        except driver().IntegrityError as e:
+                            # Two doctors whose numbers only differed in formatting
+                            print(f"Skipped {table} row '{key}':", e)
+                            continue
+                    if deleted_at is None:
+                        live.append((key, name, digits))
+                index_contacts(conn, entity, live)
+                conn.commit()
+                after = rows[-1][0]
+        finally:
+            cursor.close()
+            conn.close()
+    print(f"Normalized {total} stored contact number(s).")
+    return total
+
+if __name__ == "__main__":
+    if '--backfill' in sys.argv[1:]:
+        backfill()
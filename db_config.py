@@ -1,22 +1,375 @@
-import mysql.connector
-from mysql.connector import Error
+import itertools
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 
-def get_connection():
-    return mysql.connector.connect(
-        host='localhost',
-        user='root',
-        password='root@39',
-        database='HospitalManagement',
-    )
+# Primary (read-write) endpoint
+DB_CONFIG = {
+    'host': os.environ.get('HOSPITAL_DB_HOST', 'localhost'),
+    'port': int(os.environ.get('HOSPITAL_DB_PORT', '3306')),
+    'user': os.environ.get('HOSPITAL_DB_USER', 'root'),
+    'password': os.environ.get('HOSPITAL_DB_PASSWORD', 'root@39'),
+    'database': os.environ.get('HOSPITAL_DB_NAME', 'HospitalManagement'),
+}
+
+# Connections kept open per endpoint; callers beyond this get a plain connection
+POOL_SIZE = int(os.environ.get('HOSPITAL_DB_POOL_SIZE', '5'))
+
+# Prepared statements kept per connection (server limit is max_prepared_stmt_count overall)
+STATEMENT_CACHE_SIZE = int(os.environ.get('HOSPITAL_DB_STMT_CACHE_SIZE', '64'))
+
+# Seconds after a write during which a read-your-writes session keeps reading from the primary
+READ_YOUR_WRITES_WINDOW = float(os.environ.get('HOSPITAL_DB_RYW_WINDOW', '5'))
+
+def _parse_replicas(spec):
+    # "host:port,host:port" -> list of connection configs sharing the primary's credentials
+    replicas = []
+    for entry in spec.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        host, _, port = entry.partition(':')
+        replica = dict(DB_CONFIG, host=host or DB_CONFIG['host'])
+        if port:
+            replica['port'] = int(port)
+        replicas.append(replica)
+    return replicas
+
+# Read-only endpoints; empty means every query goes to the primary
+REPLICA_CONFIGS = _parse_replicas(os.environ.get('HOSPITAL_DB_REPLICAS', ''))
+
+_replica_lock = threading.Lock()
+_replica_cycle = itertools.cycle(REPLICA_CONFIGS) if REPLICA_CONFIGS else None
+
+def _next_replica():
+    with _replica_lock:
+        return next(_replica_cycle)
+
+class Session:
+    def __init__(self, read_your_writes=True):
+        self.read_your_writes = read_your_writes
+        self.last_write_at = None
+
+    def mark_write(self):
+        self.last_write_at = time.monotonic()
+
+    def reads_from_primary(self):
+        if not self.read_your_writes or self.last_write_at is None:
+            return False
+        return time.monotonic() - self.last_write_at < READ_YOUR_WRITES_WINDOW
+
+_local = threading.local()
+
+def current_session():
+    session = getattr(_local, 'session', None)
+    if session is None:
+        session = Session(read_your_writes=os.environ.get('HOSPITAL_DB_READ_YOUR_WRITES', '1') == '1')
+        _local.session = session
+    return session
+
+def start_session(read_your_writes=True):
+    # Replaces the calling thread's session, e.g. one per terminal or worker thread
+    _local.session = Session(read_your_writes)
+    return _local.session
+
+class _PooledConnection:
+    # Returns the connection to its pool in a clean state; prepared statements survive
+    def __init__(self, pooled):
+        self._pooled = pooled
+        self._cnx = pooled._cnx
+
+    def __getattr__(self, name):
+        return getattr(self._pooled, name)
+
+    def cursor(self, *args, **kwargs):
+        return _watched(self._pooled.cursor(*args, **kwargs))
+
+    def close(self):
+        cnx = self._pooled._cnx
+        if cnx is None:
+            return
+        try:
+            if cnx.unread_result:
+                cnx.consume_results()
+            if cnx.in_transaction:
+                cnx.rollback()
+        except driver().Error:
+            pass
+        self._pooled.close()
+
+class _DirectConnection:
+    # A connection opened outside the pool (the pool was exhausted); closing it disconnects
+    def __init__(self, cnx):
+        self._cnx = cnx
+
+    def __getattr__(self, name):
+        return getattr(self._cnx, name)
+
+    def cursor(self, *args, **kwargs):
+        return _watched(self._cnx.cursor(*args, **kwargs))
+
+_driver = None
+
+def driver():
+    # mysql.connector is imported on the first real query, not at CLI startup
+    global _driver
+    if _driver is None:
+        import mysql.connector
+        import mysql.connector.pooling
+        _driver = mysql.connector
+    return _driver
+
+def _driver_config(config):
+    # Prefer the C extension; fall back to the pure-Python protocol when it isn't built
+    return dict(config, use_pure=not driver().HAVE_CEXT)
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def _get_pool(config):
+    key = (config['host'], config['port'])
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            # Session reset would deallocate the cached prepared statements on every checkin
+            pool = driver().pooling.MySQLConnectionPool(
+                pool_name=f"hospital_{config['host']}_{config['port']}",
+                pool_size=POOL_SIZE, pool_reset_session=False, **_driver_config(config))
+            _pools[key] = pool
+        return pool
+
+def _connect(config):
+    try:
+        return _PooledConnection(_get_pool(config).get_connection())
+    except driver().errors.PoolError:
+        return _DirectConnection(driver().connect(**_driver_config(config)))
+
+class _PinnedConnection:
+    # One connection shared by every get_connection() call on this thread. Entity methods
+    # close it after each call, which keeps it open; inside transaction() their commits are
+    # no-ops too.
+    def __init__(self, conn):
+        self._conn = conn
+        self._cnx = getattr(conn, '_cnx', conn)
+        self.in_group = False
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def commit(self):
+        if not self.in_group:
+            self._conn.commit()
+
+    def cursor(self, *args, **kwargs):
+        return _watched(self._conn.cursor(*args, **kwargs))
+
+    def discard_uncommitted(self):
+        # Outside a group, work a method left uncommitted (it failed or returned early) is rolled
+        # back as a pooled connection's would be on release, not committed by the next caller
+        if self.in_group:
+            return
+        try:
+            if self._cnx.in_transaction:
+                self._conn.rollback()
+        except driver().Error:
+            # The connection is gone, and the transaction with it
+            pass
+
+    def close(self):
+        self.discard_uncommitted()
+
+class _WatchedCursor:
+    # Reports driver errors to the thread's retry scope before raising them, so a failure
+    # the calling entity method catches and prints is still seen by retry.run_transaction
+    def __init__(self, cursor, scope):
+        self._cursor = cursor
+        self._scope = scope
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def _call(self, method, *args, **kwargs):
+        try:
+            return getattr(self._cursor, method)(*args, **kwargs)
+        except driver().Error as e:
+            self._scope.record(e)
+            raise
+
+    def execute(self, *args, **kwargs):
+        return self._call('execute', *args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        return self._call('executemany', *args, **kwargs)
+
+    def fetchone(self):
+        return self._call('fetchone')
+
+    def fetchall(self):
+        return self._call('fetchall')
+
+    def fetchmany(self, *args, **kwargs):
+        return self._call('fetchmany', *args, **kwargs)
+
+def _watched(cursor):
+    scope = getattr(_local, 'retry_scope', None)
+    if scope is None or isinstance(cursor, _WatchedCursor):
+        return cursor
+    return _WatchedCursor(cursor, scope)
+
+@contextmanager
+def retry_scope(scope):
+    # scope.record(error) is called for every driver error on this thread's cursors
+    previous = getattr(_local, 'retry_scope', None)
+    _local.retry_scope = scope
+    try:
+        yield scope
+    finally:
+        _local.retry_scope = previous
+
+def in_retry_scope():
+    return getattr(_local, 'retry_scope', None) is not None
+
+def in_transaction_group():
+    pinned = getattr(_local, 'pinned', None)
+    return pinned is not None and pinned.in_group
+
+def reset_pinned():
+    # Before a replay, this thread's pinned connection is rolled back: a lock wait timeout undoes
+    # only the failed statement, and the attempt's earlier writes must not be applied twice. A
+    # connection that can't be rolled back is reconnected, which ends its transaction; if that
+    # fails too the error is raised rather than replaying. Pooled connections are reset by the
+    # pool on checkout, and prepared_cursor notices a new session.
+    pinned = getattr(_local, 'pinned', None)
+    if pinned is None:
+        return
+    if pinned._cnx.is_connected():
+        try:
+            pinned._conn.rollback()
+            return
+        except driver().Error:
+            pass
+    pinned._cnx.reconnect()
+
+@contextmanager
+def pinned_connection():
+    pinned = getattr(_local, 'pinned', None)
+    if pinned is not None:
+        yield pinned
+        return
+    conn = get_connection()
+    pinned = _PinnedConnection(conn)
+    _local.pinned = pinned
+    try:
+        yield pinned
+    finally:
+        _local.pinned = None
+        conn.close()
+
+@contextmanager
+def transaction():
+    # Groups every entity call made inside the block into one commit (or one rollback)
+    with pinned_connection() as pinned:
+        if pinned.in_group:
+            yield pinned
+            return
+        pinned.in_group = True
+        try:
+            yield pinned
+        except BaseException:
+            pinned.in_group = False
+            pinned._conn.rollback()
+            raise
+        pinned.in_group = False
+        pinned._conn.commit()
+
+def get_connection(read_only=False):
+    pinned = getattr(_local, 'pinned', None)
+    if pinned is not None:
+        return pinned
+    session = current_session()
+    if read_only and REPLICA_CONFIGS and not session.reads_from_primary():
+        replica = _next_replica()
+        try:
+            return _connect(replica)
+        except driver().Error:
+            # A replica being down must not take reporting down with it
+            pass
+    if not read_only:
+        session.mark_write()
+    return _connect(DB_CONFIG)
+
+# --- Prepared statement cache ---
+_stmt_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+_stmt_stats_lock = threading.Lock()
+
+def _count(stat):
+    with _stmt_stats_lock:
+        _stmt_stats[stat] += 1
+
+def prepared_cursor(conn, sql):
+    # Server-side prepared cursor for `sql`, kept on the physical connection and keyed by
+    # statement text. The cursor belongs to the connection: callers must not close it.
+    raw = getattr(conn, '_cnx', conn)
+    cache = getattr(raw, '_statement_cache', None)
+    if cache is None or cache[0] != raw.connection_id:
+        # New or reconnected connection: statement handles from the old session are gone
+        cache = (raw.connection_id, OrderedDict())
+        raw._statement_cache = cache
+    cursors = cache[1]
+    cursor = cursors.get(sql)
+    if cursor is not None:
+        cursors.move_to_end(sql)
+        _count('hits')
+        return _watched(cursor)
+    _count('misses')
+    cursor = raw.cursor(prepared=True)
+    cursors[sql] = cursor
+    if len(cursors) > STATEMENT_CACHE_SIZE:
+        _, evicted = cursors.popitem(last=False)
+        evicted.close()
+        _count('evictions')
+    return _watched(cursor)
+
+def live_patient(column='patient_id'):
+    # Predicate for rows owned by a patient who isn't soft-deleted. Their rows stay until
+    # purge.py removes them, so every read of patient-owned rows filters on this.
+    return f"{column} IN (SELECT patient_id FROM patients WHERE deleted_at IS NULL)"
+
+def row_version(conn, table, key_column, key, condition=None):
+    # Current version of a row, read after a compare-and-set update matched nothing;
+    # None means the row doesn't exist (or doesn't meet `condition`, e.g. "deleted_at IS NULL")
+    cursor = conn.cursor()
+    try:
+        where = f"{key_column}=%s AND {condition}" if condition else f"{key_column}=%s"
+        cursor.execute(f"SELECT version FROM {table} WHERE {where}", (key,))
+        row = cursor.fetchone()
+        return row[0] if row else None
+    finally:
+        cursor.close()
+
+def statement_cache_stats():
+    with _stmt_stats_lock:
+        stats = dict(_stmt_stats)
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+    return stats
 
 # Optional: Test connection when running this file directly
 if __name__ == "__main__":
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT DATABASE()")
-        print("Connected to:", cursor.fetchone()[0])
-        cursor.close()
-        conn.close()
-    except Error as e:
+        start_session(read_your_writes=False)
+        for label, read_only in (("Primary (writes)", False), ("Reads", True)):
+            conn = get_connection(read_only=read_only)
+            cursor = conn.cursor()
+            cursor.execute("SELECT DATABASE(), @@hostname, @@port")
+            database, hostname, port = cursor.fetchone()
+            print(f"{label}: connected to {database} on {hostname}:{port}")
+            cursor.close()
+            conn.close()
+    except driver().Error as e:
         print("Error while connecting to MySQL:", e)
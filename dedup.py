@@ -0,0 +1,311 @@
+import os
+import re
+import sys
+import time
+from collections import deque
+from difflib import SequenceMatcher
+
+from db_config import get_connection, prepared_cursor
+from changelog import ChangeConsumer
+from mysql.connector import Error
+
+# Record linkage for patients registered more than once under slightly different spellings.
+# Instead of comparing every pair, records are only compared when they share a block (same
+# phonetic name key and a close birth year, or the same contact number) or sit within
+# DEDUP_WINDOW of each other when sorted by name; each pass is one sorted scan.
+DEDUP_WINDOW = int(os.environ.get('HOSPITAL_DEDUP_WINDOW', '20'))
+DEDUP_THRESHOLD = float(os.environ.get('HOSPITAL_DEDUP_THRESHOLD', '0.8'))
+# Birth years (admission year - age) further apart than this are not compared in the name pass
+DEDUP_BIRTH_YEAR_BAND = int(os.environ.get('HOSPITAL_DEDUP_BIRTH_YEAR_BAND', '2'))
+# Most candidates read from one block by the incremental and registration checks
+DEDUP_BLOCK_LIMIT = int(os.environ.get('HOSPITAL_DEDUP_BLOCK_LIMIT', '500'))
+DEDUP_POLL_INTERVAL = float(os.environ.get('HOSPITAL_DEDUP_POLL_INTERVAL', '30'))
+DEDUP_WRITE_BATCH = 500
+
+HONORIFICS = {'mr', 'mrs', 'ms', 'miss', 'dr', 'shri', 'smt', 'md'}
+
+_SOUNDEX_CODES = {letter: digit for digit, letters in
+                  (('1', 'bfpv'), ('2', 'cgjkqsxz'), ('3', 'dt'), ('4', 'l'), ('5', 'mn'), ('6', 'r'))
+                  for letter in letters}
+
+# Columns every pass and check reads, in the order _record() expects
+PATIENT_COLUMNS = "patient_id, name, gender, contact_no, name_key, YEAR(admission_date) - age"
+
+def _tokens(name):
+    tokens = re.sub(r'[^a-z ]', ' ', str(name or '').lower()).split()
+    return sorted(t for t in tokens if t not in HONORIFICS)
+
+def normalize_name(name):
+    # "Dr. Smith,  John" -> "john smith": lowercase letters only, no titles, tokens sorted
+    return ' '.join(_tokens(name))
+
+def _soundex(token):
+    code = token[0].upper()
+    last = _SOUNDEX_CODES.get(token[0], '')
+    for letter in token[1:]:
+        digit = _SOUNDEX_CODES.get(letter, '')
+        if digit and digit != last:
+            code += digit
+            if len(code) == 4:
+                break
+        if letter not in 'hw':
+            last = digit
+    return code.ljust(4, '0')
+
+def name_key(name):
+    # Blocking key stored in patients.name_key: sorted Soundex codes, so "Jon Smyth" and
+    # "John Smith" land in the same block whichever order the names were typed in
+    return ' '.join(sorted(_soundex(t) for t in _tokens(name)))[:100] or None
+
+def _record(row):
+    patient_id, name, gender, contact_no, key, birth_year = row
+    return (int(patient_id), normalize_name(name), gender, contact_no or '', key, birth_year)
+
+def match_score(a, b):
+    # 0..1 from name similarity, contact number, birth year and gender
+    name = SequenceMatcher(None, a[1], b[1]).ratio() if a[1] and b[1] else 0.0
+    if a[3] and a[3] == b[3]:
+        contact = 1.0
+    elif len(a[3]) >= 7 and a[3][-7:] == b[3][-7:]:
+        contact = 0.8
+    else:
+        contact = 0.0
+    if a[5] is None or b[5] is None:
+        birth = 0.5
+    else:
+        gap = abs(a[5] - b[5])
+        birth = 1.0 if gap <= 1 else 0.5 if gap <= 3 else 0.0
+    gender = 1.0 if a[2] == b[2] else 0.0
+    return round(0.5 * name + 0.25 * contact + 0.15 * birth + 0.1 * gender, 3)
+
+def _same_name_block(prev, row):
+    return (prev[4] == row[4] and
+            (prev[5] is None or row[5] is None or abs(row[5] - prev[5]) <= DEDUP_BIRTH_YEAR_BAND))
+
+def _same_contact_block(prev, row):
+    return prev[3] == row[3]
+
+# (name, sorted scan, predicate a previous row must still meet to be compared; None compares
+# the whole window). Rows are sorted so that once a row fails, every row before it fails too.
+DEDUP_PASSES = [
+    ('name_key', f"SELECT {PATIENT_COLUMNS} FROM patients WHERE deleted_at IS NULL AND name_key IS NOT NULL "
+                 "ORDER BY name_key, YEAR(admission_date) - age, patient_id", _same_name_block),
+    ('contact', f"SELECT {PATIENT_COLUMNS} FROM patients WHERE deleted_at IS NULL AND contact_no <> '' "
+                "ORDER BY contact_no, patient_id", _same_contact_block),
+    ('name', f"SELECT {PATIENT_COLUMNS} FROM patients WHERE deleted_at IS NULL ORDER BY name, patient_id", None),
+]
+
+def _scan(pass_name, sql, keep, window, matches, threshold):
+    # One sorted pass: each row is compared with at most `window` rows before it
+    conn = get_connection(read_only=True)
+    cursor = conn.cursor()
+    compared = 0
+    try:
+        cursor.execute(sql)
+        recent = deque(maxlen=window)
+        while True:
+            rows = cursor.fetchmany(1000)
+            if not rows:
+                break
+            for row in rows:
+                record = _record(row)
+                if keep:
+                    while recent and not keep(recent[0], record):
+                        recent.popleft()
+                for prev in recent:
+                    compared += 1
+                    score = match_score(prev, record)
+                    if score >= threshold:
+                        _keep_best(matches, prev[0], record[0], score, pass_name)
+                recent.append(record)
+    finally:
+        cursor.close()
+        conn.close()
+    return compared
+
+def _keep_best(matches, a, b, score, pass_name):
+    # matches: (newer id, older id) -> (score, pass); the newer registration is the suspect
+    pair = (max(a, b), min(a, b))
+    if pair not in matches or matches[pair][0] < score:
+        matches[pair] = (score, pass_name)
+
+def _save_matches(matches):
+    # Re-finding a pair refreshes its score but keeps a reviewer's merged/dismissed status
+    rows = [(newer, older, score, pass_name) for (newer, older), (score, pass_name) in matches.items()]
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        for start in range(0, len(rows), DEDUP_WRITE_BATCH):
+            cursor.executemany(
+                "INSERT INTO duplicate_candidates (patient_id, duplicate_of, score, match_pass) VALUES (%s, %s, %s, %s) "
+                "ON DUPLICATE KEY UPDATE score = VALUES(score), match_pass = VALUES(match_pass)",
+                rows[start:start + DEDUP_WRITE_BATCH])
+            conn.commit()
+    finally:
+        cursor.close()
+        conn.close()
+    return len(rows)
+
+def find_all_duplicates(window=DEDUP_WINDOW, threshold=DEDUP_THRESHOLD):
+    # Full run over every live patient: len(DEDUP_PASSES) sorted scans, O(n * window) comparisons
+    matches = {}
+    try:
+        for pass_name, sql, keep in DEDUP_PASSES:
+            started = time.perf_counter()
+            compared = _scan(pass_name, sql, keep, window, matches, threshold)
+            print(f"Pass '{pass_name}': {compared} comparisons in {time.perf_counter() - started:.1f}s, "
+                  f"{len(matches)} candidate pair(s) so far.")
+        saved = _save_matches(matches)
+        print(f"Saved {saved} likely duplicate pair(s).")
+        return saved
+    except Error as e:
+        print("Database error while finding duplicate patients:", e)
+        return None
+
+# Index probes that find what a full run would compare one patient with: (pass, sql, which
+# value to look up). The first two are the blocks, the last two the sorted-by-name neighbours.
+CANDIDATE_QUERIES = [
+    ('name_key', f"SELECT {PATIENT_COLUMNS} FROM patients WHERE name_key = %s AND deleted_at IS NULL "
+                 "AND patient_id <> %s LIMIT %s", 'name_key'),
+    ('contact', f"SELECT {PATIENT_COLUMNS} FROM patients WHERE contact_no = %s AND deleted_at IS NULL "
+                "AND patient_id <> %s LIMIT %s", 'contact_no'),
+    ('name', f"SELECT {PATIENT_COLUMNS} FROM patients WHERE name >= %s AND deleted_at IS NULL "
+             "AND patient_id <> %s ORDER BY name LIMIT %s", 'name'),
+    ('name', f"SELECT {PATIENT_COLUMNS} FROM patients WHERE name < %s AND deleted_at IS NULL "
+             "AND patient_id <> %s ORDER BY name DESC LIMIT %s", 'name'),
+]
+
+def _candidates(conn, record, name, neighbours=True):
+    values = {'name_key': record[4], 'contact_no': record[3], 'name': name}
+    queries = CANDIDATE_QUERIES if neighbours else CANDIDATE_QUERIES[:2]
+    found = {}
+    for pass_name, sql, field in queries:
+        if not values[field]:
+            continue
+        limit = DEDUP_WINDOW if pass_name == 'name' else DEDUP_BLOCK_LIMIT
+        cursor = prepared_cursor(conn, sql)
+        cursor.execute(sql, (values[field], record[0], limit))
+        for row in cursor.fetchall():
+            other = _record(row)
+            if other[0] not in found:
+                found[other[0]] = (pass_name, row, match_score(record, other))
+    return found
+
+def likely_duplicates(patient, threshold=DEDUP_THRESHOLD):
+    # Registration check for a patient that may not be saved yet: two index probes (name key
+    # and contact number). Returns [{'patient_id', 'name', 'contact_no', 'score'}], best first.
+    try:
+        birth_year = int(str(patient.admission_date)[:4]) - int(patient.age)
+    except (TypeError, ValueError):
+        birth_year = None
+    record = _record((patient.patient_id or 0, patient.name, patient.gender, patient.contact_no,
+                      name_key(patient.name), birth_year))
+    try:
+        conn = get_connection(read_only=True)
+        found = _candidates(conn, record, patient.name, neighbours=False)
+        matches = [{'patient_id': row[0], 'name': row[1], 'contact_no': row[3], 'score': score}
+                   for pass_name, row, score in found.values() if score >= threshold]
+        return sorted(matches, key=lambda m: -m['score'])
+    except Error as e:
+        print("Database error while checking for duplicate patients:", e)
+        return []
+    finally:
+        if 'conn' in locals(): conn.close()
+
+def check_patients(patient_ids, threshold=DEDUP_THRESHOLD):
+    # Incremental form of the full run for new or changed patients; returns the pairs found
+    matches = {}
+    try:
+        conn = get_connection(read_only=True)
+        sql = f"SELECT {PATIENT_COLUMNS} FROM patients WHERE patient_id = %s AND deleted_at IS NULL"
+        for patient_id in patient_ids:
+            cursor = prepared_cursor(conn, sql)
+            cursor.execute(sql, (patient_id,))
+            rows = cursor.fetchall()
+            if not rows:
+                continue
+            record = _record(rows[0])
+            for other_id, (pass_name, row, score) in _candidates(conn, record, rows[0][1]).items():
+                if score >= threshold:
+                    _keep_best(matches, record[0], other_id, score, pass_name)
+    finally:
+        if 'conn' in locals(): conn.close()
+    if matches:
+        _save_matches(matches)
+    return matches
+
+def stored_duplicates(patient_id):
+    # Open candidate pairs involving the patient, from the last full or incremental run
+    try:
+        conn = get_connection(read_only=True)
+        sql = ("SELECT d.patient_id, d.duplicate_of, d.score, d.match_pass, d.status FROM duplicate_candidates d "
+               "WHERE (d.patient_id = %s OR d.duplicate_of = %s) AND d.status = 'open' ORDER BY d.score DESC")
+        cursor = prepared_cursor(conn, sql)
+        cursor.execute(sql, (patient_id, patient_id))
+        return [{'patient_id': a, 'duplicate_of': b, 'score': float(score), 'match_pass': pass_name, 'status': status}
+                for a, b, score, pass_name, status in cursor.fetchall()]
+    except Error as e:
+        print("Database error while reading duplicate candidates:", e)
+        return []
+    finally:
+        if 'conn' in locals(): conn.close()
+
+def _changed_patients(events):
+    return list(dict.fromkeys(e['key'] for e in events if e['op'] in ('insert', 'update')))
+
+def run_incremental(consumer=None):
+    # Checks every patient inserted or updated since the 'dedup' checkpoint, then advances it
+    consumer = consumer or ChangeConsumer('dedup', entities=['patient'])
+    checked = found = 0
+    try:
+        while True:
+            events = consumer.poll()
+            if not events:
+                consumer.commit()
+                break
+            patient_ids = _changed_patients(events)
+            found += len(check_patients(patient_ids))
+            checked += len(patient_ids)
+            consumer.commit()
+    except Error as e:
+        print("Database error while checking new patients for duplicates:", e)
+    if checked:
+        print(f"Checked {checked} new or changed patient(s), {found} likely duplicate pair(s).")
+    return {'checked': checked, 'pairs': found}
+
+def run_worker(poll_interval=DEDUP_POLL_INTERVAL, should_stop=lambda: False):
+    ChangeConsumer('dedup', entities=['patient']).tail(
+        lambda events: check_patients(_changed_patients(events)), poll_interval, should_stop)
+
+def backfill_name_keys(batch_size=1000):
+    # Fills patients.name_key for rows written before the column existed
+    conn = get_connection()
+    cursor = conn.cursor()
+    total = 0
+    try:
+        while True:
+            cursor.execute("SELECT patient_id, name FROM patients WHERE name_key IS NULL AND name IS NOT NULL "
+                           "AND name <> '' LIMIT %s", (batch_size,))
+            # Names without letters get '' rather than NULL so they aren't read again
+            rows = [(name_key(name) or '', patient_id) for patient_id, name in cursor.fetchall()]
+            if not rows:
+                break
+            cursor.executemany("UPDATE patients SET name_key = %s WHERE patient_id = %s", rows)
+            conn.commit()
+            total += len(rows)
+    finally:
+        cursor.close()
+        conn.close()
+    print(f"Filled the name key of {total} patient(s).")
+    return total
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if '--backfill' in args:
+        backfill_name_keys()
+    if '--full' in args:
+        find_all_duplicates()
+    elif '--once' in args:
+        run_incremental()
+    elif '--backfill' not in args:
+        run_worker()
@@ -1,15 +1,25 @@
 import re
-from db_config import get_connection
+from db_config import get_connection, prepared_cursor, row_version
+from retry import retrying
+import history
+from changelog import record_change
+from bulk import BULK_CHUNK_SIZE, upsert_rows, format_counts
+from assignment import load_index
+from contacts import MAX_CONTACT_DIGITS, index_contact, index_contacts, unindex_contact
 from person import Person
 import mysql.connector
 from mysql.connector import IntegrityError, Error
 
 class Doctor(Person):
-    def __init__(self, doctor_id, name, specialization, contact_no):
+    def __init__(self, doctor_id, name, specialization, contact_no, version=None):
         super().__init__(doctor_id, name, contact_no)
         self.doctor_id = doctor_id
         self.specialization = specialization
         self.name = self._format_name(name)
+        # Row version as last read; update() only applies if the row still has it
+        self.version = version
+        self.conflict = False
+        self.current_version = None
 
     def _format_name(self, name):
         name = name.strip()
@@ -17,24 +27,33 @@ class Doctor(Person):
             return "Dr. " + name
         return name
 
-    def add(self):
-        # Data validation (no doctor_id validation needed)
+    def _validate(self):
+        # Returns the first validation error, or None if the doctor can be saved
+        # (no doctor_id validation needed)
         if not self.name or not re.match(r'^[A-Za-z. ]+$', self.name):
-            print("Invalid Name. Only letters, spaces, and periods allowed.")
-            return False
+            return "Invalid Name. Only letters, spaces, and periods allowed."
         if not self.specialization or not all(x.isalpha() or x.isspace() for x in self.specialization):
-            print("Invalid Specialization. Only letters and spaces allowed.")
-            return False
-        if not self.contact_no.isdigit() or len(self.contact_no) < 10:
-            print("Invalid Contact Number. Only digits allowed, minimum 10 digits.")
+            return "Invalid Specialization. Only letters and spaces allowed."
+        if not self.contact_no.isdigit() or not 10 <= len(self.contact_no) <= MAX_CONTACT_DIGITS:
+            return f"Invalid Contact Number. Only digits allowed, 10 to {MAX_CONTACT_DIGITS} digits."
+        return None
+
+    @retrying
+    def add(self):
+        error = self._validate()
+        if error:
+            print(error)
             return False
 
         try:
             conn = get_connection()
-            cursor = conn.cursor()
             sql = "INSERT INTO doctors (doctor_id, name, specialization, contact_no) VALUES (%s, %s, %s, %s)"
+            cursor = prepared_cursor(conn, sql)
             cursor.execute(sql, (self.doctor_id, self.name, self.specialization, self.contact_no))
+            record_change(conn, 'doctor', self.doctor_id, 'insert', {'name': self.name, 'specialization': self.specialization, 'contact_no': self.contact_no})
+            index_contact(conn, 'doctor', self.doctor_id, self.name, self.contact_no)
             conn.commit()
+            load_index.doctor_changed(self.doctor_id, self.specialization)
             return True
         except mysql.connector.errors.IntegrityError as e:
             if "unique_contact_no" in str(e):
@@ -48,33 +67,52 @@ class Doctor(Person):
             print("Unexpected error while adding doctor:", e)
             return False
         finally:
-            if 'cursor' in locals(): cursor.close()
             if 'conn' in locals(): conn.close()
 
+    @retrying
     def update(self):
-        # Data validation (no doctor_id validation needed)
-        if not self.name or not re.match(r'^[A-Za-z. ]+$', self.name):
-            print("Invalid Name. Only letters, spaces, and periods allowed.")
+        error = self._validate()
+        if error:
+            print(error)
             return False
-        if not self.specialization or not all(x.isalpha() or x.isspace() for x in self.specialization):
-            print("Invalid Specialization. Only letters and spaces allowed.")
-            return False
-        if not self.contact_no.isdigit() or len(self.contact_no) < 10:
-            print("Invalid Contact Number. Only digits allowed, minimum 10 digits.")
+        # Version validation (no version means overwrite unconditionally)
+        try:
+            version = None if self.version is None else int(self.version)
+        except ValueError:
+            print("Invalid Version. Must be a number.")
             return False
 
+        self.conflict = False
         try:
             conn = get_connection()
-            cursor = conn.cursor()
-            sql = "UPDATE doctors SET name=%s, specialization=%s, contact_no=%s WHERE doctor_id=%s"
-            cursor.execute(sql, (self.name, self.specialization, self.contact_no, self.doctor_id))
-            conn.commit()
+            params = (self.name, self.specialization, self.contact_no, self.doctor_id)
+            if version is None:
+                sql = "UPDATE doctors SET name=%s, specialization=%s, contact_no=%s, version=version+1 WHERE doctor_id=%s AND deleted_at IS NULL"
+            else:
+                # Compare-and-set: matches only if nobody has updated the row since it was read
+                sql = "UPDATE doctors SET name=%s, specialization=%s, contact_no=%s, version=version+1 WHERE doctor_id=%s AND deleted_at IS NULL AND version=%s"
+                params += (version,)
+            cursor = prepared_cursor(conn, sql)
+            cursor.execute(sql, params)
             if cursor.rowcount == 0:
-                print(f"Doctor ID '{self.doctor_id}' not found.")
+                current = row_version(conn, 'doctors', 'doctor_id', self.doctor_id, 'deleted_at IS NULL')
+                if current is None:
+                    print(f"Doctor ID '{self.doctor_id}' not found.")
+                else:
+                    self.conflict = True
+                    self.current_version = current
+                    print(f"Update conflict: doctor '{self.doctor_id}' was changed by someone else "
+                          f"(your version {version}, current version {current}). Reload it and try again.")
                 return False
-            else:
-                print("Doctor updated successfully.")
-                return True
+            record_change(conn, 'doctor', self.doctor_id, 'update', {'name': self.name, 'specialization': self.specialization, 'contact_no': self.contact_no})
+            index_contact(conn, 'doctor', self.doctor_id, self.name, self.contact_no)
+            conn.commit()
+            history.invalidate()
+            load_index.doctor_changed(self.doctor_id, self.specialization)
+            if version is not None:
+                self.version = version + 1
+            print("Doctor updated successfully.")
+            return True
         except Error as e:
             print("Database error while updating doctor:", e)
             return False
@@ -82,18 +120,25 @@ class Doctor(Person):
             print("Unexpected error while updating doctor:", e)
             return False
         finally:
-            if 'cursor' in locals(): cursor.close()
             if 'conn' in locals(): conn.close()
 
     @staticmethod
+    @retrying
     def delete(doctor_id):
         # No need to validate doctor_id if always generated by system
+        # Soft delete: purge.py later detaches the doctor's appointments in batches and removes the row
         try:
             conn = get_connection()
-            cursor = conn.cursor()
-            sql = "DELETE FROM doctors WHERE doctor_id=%s"
+            sql = "UPDATE doctors SET deleted_at = CURRENT_TIMESTAMP, version = version + 1 WHERE doctor_id=%s AND deleted_at IS NULL"
+            cursor = prepared_cursor(conn, sql)
             cursor.execute(sql, (doctor_id,))
+            if cursor.rowcount:
+                record_change(conn, 'doctor', doctor_id, 'delete')
+                unindex_contact(conn, 'doctor', doctor_id)
             conn.commit()
+            history.invalidate()
+            if cursor.rowcount:
+                load_index.doctor_changed(doctor_id)
             if cursor.rowcount == 0:
                 print(f"Doctor ID '{doctor_id}' not found.")
                 return False
@@ -107,17 +152,56 @@ class Doctor(Person):
             print("Unexpected error while deleting doctor:", e)
             return False
         finally:
-            if 'cursor' in locals(): cursor.close()
             if 'conn' in locals(): conn.close()
 
     @staticmethod
-    def view():
+    def get(doctor_id):
+        # Reads the primary, so the version is current enough to update with
         try:
             conn = get_connection()
+            sql = "SELECT doctor_id, name, specialization, contact_no, version FROM doctors WHERE doctor_id=%s AND deleted_at IS NULL"
+            cursor = prepared_cursor(conn, sql)
+            cursor.execute(sql, (doctor_id,))
+            rows = cursor.fetchall()
+            return Doctor(*rows[0]) if rows else None
+        except Error as e:
+            print("Database error while fetching doctor:", e)
+            return None
+        finally:
+            if 'conn' in locals(): conn.close()
+
+    @staticmethod
+    def bulk_upsert(rows, chunk_size=BULK_CHUNK_SIZE):
+        # Roster sync: rows are dicts with doctor_id, name, specialization and contact_no.
+        # Safe to re-run; returns inserted/updated/unchanged/failed/invalid counts.
+        valid, invalid = [], 0
+        for row in rows:
+            doctor = Doctor(str(row.get('doctor_id') or ''), str(row.get('name') or ''),
+                            row.get('specialization'), row.get('contact_no'))
+            error = doctor._validate() if doctor.doctor_id else "Missing Doctor ID."
+            if error:
+                print(f"Skipped doctor '{doctor.doctor_id}': {error}")
+                invalid += 1
+                continue
+            valid.append((doctor.doctor_id, (doctor.name, doctor.specialization, doctor.contact_no)))
+        counts = upsert_rows('doctors', 'doctor', 'doctor_id', ('name', 'specialization', 'contact_no'), valid, chunk_size,
+                             lambda conn, written: index_contacts(conn, 'doctor', [(key, v[0], v[2]) for key, v in written]),
+                             deleted_column='deleted_at')
+        counts['invalid'] = invalid
+        if counts['inserted'] or counts['updated']:
+            history.invalidate()
+            load_index.invalidate()
+        print("Doctor sync:", format_counts(counts))
+        return counts
+
+    @staticmethod
+    def view():
+        try:
+            conn = get_connection(read_only=True)
             cursor = conn.cursor()
-            cursor.execute("SELECT * FROM doctors")
+            cursor.execute("SELECT doctor_id, name, specialization, contact_no, version FROM doctors WHERE deleted_at IS NULL")
             rows = cursor.fetchall()
-            print("ID | Name | Specialization | Contact No")
+            print("ID | Name | Specialization | Contact No | Version")
             for row in rows:
                 print(" | ".join(str(x) for x in row))
         except Error as e:
@@ -130,14 +214,15 @@ class Doctor(Person):
 
     @staticmethod
     def search_by_name(name_substring):
-        conn = get_connection()
+        conn = get_connection(read_only=True)
         cursor = conn.cursor()
         try:
             search_pattern = f"%{name_substring}%"
-            cursor.execute("SELECT * FROM doctors WHERE name LIKE %s", (search_pattern,))
+            cursor.execute("SELECT doctor_id, name, specialization, contact_no, version FROM doctors "
+                           "WHERE name LIKE %s AND deleted_at IS NULL", (search_pattern,))
             rows = cursor.fetchall()
             if rows:
-                print("Doctor ID | Name | Specialization | Contact No")
+                print("Doctor ID | Name | Specialization | Contact No | Version")
                 for row in rows:
                     print(" | ".join(str(x) for x in row))
             else:
@@ -0,0 +1,160 @@
+import heapq
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import date, datetime
+
+from db_config import get_connection
+
+# Each source is a separate query on an indexed (patient_id, <time>) column, so the
+# history grows with the sum of the rows instead of appointments x services.
+HISTORY_QUERIES = {
+    'appointment': """
+        SELECT a.date, a.appt_id, a.doctor_id, d.name, d.specialization, a.diagnosis, a.consulting_charge
+        FROM appointments a
+        LEFT JOIN doctors d ON d.doctor_id = a.doctor_id
+        WHERE a.patient_id = %s
+        ORDER BY a.date, a.appt_id""",
+    'bill': """
+        SELECT billing_date, bill_id, total_amount
+        FROM billing
+        WHERE patient_id = %s
+        ORDER BY billing_date, bill_id""",
+    'billed_service': """
+        SELECT billed_at, bill_id, service_id, service_name, cost
+        FROM billed_services
+        WHERE patient_id = %s AND voided_at IS NULL
+        ORDER BY billed_at, id""",
+    'pending_service': """
+        SELECT c.created_at, c.service_id, s.service_name, c.cost
+        FROM pending_charges c
+        JOIN services s ON s.service_id = c.service_id
+        WHERE c.patient_id = %s
+        ORDER BY c.charge_id""",
+}
+
+# Same sources over the archive tables (archive.py), read only when asked for
+ARCHIVED_HISTORY_QUERIES = {
+    'appointment': HISTORY_QUERIES['appointment'].replace("FROM appointments a", "FROM appointments_archive a"),
+    'bill': HISTORY_QUERIES['bill'].replace("FROM billing", "FROM billing_archive"),
+    'billed_service': HISTORY_QUERIES['billed_service'].replace("FROM billed_services", "FROM billed_services_archive"),
+}
+
+HISTORY_FIELDS = {
+    'appointment': ('appt_id', 'doctor_id', 'doctor_name', 'specialization', 'diagnosis', 'consulting_charge'),
+    'bill': ('bill_id', 'total_amount'),
+    'billed_service': ('bill_id', 'service_id', 'service_name', 'cost'),
+    'pending_service': ('service_id', 'service_name', 'cost'),
+}
+
+# Other terminals' writes are only picked up once an entry expires
+HISTORY_CACHE_TTL = float(os.environ.get('HOSPITAL_HISTORY_CACHE_TTL', '60'))
+HISTORY_CACHE_SIZE = int(os.environ.get('HOSPITAL_HISTORY_CACHE_SIZE', '256'))
+
+_cache = OrderedDict()  # (patient_id, include_archived) -> (loaded_at, events)
+_generations = {}       # patient_id -> invalidation counter, guards against caching a stale build
+_epoch = 0              # bumped when every patient is invalidated at once
+_cache_lock = threading.Lock()
+
+def _timestamp(value):
+    if isinstance(value, datetime):
+        return value
+    if isinstance(value, date):
+        return datetime(value.year, value.month, value.day)
+    return datetime.min
+
+def _events(cursor, kind, sql, patient_id, archived):
+    cursor.execute(sql, (patient_id,))
+    fields = HISTORY_FIELDS[kind]
+    for row in cursor:
+        event = dict(zip(fields, row[1:]))
+        event['type'] = kind
+        event['at'] = row[0]
+        event['archived'] = archived
+        yield event
+
+def _load_history(patient_id, include_archived):
+    sources = [(kind, sql, False) for kind, sql in HISTORY_QUERIES.items()]
+    if include_archived:
+        sources += [(kind, sql, True) for kind, sql in ARCHIVED_HISTORY_QUERIES.items()]
+    conn = get_connection(read_only=True)
+    cursors = []
+    try:
+        # A soft-deleted patient has no history, even before purge.py has removed their rows
+        check = conn.cursor(buffered=True)
+        cursors.append(check)
+        check.execute("SELECT 1 FROM patients WHERE patient_id = %s AND deleted_at IS NULL", (patient_id,))
+        if check.fetchone() is None:
+            return
+        streams = []
+        for kind, sql, archived in sources:
+            cursor = conn.cursor(buffered=True)
+            cursors.append(cursor)
+            streams.append(_events(cursor, kind, sql, patient_id, archived))
+        yield from heapq.merge(*streams, key=lambda e: _timestamp(e['at']))
+    finally:
+        for cursor in cursors:
+            cursor.close()
+        conn.close()
+
+def patient_history(patient_id, include_archived=False):
+    # Yields the patient's timeline oldest first; a fully consumed build is cached
+    key = str(patient_id)
+    cache_key = (key, bool(include_archived))
+    with _cache_lock:
+        entry = _cache.get(cache_key)
+        if entry and time.monotonic() - entry[0] < HISTORY_CACHE_TTL:
+            _cache.move_to_end(cache_key)
+            events = entry[1]
+        else:
+            events = None
+            generation = (_epoch, _generations.get(key, 0))
+    if events is not None:
+        yield from events
+        return
+
+    built = []
+    for event in _load_history(key, include_archived):
+        built.append(event)
+        yield event
+    with _cache_lock:
+        if (_epoch, _generations.get(key, 0)) == generation:
+            _cache[cache_key] = (time.monotonic(), built)
+            _cache.move_to_end(cache_key)
+            while len(_cache) > HISTORY_CACHE_SIZE:
+                _cache.popitem(last=False)
+
+def invalidate(patient_id=None):
+    # Called by every write that can change a history; None drops all patients
+    global _epoch
+    with _cache_lock:
+        if patient_id is None:
+            _epoch += 1
+            _cache.clear()
+        else:
+            key = str(patient_id)
+            _generations[key] = _generations.get(key, 0) + 1
+            _cache.pop((key, False), None)
+            _cache.pop((key, True), None)
+
+def print_patient_history(patient_id, include_archived=False):
+    try:
+        count = 0
+        for event in patient_history(patient_id, include_archived):
+            count += 1
+            at = f"{event['at']} [archived]" if event['archived'] else event['at']
+            kind = event['type']
+            if kind == 'appointment':
+                print(f"{at} | Appointment {event['appt_id']} | {event['doctor_name'] or 'N/A'} "
+                      f"({event['specialization'] or 'N/A'}) | {event['diagnosis']} | Charge: {event['consulting_charge']}")
+            elif kind == 'bill':
+                print(f"{at} | Bill {event['bill_id']} | Total: {event['total_amount']}")
+            elif kind == 'billed_service':
+                print(f"{at} | Billed service {event['service_name']} (ID: {event['service_id']}) on {event['bill_id']} | Cost: {event['cost']}")
+            else:
+                print(f"{at} | Pending service {event['service_name']} (ID: {event['service_id']}) | Cost: {event['cost']}")
+        if count == 0:
+            print("No history found for this patient.")
+    except Exception as e:
+        print("Error fetching patient history:", e)
@@ -1,12 +1,16 @@
-from db_config import get_connection
-from patient import Patient, generate_next_patient_id
-from doctor import Doctor, generate_next_doctor_id
-from service import Service, ServiceUsageDB, service_usage_menu, generate_next_service_id
-from appointment import Appointment, generate_next_appointment_id
-from billing import Bill, compute_total_billing, generate_next_bill_id
+import datetime
+
+from profiler import select_option
+
+# Entity modules (and through them the MySQL driver) are imported when their submenu is
+# first opened, so the main menu appears without loading or connecting to anything.
 
 # --- Patient ---
 def patients_menu():
+    from patient import Patient, generate_next_patient_id
+    from service import service_usage_menu
+    from history import print_patient_history
+    from dedup import likely_duplicates
     while True:
         print("\n=== Patient Management ===")
         print("1. Search Patient")
@@ -16,23 +20,34 @@ def patients_menu():
         print("5. Delete Patient")
         print("6. Service Usage of Patient")
         print("7. Days Admitted for a Patient")
-        print("8. Back to Main Menu")
+        print("8. Patient History")
+        print("9. Back to Main Menu")
     
-        choice = input("Select an option: ")
+        choice = select_option('patients_menu')
 
         if choice == '1':
             name = input("Enter part or full patient name: ")
             Patient.search_by_name(name)
             
         elif choice == '2':
-            patient_id = generate_next_patient_id()
-            print(f"Auto-generated Patient ID: {patient_id}")
             name = input("Enter Name: ")
             age = input("Enter Age: ")
             gender = input("Enter Gender: ")
             admission_date = input("Enter Admission Date (YYYY-MM-DD): ")
             contact_no = input("Enter Contact No: ")
+            patient_id = generate_next_patient_id()
+            print(f"Auto-generated Patient ID: {patient_id}")
             patient = Patient(patient_id, name, age, gender, admission_date, contact_no)
+            # Returning patients are often re-registered under another spelling
+            matches = likely_duplicates(patient)
+            if matches:
+                print("Possible existing registrations:")
+                print("Patient_ID | Name | Contact No | Match")
+                for m in matches:
+                    print(f"{m['patient_id']} | {m['name']} | {m['contact_no']} | {m['score']:.2f}")
+                if input("Register as a new patient anyway? (y/N): ").strip().lower() != 'y':
+                    print("Patient was not added.")
+                    continue
             result = patient.add()
             if result:
                 print("Patient added successfully.")
@@ -44,12 +59,18 @@ def patients_menu():
 
         elif choice == '4':
             patient_id = int(input("Enter Patient ID to update: "))
-            name = input("Enter New Name: ")
-            age = int(input("Enter New Age: "))
-            gender = input("Enter New Gender (M/F/Other): ")
-            admission_date = input("Enter New Admission Date (YYYY-MM-DD): ")
-            contact_no = input("Enter New Contact No: ")
-            Patient(patient_id, name, age, gender, admission_date, contact_no).update()
+            # Read first: the update only goes through if nobody changes the row meanwhile
+            current = Patient.get(patient_id)
+            if current is None:
+                print(f"No patient found with ID '{patient_id}'.")
+            else:
+                print(f"Editing patient {patient_id} (version {current.version}).")
+                name = input("Enter New Name: ")
+                age = int(input("Enter New Age: "))
+                gender = input("Enter New Gender (M/F/Other): ")
+                admission_date = input("Enter New Admission Date (YYYY-MM-DD): ")
+                contact_no = input("Enter New Contact No: ")
+                Patient(patient_id, name, age, gender, admission_date, contact_no, current.version).update()
 
         elif choice == '5':
             patient_id = input("Enter Patient ID to delete: ")
@@ -63,7 +84,12 @@ def patients_menu():
             patient_id = input("Enter Patient ID: ")
             Patient.days_admitted(patient_id)
 
-        elif choice == '8':
+        elif choice == "8":
+            patient_id = input("Enter Patient ID: ")
+            include_archived = input("Include archived records? (y/N): ").strip().lower() == 'y'
+            print_patient_history(patient_id, include_archived)
+
+        elif choice == '9':
             break
 
         else:
@@ -71,6 +97,7 @@ def patients_menu():
 
 # --- Doctor ---
 def doctors_menu():
+    from doctor import Doctor, generate_next_doctor_id
     while True:
         print("\n=== Doctor Management ===")
         print("1. Search Doctor")
@@ -80,18 +107,18 @@ def doctors_menu():
         print("5. Delete Doctor")
         print("6. Back to Main Menu")
  
-        choice = input("Select an option: ")
+        choice = select_option('doctors_menu')
  
         if choice == "1":
             name = input("Enter part or full doctor name: ")
             Doctor.search_by_name(name)
         
         elif choice == '2':
-            doctor_id = generate_next_doctor_id()
-            print(f"Auto-generated Doctor ID: {doctor_id}")
             name = input("Enter Name: ")
             specialization = input("Enter Specialization: ")
             contact_no = input("Enter contact no: ")
+            doctor_id = generate_next_doctor_id()
+            print(f"Auto-generated Doctor ID: {doctor_id}")
             doctor = Doctor(doctor_id, name, specialization, contact_no)
             result = doctor.add()
             if result:
@@ -104,10 +131,15 @@ def doctors_menu():
  
         elif choice == '4':
             doctor_id = input("Enter Doctor ID to update: ")
-            name = input("Enter New Name: ")
-            specialization = input("Enter New Specialization: ")
-            contact_no = input("Enter New Contact No: ")
-            Doctor(doctor_id, name, specialization, contact_no).update()
+            current = Doctor.get(doctor_id)
+            if current is None:
+                print(f"Doctor ID '{doctor_id}' not found.")
+            else:
+                print(f"Editing doctor {doctor_id} (version {current.version}).")
+                name = input("Enter New Name: ")
+                specialization = input("Enter New Specialization: ")
+                contact_no = input("Enter New Contact No: ")
+                Doctor(doctor_id, name, specialization, contact_no, current.version).update()
  
         elif choice == '5':
             doctor_id = input("Enter Doctor ID to delete: ")
@@ -121,6 +153,7 @@ def doctors_menu():
 
 # --- Services ---
 def services_menu():
+    from service import Service, generate_next_service_id
     while True:
         print("\n=== Service Management ===")
         print("1. Add Service")
@@ -128,13 +161,13 @@ def services_menu():
         print("3. Update Service")
         print("4. Delete Service")
         print("5. Back to Main Menu")
-        choice = input("Select an option: ")
+        choice = select_option('services_menu')
 
         if choice == '1':
-            service_id = generate_next_service_id()
-            print(f"Auto-generated Service ID: {service_id}")
             service_name = input("Enter Service Name: ")
             cost = input("Enter Cost: ")
+            service_id = generate_next_service_id()
+            print(f"Auto-generated Service ID: {service_id}")
             service = Service(service_id, service_name, cost)
             result = service.add()
             if result:
@@ -147,9 +180,14 @@ def services_menu():
 
         elif choice == '3':
             service_id = input("Enter Service ID to update: ")
-            name = input("Enter New Service Name: ")
-            cost = float(input("Enter New Cost: "))
-            Service(service_id, name, cost).update()
+            current = Service.get(service_id)
+            if current is None:
+                print("Service ID not found.")
+            else:
+                print(f"Editing service {service_id} (version {current.version}).")
+                name = input("Enter New Service Name: ")
+                cost = float(input("Enter New Cost: "))
+                Service(service_id, name, cost, current.version).update()
 
         elif choice == '4':
             service_id = input("Enter Service ID to delete: ")
@@ -163,6 +201,7 @@ def services_menu():
           
 # --- Appointments ---
 def appointments_menu():
+    from appointment import Appointment, generate_next_appointment_id
     while True:
         print("\n=== Appointments Management ===")
         print("1. Add Appointment")
@@ -173,15 +212,23 @@ def appointments_menu():
         print("6. Total Days between Appointments of Patient")
         print("7. Back to Main Menu")
         
-        choice = input("Select an option: ")
+        choice = select_option('appointments_menu')
 
         if choice == '1':
-            appointment_id = generate_next_appointment_id()
-            print(f"Auto-generated Appointment ID: {appointment_id}")
             patient_id = input("Enter Patient ID: ")
-            doctor_id = input("Enter Doctor ID: ")
             date = input("Enter Appointment Date (YYYY-MM-DD): ")
+            doctor_id = input("Enter Doctor ID [leave blank to auto-assign]: ").strip()
+            if not doctor_id:
+                from assignment import least_loaded_doctor
+                specialization = input("Enter Specialization: ")
+                doctor_id = least_loaded_doctor(specialization, date)
+                if doctor_id is None:
+                    print(f"No doctor found with specialization '{specialization}'.")
+                    continue
+                print(f"Assigned least-loaded doctor: {doctor_id}")
             diagnosis = input("Enter Diagnosis: ")
+            appointment_id = generate_next_appointment_id()
+            print(f"Auto-generated Appointment ID: {appointment_id}")
             appointment = Appointment(appointment_id, patient_id, doctor_id, date, diagnosis)
             result = appointment.add()
             if result:
@@ -194,11 +241,16 @@ def appointments_menu():
 
         elif choice == '3':
             appointment_id = input("Enter Appointment ID to update: ")
-            patient_id = input("Enter New Patient ID: ")
-            doctor_id = input("Enter New Doctor ID: ")
-            date = input("Enter New Appointment Date (YYYY-MM-DD): ")
-            diagnosis = input("Enter New Diagnosis: ")
-            Appointment(appointment_id, patient_id, doctor_id, date, diagnosis).update()
+            current = Appointment.get(appointment_id)
+            if current is None:
+                print("Appointment ID not found.")
+            else:
+                print(f"Editing appointment {appointment_id} (version {current.version}).")
+                patient_id = input("Enter New Patient ID: ")
+                doctor_id = input("Enter New Doctor ID: ")
+                date = input("Enter New Appointment Date (YYYY-MM-DD): ")
+                diagnosis = input("Enter New Diagnosis: ")
+                Appointment(appointment_id, patient_id, doctor_id, date, diagnosis, current.version).update()
 
         elif choice == '4':
             appointment_id = input("Enter Appointment ID to delete: ")
@@ -218,6 +270,7 @@ def appointments_menu():
 
 # --- Bill ---
 def billing_menu():
+    from billing import Bill, compute_total_billing, generate_next_bill_id
     while True:
         print("\nBilling Management")
         print("1. Add Bill")
@@ -226,15 +279,17 @@ def billing_menu():
         print("4. Delete Bill")
         print("5. Compute Total Billing")
         print("6. Generate Invoice")
-        print("7. Back to Main Menu")
+        print("7. Adjust Bill Line Items")
+        print("8. View Bill Lines and Adjustments")
+        print("9. Back to Main Menu")
         
-        choice = input("Select an option: ")
+        choice = select_option('billing_menu')
  
         if choice == "1":
-            bill_id = generate_next_bill_id()
-            print(f"Auto-generated Bill ID: {bill_id}")
             patient_id = input("Enter Patient ID: ")
             billing_date = input("Enter Billing Date (YYYY-MM-DD) [leave blank for today]: ")
+            bill_id = generate_next_bill_id()
+            print(f"Auto-generated Bill ID: {bill_id}")
             if not billing_date.strip():
                 bill = Bill(bill_id, patient_id)
             else:
@@ -250,13 +305,18 @@ def billing_menu():
  
         elif choice == "3":
             bill_id = input("Enter Bill ID to update: ")
-            patient_id = input("Enter New Patient ID: ")
-            billing_date = input("Enter New Billing Date (YYYY-MM-DD) [leave blank for today]: ")
-            if not billing_date.strip():
-                bill = Bill(bill_id, patient_id)
+            current = Bill.get(bill_id)
+            if current is None:
+                print("Bill ID not found.")
             else:
-                bill = Bill(bill_id, patient_id, billing_date)
-            bill.update()
+                print(f"Editing bill {bill_id} (version {current.version}).")
+                patient_id = input("Enter New Patient ID: ")
+                billing_date = input("Enter New Billing Date (YYYY-MM-DD) [leave blank for today]: ")
+                if not billing_date.strip():
+                    bill = Bill(bill_id, patient_id, version=current.version)
+                else:
+                    bill = Bill(bill_id, patient_id, billing_date, current.version)
+                bill.update()
  
         elif choice == "4":
             bill_id = input("Enter Bill ID to delete: ")
@@ -275,17 +335,8 @@ def billing_menu():
             invoice_choice = input("Select an option: ")
             if invoice_choice == "1":
                 bill_id = input("Enter Bill ID to generate invoice: ")
-                # Fetch patient_id and billing_date from DB
-                from db_config import get_connection
-                conn = get_connection()
-                cursor = conn.cursor()
-                cursor.execute("SELECT patient_id, billing_date FROM billing WHERE bill_id=%s", (bill_id,))
-                row = cursor.fetchone()
-                cursor.close()
-                conn.close()
-                if row:
-                    patient_id, billing_date = row
-                    bill = Bill(bill_id, patient_id, billing_date)
+                bill = Bill.get(bill_id)
+                if bill:
                     bill.generate_invoice()
                 else:
                     print("Bill not found.")
@@ -293,7 +344,7 @@ def billing_menu():
             elif invoice_choice == "2":
                 patient_id = input("Enter Patient ID to generate invoice: ")
                 from db_config import get_connection
-                conn = get_connection()
+                conn = get_connection(read_only=True)
                 cursor = conn.cursor(dictionary=True)
                 cursor.execute("SELECT bill_id, billing_date FROM billing WHERE patient_id=%s", (patient_id,))
                 bills = cursor.fetchall()
@@ -327,33 +378,130 @@ def billing_menu():
                 print("Invalid option for invoice generation.")
  
         elif choice == "7":
+            bill_id = input("Enter Bill ID to adjust: ")
+            print("1. Add Line Item")
+            print("2. Void Line Item")
+            adjust_choice = input("Select an option: ")
+            if adjust_choice == "1":
+                service_id = input("Enter Service ID: ")
+                cost = input("Enter Cost [leave blank for the service's price]: ").strip()
+                reason = input("Reason: ").strip()
+                Bill.add_line_item(bill_id, service_id, cost or None, reason or None)
+            elif adjust_choice == "2":
+                Bill.line_items(bill_id)
+                line_id = input("Enter Line to void: ")
+                reason = input("Reason: ").strip()
+                Bill.void_line_item(bill_id, line_id, reason or None)
+            else:
+                print("Invalid option for bill adjustment.")
+
+        elif choice == "8":
+            bill_id = input("Enter Bill ID: ")
+            Bill.line_items(bill_id)
+            print()
+            Bill.adjustments(bill_id)
+
+        elif choice == "9":
             break
  
         else:
             print("Invalid Choice. Please try again.")
 
 def export_menu():
+    from appointment import Appointment
+    from billing import Bill
+    from archive import archive_old_records, ARCHIVE_RETENTION_DAYS
+    from columnar_export import export_columnar, COLUMNAR_EXPORTS
     while True:
         print("\n=== Export Management ===")
         print("1. Export Billing Summary to CSV")
         print("2. Export Appointment Summary to CSV")
-        print("3. Back to Main Menu")
+        print("3. Columnar Export for Analytics (Parquet/Arrow)")
+        print("4. Archive Old Appointments and Bills")
+        print("5. Back to Main Menu")
         
-        choice = input("Select an option: ")
+        choice = select_option('export_menu')
         
         if choice == '1':
             filename = input("Enter filename for billing summary (default: billing_summary.csv): ").strip() or "billing_summary.csv"
             if not filename.lower().endswith(".csv"):
                 filename += ".csv"
-            Bill.export_billing_summary_to_csv(filename)
+            include_archived = input("Include archived records? (y/N): ").strip().lower() == 'y'
+            Bill.export_billing_summary_to_csv(filename, include_archived)
             
         elif choice == '2':
             filename = input("Enter filename for appointment summary (default: appointment_summary.csv): ").strip() or "appointment_summary.csv"
             if not filename.lower().endswith(".csv"):
                 filename += ".csv"
-            Appointment.export_appointment_summary_to_csv(filename)
-            
+            include_archived = input("Include archived records? (y/N): ").strip().lower() == 'y'
+            Appointment.export_appointment_summary_to_csv(filename, include_archived)
+
         elif choice == '3':
+            table = input(f"Table to export ({', '.join(COLUMNAR_EXPORTS)}): ").strip()
+            filename = input(f"Enter filename (default: {table}.parquet, use .arrow for Arrow IPC): ").strip() or f"{table}.parquet"
+            include_archived = input("Include archived records? (y/N): ").strip().lower() == 'y'
+            export_columnar(table, filename, include_archived=include_archived)
+
+        elif choice == '4':
+            days = input(f"Archive records older than how many days? (default: {ARCHIVE_RETENTION_DAYS}): ").strip()
+            if days and not days.isdigit():
+                print("Invalid number of days.")
+            else:
+                archive_old_records(int(days) if days else ARCHIVE_RETENTION_DAYS)
+
+        elif choice == '5':
+            break
+        else:
+            print("Invalid choice.")
+
+def reports_menu():
+    from reports import REPORTS, REPORT_WORKERS, print_report
+    names = list(REPORTS)
+    while True:
+        print("\n=== Reports ===")
+        for idx, name in enumerate(names, 1):
+            print(f"{idx}. {REPORTS[name]['title']}")
+        print(f"{len(names) + 1}. In-memory Analytics")
+        print(f"{len(names) + 2}. Back to Main Menu")
+
+        choice = select_option('reports_menu')
+
+        if choice.isdigit() and 1 <= int(choice) <= len(names):
+            start = input("Start date (YYYY-MM-DD) [leave blank for all history]: ").strip()
+            end = input("End date, exclusive (YYYY-MM-DD) [leave blank for all history]: ").strip()
+            workers = input(f"Parallel workers (default: {REPORT_WORKERS}): ").strip()
+            include_archived = input("Include archived records? (y/N): ").strip().lower() == 'y'
+            try:
+                start = datetime.date.fromisoformat(start) if start else None
+                end = datetime.date.fromisoformat(end) if end else None
+            except ValueError:
+                print("Invalid Date. Use YYYY-MM-DD format.")
+                continue
+            print_report(names[int(choice) - 1], start=start, end=end,
+                         workers=int(workers) if workers.isdigit() else REPORT_WORKERS,
+                         include_archived=include_archived)
+
+        elif choice == str(len(names) + 1):
+            # The cache is loaded on first use and kept current, so later queries don't touch the tables
+            from analytics import ANALYTICS_QUERIES, print_query
+            queries = list(ANALYTICS_QUERIES)
+            for idx, name in enumerate(queries, 1):
+                print(f"{idx}. {ANALYTICS_QUERIES[name]['title']}")
+            pick = input("Select a query: ").strip()
+            if not (pick.isdigit() and 1 <= int(pick) <= len(queries)):
+                print("Invalid choice.")
+                continue
+            start = input("Start date (YYYY-MM-DD) [leave blank for all history]: ").strip()
+            end = input("End date, exclusive (YYYY-MM-DD) [leave blank for all history]: ").strip()
+            try:
+                start = datetime.date.fromisoformat(start) if start else None
+                end = datetime.date.fromisoformat(end) if end else None
+            except ValueError:
+                print("Invalid Date. Use YYYY-MM-DD format.")
+                continue
+            print_query(queries[int(pick) - 1], start, end)
+
+        elif choice == str(len(names) + 2):
             break
         else:
             print("Invalid choice.")
@@ -367,9 +515,10 @@ def main_menu():
         print("4. Appointment Management")
         print("5. Billing Management")
         print("6. Export Management")
-        print("7. Exit")
+        print("7. Reports")
+        print("8. Exit")
         
-        choice = input("Select an option: ")
+        choice = select_option('main_menu')
 
         if choice == '1':
             patients_menu()
@@ -384,10 +533,20 @@ def main_menu():
         elif choice == '6':
             export_menu()
         elif choice == '7':
+            reports_menu()
+        elif choice == '8':
             print("Exiting Hospital Management CLI. Bye!")
             break
         else:
             print("Invalid choice. Please try again.")
 
 if __name__ == "__main__":
+    import sys
+    from profiler import enable, profiling_requested
+    profile = profiling_requested(sys.argv)
+    if len(sys.argv) > 1:
+        from commands import main
+        sys.exit(main(sys.argv[1:]))
+    if profile:
+        enable()
     main_menu()
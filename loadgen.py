@@ -0,0 +1,289 @@
+import argparse
+import datetime
+import io
+import random
+import sys
+import threading
+import time
+from collections import defaultdict
+
+# Front-desk load generator: N terminal threads replay a weighted mix of operations through
+# the entity classes, exactly as the menus call them, and the run is summarised per operation.
+#   python loadgen.py --terminals 50 --duration 60
+#   python loadgen.py --ramp 5,10,25,50 --duration 30 --slo-ms 250
+DEFAULT_MIX = {'register': 2, 'book': 3, 'record_service': 4, 'bill': 1, 'update': 1}
+
+# Entity methods report failures by printing; the message decides how a failure is counted
+FAILURE_KINDS = [
+    ('id_collision', ('Duplicate',)),
+    ('deadlock', ('Deadlock', '1213')),
+    ('lock_timeout', ('Lock wait timeout', '1205')),
+    ('conflict', ('Update conflict',)),
+]
+
+class _ThreadStdout(io.TextIOBase):
+    # Stands in for sys.stdout so each terminal thread's prints go to its own buffer;
+    # contextlib.redirect_stdout swaps the global stream and can't be used from threads
+    def __init__(self, real):
+        self.real = real
+        self.local = threading.local()
+
+    def write(self, text):
+        buffer = getattr(self.local, 'buffer', None)
+        return (self.real if buffer is None else buffer).write(text)
+
+    def flush(self):
+        self.real.flush()
+
+    def capture(self):
+        self.local.buffer = io.StringIO()
+
+    def release(self):
+        buffer, self.local.buffer = self.local.buffer, None
+        return buffer.getvalue()
+
+def _percentile(values, pct):
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, max(0, int(round(pct / 100 * len(values))) - 1))
+    return values[index]
+
+class LoadRun:
+    def __init__(self, terminals, duration, mix, seed=None):
+        self.terminals = terminals
+        self.duration = duration
+        self.ops = list(mix)
+        self.weights = [mix[op] for op in self.ops]
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)                      # op -> [seconds]
+        self.outcomes = defaultdict(lambda: defaultdict(int))   # op -> outcome -> count
+        self.samples = defaultdict(list)                        # outcome -> first few messages
+        self.patients = []
+        self.created_patients = []
+        self.doctors = []
+        self.services = []
+
+    # --- Setup ---
+    def seed_reference_data(self):
+        from db_config import get_connection
+        conn = get_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT patient_id FROM patients WHERE deleted_at IS NULL ORDER BY patient_id DESC LIMIT 200")
+            self.patients = [str(row[0]) for row in cursor.fetchall()]
+            cursor.execute("SELECT doctor_id FROM doctors WHERE deleted_at IS NULL LIMIT 50")
+            self.doctors = [row[0] for row in cursor.fetchall()]
+            cursor.execute("SELECT service_id, service_name, cost FROM services LIMIT 50")
+            self.services = cursor.fetchall()
+        finally:
+            cursor.close()
+            conn.close()
+        if not self.doctors or not self.services:
+            raise RuntimeError("Load test needs at least one doctor and one service in the database.")
+
+    # --- Operations: each returns the entity method's result ---
+    def _pick_patient(self, rng):
+        with self.lock:
+            return rng.choice(self.patients) if self.patients else None
+
+    def op_register(self, rng):
+        from patient import Patient, generate_next_patient_id
+        patient_id = generate_next_patient_id()
+        contact_no = str(9000000000 + rng.randrange(10 ** 9))
+        ok = Patient(patient_id, "Load Test", rng.randint(1, 90), rng.choice(['M', 'F', 'Other']),
+                     datetime.date.today().isoformat(), contact_no).add()
+        if ok:
+            with self.lock:
+                self.patients.append(str(patient_id))
+                self.created_patients.append(str(patient_id))
+        return ok
+
+    def op_book(self, rng):
+        from appointment import Appointment, generate_next_appointment_id
+        patient_id = self._pick_patient(rng)
+        if patient_id is None:
+            return self.op_register(rng)
+        return Appointment(generate_next_appointment_id(), patient_id, rng.choice(self.doctors),
+                           datetime.date.today().isoformat(), "Load test").add()
+
+    def op_record_service(self, rng):
+        from service import Service, ServiceUsageDB
+        patient_id = self._pick_patient(rng)
+        if patient_id is None:
+            return self.op_register(rng)
+        ServiceUsageDB.add_service_for_patient(patient_id, Service(*rng.choice(self.services)))
+        return None  # success is read from the output
+
+    def op_bill(self, rng):
+        from billing import Bill, generate_next_bill_id
+        patient_id = self._pick_patient(rng)
+        if patient_id is None:
+            return self.op_register(rng)
+        return Bill(generate_next_bill_id(), patient_id).add()
+
+    def op_update(self, rng):
+        # Read-modify-write with the version, so lost races show up as conflicts
+        from patient import Patient
+        patient_id = self._pick_patient(rng)
+        current = Patient.get(patient_id) if patient_id else None
+        if current is None:
+            return False
+        current.age = min(int(current.age or 0) + 1, 120)
+        return current.update()
+
+    # --- Running ---
+    def _classify(self, op, result, output):
+        if op == 'record_service':
+            result = 'Added ' in output
+        if result:
+            return 'ok'
+        for kind, markers in FAILURE_KINDS:
+            if any(marker in output for marker in markers):
+                return kind
+        return 'error'
+
+    def _terminal(self, index, deadline, stdout):
+        rng = random.Random(self.random.random() + index)
+        while time.monotonic() < deadline:
+            op = rng.choices(self.ops, self.weights)[0]
+            stdout.capture()
+            started = time.perf_counter()
+            try:
+                result = getattr(self, 'op_' + op)(rng)
+            except Exception as e:
+                print("Unhandled:", e)
+                result = False
+            elapsed = time.perf_counter() - started
+            output = stdout.release()
+            outcome = self._classify(op, result, output)
+            with self.lock:
+                self.latencies[op].append(elapsed)
+                self.outcomes[op][outcome] += 1
+                if outcome != 'ok' and len(self.samples[outcome]) < 3:
+                    self.samples[outcome].append(output.strip().splitlines()[-1] if output.strip() else op)
+
+    def run(self):
+        from retry import retry_stats
+        self.retries_before = retry_stats()
+        stdout = _ThreadStdout(sys.stdout)
+        sys.stdout = stdout
+        try:
+            deadline = time.monotonic() + self.duration
+            started = time.monotonic()
+            threads = [threading.Thread(target=self._terminal, args=(i, deadline, stdout), daemon=True)
+                       for i in range(self.terminals)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.elapsed = time.monotonic() - started
+            # Deadlocks and lock timeouts retried inside operations: slower, but not failures
+            after = retry_stats()
+            self.retries = {key: after[key] - self.retries_before[key] for key in ('retries', 'retried_operations', 'gave_up')}
+        finally:
+            sys.stdout = stdout.real
+        return self.summary()
+
+    def summary(self):
+        all_latencies = sorted(l for values in self.latencies.values() for l in values)
+        total = len(all_latencies)
+        outcomes = defaultdict(int)
+        for per_op in self.outcomes.values():
+            for outcome, count in per_op.items():
+                outcomes[outcome] += count
+        return {
+            'terminals': self.terminals,
+            'operations': total,
+            'throughput': total / self.elapsed if self.elapsed else 0.0,
+            'p50_ms': _percentile(all_latencies, 50) * 1000,
+            'p95_ms': _percentile(all_latencies, 95) * 1000,
+            'p99_ms': _percentile(all_latencies, 99) * 1000,
+            'error_rate': (total - outcomes['ok']) / total if total else 0.0,
+            'conflict_rate': outcomes['conflict'] / total if total else 0.0,
+            'retries': self.retries['retries'],
+            'outcomes': dict(outcomes),
+        }
+
+    def print_report(self):
+        print(f"\n{self.terminals} terminal(s), {self.elapsed:.1f}s")
+        print("Operation | Count | OK | Failures | p50 ms | p95 ms | p99 ms")
+        for op in self.ops:
+            latencies = sorted(self.latencies[op])
+            if not latencies:
+                continue
+            outcomes = self.outcomes[op]
+            failures = ", ".join(f"{kind}={count}" for kind, count in sorted(outcomes.items()) if kind != 'ok') or "-"
+            print(f"{op} | {len(latencies)} | {outcomes['ok']} | {failures} | "
+                  f"{_percentile(latencies, 50) * 1000:.1f} | {_percentile(latencies, 95) * 1000:.1f} | "
+                  f"{_percentile(latencies, 99) * 1000:.1f}")
+        s = self.summary()
+        print(f"Total: {s['operations']} ops, {s['throughput']:.1f} ops/s, p50 {s['p50_ms']:.1f} ms, "
+              f"p95 {s['p95_ms']:.1f} ms, p99 {s['p99_ms']:.1f} ms, "
+              f"errors {s['error_rate']:.1%}, conflicts {s['conflict_rate']:.1%}")
+        print(f"Retries: {self.retries['retries']} in {self.retries['retried_operations']} operation(s), "
+              f"{self.retries['gave_up']} gave up")
+        for outcome, messages in self.samples.items():
+            print(f"  e.g. {outcome}: {' | '.join(messages)}")
+
+def cleanup(patient_ids):
+    # Soft-deletes the patients the run registered; purge.py removes their rows later
+    from patient import Patient
+    stdout = sys.stdout
+    sys.stdout = io.StringIO()
+    try:
+        for patient_id in patient_ids:
+            Patient.delete(patient_id)
+    finally:
+        sys.stdout = stdout
+    print(f"Soft-deleted {len(patient_ids)} load-test patient(s).")
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        op, _, weight = part.partition('=')
+        if op.strip() not in DEFAULT_MIX:
+            raise ValueError(f"Unknown operation '{op.strip()}'. Choose from: {', '.join(DEFAULT_MIX)}")
+        mix[op.strip()] = float(weight or 1)
+    return mix
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Replay a concurrent front-desk workload against the database.")
+    parser.add_argument('--terminals', type=int, default=50)
+    parser.add_argument('--duration', type=float, default=30, help="Seconds per run (per level with --ramp)")
+    parser.add_argument('--mix', default=",".join(f"{k}={v}" for k, v in DEFAULT_MIX.items()),
+                        help="Weighted operations, e.g. register=2,book=3,record_service=4,bill=1,update=1")
+    parser.add_argument('--ramp', help="Comma-separated terminal counts to find the capacity limit, e.g. 5,10,25,50")
+    parser.add_argument('--slo-ms', type=float, default=500, help="p99 latency a level must stay under to count as sustainable")
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--cleanup', action='store_true', help="Soft-delete the patients registered by the run")
+    args = parser.parse_args(argv)
+
+    mix = parse_mix(args.mix)
+    levels = [int(x) for x in args.ramp.split(',')] if args.ramp else [args.terminals]
+    results, created = [], []
+    for terminals in levels:
+        run = LoadRun(terminals, args.duration, mix, args.seed)
+        run.seed_reference_data()
+        results.append(run.run())
+        run.print_report()
+        created += run.created_patients
+
+    if len(results) > 1:
+        # Capacity: the most throughput reached while p99 stays within the SLO and errors stay rare
+        print("\nTerminals | ops/s | p99 ms | errors")
+        for r in results:
+            print(f"{r['terminals']} | {r['throughput']:.1f} | {r['p99_ms']:.1f} | {r['error_rate']:.1%}")
+        sustainable = [r for r in results if r['p99_ms'] <= args.slo_ms and r['error_rate'] < 0.01]
+        if sustainable:
+            best = max(sustainable, key=lambda r: r['throughput'])
+            print(f"Capacity: {best['throughput']:.1f} ops/s at {best['terminals']} terminals "
+                  f"(p99 {best['p99_ms']:.1f} ms <= {args.slo_ms:.0f} ms)")
+        else:
+            print(f"Capacity: no level kept p99 under {args.slo_ms:.0f} ms with under 1% errors")
+    if args.cleanup:
+        cleanup(created)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
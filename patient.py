@@ -1,4 +1,11 @@
-from db_config import get_connection
+from db_config import get_connection, prepared_cursor, row_version
+from retry import retrying
+import history
+from changelog import record_change
+from bulk import BULK_CHUNK_SIZE, upsert_rows, format_counts
+from assignment import load_index
+from contacts import MAX_CONTACT_DIGITS, index_contact, index_contacts, unindex_contact
+from dedup import name_key
 from datetime import datetime, date
 from person import Person
 import re
@@ -6,47 +13,60 @@ import mysql.connector
 from mysql.connector import IntegrityError, Error
 
 class Patient(Person):
-    def __init__(self, patient_id, name, age, gender, admission_date, contact_no):
+    def __init__(self, patient_id, name, age, gender, admission_date, contact_no, version=None):
         super().__init__(patient_id, name, contact_no)
         self.patient_id = patient_id
         self.age = age
         self.gender = gender
         self.admission_date = admission_date
+        # Row version as last read; update() only applies if the row still has it
+        self.version = version
+        self.conflict = False
+        self.current_version = None
 
-    def add(self):
+    def _validate(self):
+        # Returns the first validation error, or None if the patient can be saved
         # Name validation
         if not self.name or not re.match(r'^[A-Za-z. ]+$', self.name):
-            print("Invalid Name. Only letters, spaces, and periods allowed.")
-            return False
+            return "Invalid Name. Only letters, spaces, and periods allowed."
         # Age validation
         try:
             age = int(self.age)
             if age < 0 or age > 120:
-                print("Invalid Age. Must be between 0 and 120.")
-                return False
-        except ValueError:
-            print("Invalid Age. Must be a number.")
-            return False
+                return "Invalid Age. Must be between 0 and 120."
+        except (TypeError, ValueError):
+            return "Invalid Age. Must be a number."
         # Gender validation
         if self.gender not in ['M', 'F', 'Other']:
-            print("Invalid Gender. Choose from M, F, Other.")
-            return False
+            return "Invalid Gender. Choose from M, F, Other."
         # Admission date validation
-        if not re.match(r'^\d{4}-\d{2}-\d{2}$', self.admission_date):
-            print("Invalid Admission Date. Use YYYY-MM-DD format.")
-            return False
+        try:
+            datetime.strptime(self.admission_date, "%Y-%m-%d")
+        except (TypeError, ValueError):
+            return "Invalid Admission Date. Use YYYY-MM-DD format."
         # Contact number validation
-        if not self.contact_no.isdigit() or len(self.contact_no) < 10:
-            print("Invalid Contact Number. Must be at least 10 digits.")
+        if not self.contact_no.isdigit() or not 10 <= len(self.contact_no) <= MAX_CONTACT_DIGITS:
+            return f"Invalid Contact Number. Must be 10 to {MAX_CONTACT_DIGITS} digits."
+        return None
+
+    @retrying
+    def add(self):
+        error = self._validate()
+        if error:
+            print(error)
             return False
+        age = int(self.age)
 
         # Insert into DB with exception handling
         try:
             conn = get_connection()
-            cursor = conn.cursor()
-            sql = "INSERT INTO patients (patient_id, name, age, gender, admission_date, contact_no) VALUES (%s, %s, %s, %s, %s, %s)"
-            cursor.execute(sql, (self.patient_id, self.name, age, self.gender, self.admission_date, self.contact_no))
+            sql = "INSERT INTO patients (patient_id, name, age, gender, admission_date, contact_no, name_key) VALUES (%s, %s, %s, %s, %s, %s, %s)"
+            cursor = prepared_cursor(conn, sql)
+            cursor.execute(sql, (self.patient_id, self.name, age, self.gender, self.admission_date, self.contact_no, name_key(self.name)))
+            record_change(conn, 'patient', self.patient_id, 'insert', {'name': self.name, 'age': age, 'gender': self.gender, 'admission_date': self.admission_date, 'contact_no': self.contact_no})
+            index_contact(conn, 'patient', self.patient_id, self.name, self.contact_no)
             conn.commit()
+            history.invalidate(self.patient_id)
             return True
         except mysql.connector.errors.IntegrityError as e:
             if "PRIMARY" in str(e):
@@ -58,50 +78,52 @@ class Patient(Person):
             print("Unexpected error while adding patient:", e)
             return False
         finally:
-            if 'cursor' in locals(): cursor.close()
             if 'conn' in locals(): conn.close()
 
+    @retrying
     def update(self):
-        # Name validation
-        if not self.name or not re.match(r'^[A-Za-z. ]+$', self.name):
-            print("Invalid Name. Only letters, spaces, and periods allowed.")
+        error = self._validate()
+        if error:
+            print(error)
             return False
-        # Age validation
+        age = int(self.age)
+        # Version validation (no version means overwrite unconditionally)
         try:
-            age = int(self.age)
-            if age < 0 or age > 120:
-                print("Invalid Age. Must be between 0 and 120.")
-                return False
-        except ValueError:
-            print("Invalid Age. Must be a number.")
-            return False
-        # Gender validation
-        if self.gender not in ['M', 'F', 'Other']:
-            print("Invalid Gender. Choose from M, F, Other.")
-            return False
-        # Admission date validation
-        try:
-            datetime.strptime(self.admission_date, "%Y-%m-%d")
+            version = None if self.version is None else int(self.version)
         except ValueError:
-            print("Invalid Admission Date. Use YYYY-MM-DD format.")
-            return False
-        # Contact number validation
-        if not self.contact_no.isdigit() or len(self.contact_no) < 10:
-            print("Invalid Contact Number. Must be at least 10 digits.")
+            print("Invalid Version. Must be a number.")
             return False
 
+        self.conflict = False
         try:
             conn = get_connection()
-            cursor = conn.cursor()
-            sql = """UPDATE patients SET name=%s, age=%s, gender=%s, admission_date=%s, contact_no=%s WHERE patient_id=%s"""
-            cursor.execute(sql, (self.name, age, self.gender, self.admission_date, self.contact_no, self.patient_id))
-            conn.commit()
+            params = (self.name, age, self.gender, self.admission_date, self.contact_no, name_key(self.name), self.patient_id)
+            if version is None:
+                sql = """UPDATE patients SET name=%s, age=%s, gender=%s, admission_date=%s, contact_no=%s, name_key=%s, version=version+1 WHERE patient_id=%s AND deleted_at IS NULL"""
+            else:
+                # Compare-and-set: matches only if nobody has updated the row since it was read
+                sql = """UPDATE patients SET name=%s, age=%s, gender=%s, admission_date=%s, contact_no=%s, name_key=%s, version=version+1 WHERE patient_id=%s AND deleted_at IS NULL AND version=%s"""
+                params += (version,)
+            cursor = prepared_cursor(conn, sql)
+            cursor.execute(sql, params)
             if cursor.rowcount == 0:
-                print(f"No patient found with ID '{self.patient_id}'.")
+                current = row_version(conn, 'patients', 'patient_id', self.patient_id, 'deleted_at IS NULL')
+                if current is None:
+                    print(f"No patient found with ID '{self.patient_id}'.")
+                else:
+                    self.conflict = True
+                    self.current_version = current
+                    print(f"Update conflict: patient '{self.patient_id}' was changed by someone else "
+                          f"(your version {version}, current version {current}). Reload it and try again.")
                 return False
-            else:
-                print("Patient updated successfully.")
-                return True
+            record_change(conn, 'patient', self.patient_id, 'update', {'name': self.name, 'age': age, 'gender': self.gender, 'admission_date': self.admission_date, 'contact_no': self.contact_no})
+            index_contact(conn, 'patient', self.patient_id, self.name, self.contact_no)
+            conn.commit()
+            history.invalidate(self.patient_id)
+            if version is not None:
+                self.version = version + 1
+            print("Patient updated successfully.")
+            return True
         except mysql.connector.errors.IntegrityError as e:
             print("Database integrity error: ", e)
             return False
@@ -109,17 +131,26 @@ class Patient(Person):
             print("Unexpected error while updating patient:", e)
             return False
         finally:
-            if 'cursor' in locals(): cursor.close()
             if 'conn' in locals(): conn.close()
 
     @staticmethod
+    @retrying
     def delete(patient_id):
+        # Soft delete: the row is hidden at once and purge.py removes it with its appointments
+        # and bills in small batches, instead of one cascading DELETE holding locks on all of them
         try:
             conn = get_connection()
-            cursor = conn.cursor()
-            sql = "DELETE FROM patients WHERE patient_id=%s"
+            sql = "UPDATE patients SET deleted_at = CURRENT_TIMESTAMP, version = version + 1 WHERE patient_id=%s AND deleted_at IS NULL"
+            cursor = prepared_cursor(conn, sql)
             cursor.execute(sql, (patient_id,))
+            if cursor.rowcount:
+                record_change(conn, 'patient', patient_id, 'delete')
+                unindex_contact(conn, 'patient', patient_id)
             conn.commit()
+            history.invalidate(patient_id)
+            if cursor.rowcount:
+                # The patient's appointments no longer count towards doctor load
+                load_index.invalidate()
             if cursor.rowcount == 0:
                 print(f"No patient found with ID '{patient_id}'.")
                 return False
@@ -133,17 +164,61 @@ class Patient(Person):
             print("Unexpected error while deleting patient:", e)
             return False
         finally:
-            if 'cursor' in locals(): cursor.close()
             if 'conn' in locals(): conn.close()
 
     @staticmethod
-    def view():
+    def get(patient_id):
+        # Reads the primary, so the version is current enough to update with
         try:
             conn = get_connection()
+            sql = "SELECT patient_id, name, age, gender, admission_date, contact_no, version FROM patients WHERE patient_id=%s AND deleted_at IS NULL"
+            cursor = prepared_cursor(conn, sql)
+            cursor.execute(sql, (patient_id,))
+            rows = cursor.fetchall()
+            if not rows:
+                return None
+            patient_id, name, age, gender, admission_date, contact_no, version = rows[0]
+            return Patient(patient_id, name, age, gender, str(admission_date), contact_no, version)
+        except Error as e:
+            print("Database error while fetching patient:", e)
+            return None
+        finally:
+            if 'conn' in locals(): conn.close()
+
+    @staticmethod
+    def bulk_upsert(rows, chunk_size=BULK_CHUNK_SIZE):
+        # Registration feed sync: rows are dicts with patient_id, name, age, gender,
+        # admission_date and contact_no. Safe to re-run; returns inserted/updated/unchanged/failed/invalid counts.
+        valid, invalid = [], 0
+        for row in rows:
+            patient = Patient(row.get('patient_id'), row.get('name'), row.get('age'), row.get('gender'),
+                              row.get('admission_date'), row.get('contact_no'))
+            error = None if str(patient.patient_id).isdigit() else "Invalid Patient ID."
+            error = error or patient._validate()
+            if error:
+                print(f"Skipped patient '{patient.patient_id}': {error}")
+                invalid += 1
+                continue
+            # Values in the types the driver returns, so unchanged rows compare equal
+            admission_date = datetime.strptime(patient.admission_date, "%Y-%m-%d").date()
+            valid.append((int(patient.patient_id), (patient.name, int(patient.age), patient.gender, admission_date, patient.contact_no, name_key(patient.name))))
+        counts = upsert_rows('patients', 'patient', 'patient_id', ('name', 'age', 'gender', 'admission_date', 'contact_no', 'name_key'), valid, chunk_size,
+                             lambda conn, written: index_contacts(conn, 'patient', [(key, v[0], v[4]) for key, v in written]),
+                             deleted_column='deleted_at')
+        counts['invalid'] = invalid
+        if counts['inserted'] or counts['updated']:
+            history.invalidate()
+        print("Patient sync:", format_counts(counts))
+        return counts
+
+    @staticmethod
+    def view():
+        try:
+            conn = get_connection(read_only=True)
             cursor = conn.cursor()
-            cursor.execute("SELECT * FROM patients")
+            cursor.execute("SELECT patient_id, name, age, gender, admission_date, contact_no, version FROM patients WHERE deleted_at IS NULL")
             rows = cursor.fetchall()
-            print("Patient_ID | Name | Age | Gender | Admission Date | Contact No")
+            print("Patient_ID | Name | Age | Gender | Admission Date | Contact No | Version")
             for row in rows:
                 print(" | ".join(str(x) for x in row))
         except Error as e:
@@ -156,10 +231,10 @@ class Patient(Person):
 
     @staticmethod
     def days_admitted(patient_id):
-        conn = get_connection()
+        conn = get_connection(read_only=True)
         cursor = conn.cursor()
         try:
-            cursor.execute("SELECT admission_date FROM patients WHERE patient_id=%s", (patient_id,))
+            cursor.execute("SELECT admission_date FROM patients WHERE patient_id=%s AND deleted_at IS NULL", (patient_id,))
             row = cursor.fetchone()
             if row and row[0]:
                 admission_date = row[0]
@@ -179,14 +254,15 @@ class Patient(Person):
 
     @staticmethod
     def search_by_name(name_substring):
-        conn = get_connection()
+        conn = get_connection(read_only=True)
         cursor = conn.cursor()
         try:
             search_pattern = f"%{name_substring}%"
-            cursor.execute("SELECT * FROM patients WHERE name LIKE %s", (search_pattern,))
+            cursor.execute("SELECT patient_id, name, age, gender, admission_date, contact_no, version FROM patients "
+                           "WHERE name LIKE %s AND deleted_at IS NULL", (search_pattern,))
             rows = cursor.fetchall()
             if rows:
-                print("Patient_ID | Name | Age | Gender | Admission Date | Contact No")
+                print("Patient_ID | Name | Age | Gender | Admission Date | Contact No | Version")
                 for row in rows:
                     print(" | ".join(str(x) for x in row))
             else:
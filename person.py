@@ -1,8 +1,11 @@
+from contacts import normalize_contact
+
 class Person:
     def __init__(self, person_id, name, contact_no):
         self.person_id = person_id
         self.name = name
-        self.contact_no = contact_no
+        # Stored as digits only whatever format was typed, so lookups can match it
+        self.contact_no = normalize_contact(contact_no)
         
         
 
@@ -0,0 +1,168 @@
+import os
+import time
+
+# Per-action profiling for the interactive menus, switched on with `hospital_main.py --profile`
+# or HOSPITAL_PROFILE=1. Each menu choice is profiled from the moment it is picked until the
+# next menu prompt; time spent waiting at the action's own prompts is left out.
+PROFILE_DIR = os.environ.get('HOSPITAL_PROFILE_DIR', os.path.join("output", "profiles"))
+PROFILE_TOP = int(os.environ.get('HOSPITAL_PROFILE_TOP', '15'))
+TRACEMALLOC_FRAMES = int(os.environ.get('HOSPITAL_PROFILE_FRAMES', '1'))
+
+_session = None
+
+def profiling_requested(argv):
+    # Strips --profile from argv in place; True if it was there or HOSPITAL_PROFILE is set
+    requested = '--profile' in argv
+    while '--profile' in argv:
+        argv.remove('--profile')
+    return requested or os.environ.get('HOSPITAL_PROFILE', '').strip().lower() in ('1', 'true', 'yes', 'y')
+
+def _slug(text):
+    import re
+    return re.sub(r'[^A-Za-z0-9]+', '-', text).strip('-') or 'blank'
+
+def _snapshot(tracemalloc):
+    # The profiler's own bookkeeping is left out of the allocation diffs
+    return tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, __file__),
+        tracemalloc.Filter(False, "*cProfile.py"),
+    ))
+
+class ProfileSession:
+    def __init__(self, directory=PROFILE_DIR):
+        import builtins
+        import tracemalloc
+        self.directory = os.path.join(directory, time.strftime("%Y%m%d-%H%M%S"))
+        os.makedirs(self.directory, exist_ok=True)
+        self.builtins = builtins
+        self.real_input = builtins.input
+        self.sequence = 0
+        self.current = None
+        self.actions = {}       # label -> {'runs', 'wall', 'cpu', 'max_wall', 'peak'}
+        self.allocations = {}   # "file:line" -> [net bytes, net blocks] over all actions
+        self.stat_files = []
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+
+    def _prompt(self, prompt=''):
+        # Replaces input() while an action runs: the profiler and the clock stop at the prompt
+        action = self.current
+        action['profile'].disable()
+        waited = time.perf_counter()
+        try:
+            return self.real_input(prompt)
+        finally:
+            action['waiting'] += time.perf_counter() - waited
+            action['profile'].enable()
+
+    def start(self, menu, choice):
+        import cProfile
+        import tracemalloc
+        self.stop()
+        self.sequence += 1
+        tracemalloc.reset_peak()
+        self.current = {
+            'label': f"{menu}:{choice}",
+            'file': f"{self.sequence:03d}_{_slug(menu)}_{_slug(choice)}",
+            'snapshot': _snapshot(tracemalloc),
+            'traced': tracemalloc.get_traced_memory()[0],
+            'profile': cProfile.Profile(),
+            'waiting': 0.0,
+            'cpu': time.process_time(),
+            'wall': time.perf_counter(),
+        }
+        self.builtins.input = self._prompt
+        self.current['profile'].enable()
+
+    def stop(self):
+        import tracemalloc
+        action = self.current
+        if action is None:
+            return
+        action['profile'].disable()
+        wall = time.perf_counter() - action['wall'] - action['waiting']
+        cpu = time.process_time() - action['cpu']
+        self.builtins.input = self.real_input
+        self.current = None
+        # Peak is measured above what was already allocated when the action started
+        peak = max(tracemalloc.get_traced_memory()[1] - action['traced'], 0)
+        diff = _snapshot(tracemalloc).compare_to(action['snapshot'], 'lineno')
+
+        base = os.path.join(self.directory, action['file'])
+        action['profile'].dump_stats(base + '.prof')
+        self.stat_files.append(base + '.prof')
+        with open(base + '.alloc.txt', 'w', encoding='utf-8') as f:
+            f.write(f"{action['label']}: {wall * 1000:.1f} ms wall, {cpu * 1000:.1f} ms CPU, "
+                    f"peak +{peak / 1024:.1f} KiB\n")
+            for stat in diff[:PROFILE_TOP]:
+                f.write(f"{stat}\n")
+        for stat in diff:
+            site = str(stat.traceback)
+            totals = self.allocations.setdefault(site, [0, 0])
+            totals[0] += stat.size_diff
+            totals[1] += stat.count_diff
+
+        totals = self.actions.setdefault(action['label'], {'runs': 0, 'wall': 0.0, 'cpu': 0.0, 'max_wall': 0.0, 'peak': 0})
+        totals['runs'] += 1
+        totals['wall'] += wall
+        totals['cpu'] += cpu
+        totals['max_wall'] = max(totals['max_wall'], wall)
+        totals['peak'] = max(totals['peak'], peak)
+
+    def summary(self):
+        import io
+        import pstats
+        self.stop()
+        lines = [f"\n=== Profile summary ({self.directory}) ==="]
+        if not self.actions:
+            lines.append("No actions were profiled.")
+            return "\n".join(lines)
+        lines.append("Action | Runs | Total ms | Mean ms | Max ms | CPU ms | Peak +KiB")
+        for label, t in sorted(self.actions.items(), key=lambda item: -item[1]['wall']):
+            lines.append(f"{label} | {t['runs']} | {t['wall'] * 1000:.1f} | {t['wall'] * 1000 / t['runs']:.1f} | "
+                         f"{t['max_wall'] * 1000:.1f} | {t['cpu'] * 1000:.1f} | {t['peak'] / 1024:.1f}")
+
+        stream = io.StringIO()
+        stats = pstats.Stats(*self.stat_files, stream=stream)
+        stats.dump_stats(os.path.join(self.directory, 'session.prof'))
+        stats.sort_stats('cumulative').print_stats(PROFILE_TOP)
+        lines.append(f"\nTop {PROFILE_TOP} functions by cumulative time:")
+        text = stream.getvalue()
+        # Drop pstats' list of input files, keep the totals line and the table
+        lines.append(text[text.rfind("\n", 0, text.find("function calls")) + 1:].rstrip())
+
+        lines.append(f"\nTop {PROFILE_TOP} allocation sites by net growth:")
+        growth = sorted(self.allocations.items(), key=lambda item: -item[1][0])[:PROFILE_TOP]
+        for site, (size, count) in growth:
+            if size <= 0:
+                break
+            lines.append(f"{site}: +{size / 1024:.1f} KiB in {count:+d} blocks")
+        return "\n".join(lines)
+
+    def close(self):
+        import tracemalloc
+        report = self.summary()
+        with open(os.path.join(self.directory, 'summary.txt'), 'w', encoding='utf-8') as f:
+            f.write(report.lstrip() + "\n")
+        tracemalloc.stop()
+        print(report)
+
+def enable(directory=PROFILE_DIR):
+    global _session
+    import atexit
+    if _session is None:
+        _session = ProfileSession(directory)
+        atexit.register(_session.close)
+        print(f"Profiling menu actions into {_session.directory}")
+    return _session
+
+def select_option(menu, prompt="Select an option: "):
+    # Every menu reads its choice through here; when profiling, the previous action ends at
+    # this prompt and the chosen one starts right after it
+    if _session is None:
+        return input(prompt)
+    _session.stop()
+    choice = input(prompt)
+    _session.start(menu, choice.strip())
+    return choice
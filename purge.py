@@ -0,0 +1,143 @@
+import os
+import sys
+import time
+
+from db_config import get_connection
+from changelog import record_changes
+import history
+from assignment import load_index
+from mysql.connector import Error
+
+# Rows removed per transaction, and the pause after each one, keep lock time short for the front desk
+PURGE_BATCH_SIZE = int(os.environ.get('HOSPITAL_PURGE_BATCH_SIZE', '200'))
+PURGE_PAUSE = float(os.environ.get('HOSPITAL_PURGE_PAUSE', '0.1'))
+# Seconds between scans for newly soft-deleted rows when running as a worker
+PURGE_POLL_INTERVAL = float(os.environ.get('HOSPITAL_PURGE_POLL_INTERVAL', '30'))
+
+# What ON DELETE CASCADE / SET NULL used to do in one statement, as batchable steps run in
+# order: (table, owner condition, change, event). Children go first so the final DELETE of the
+# parent has nothing left to cascade to; the archive tables and bill_adjustments have no foreign
+# keys, so they get steps of their own. A step with an event locks its batch by row key and
+# records (entity, event key column, op, fields) in change_log for each distinct event key.
+PATIENT_PURGE_STEPS = [
+    # Adjustments are found through the bills, so they go before them
+    ('bill_adjustments', 'bill_id IN (SELECT bill_id FROM billing WHERE patient_id = %s)', 'DELETE', None),
+    ('bill_adjustments', 'bill_id IN (SELECT bill_id FROM billing_archive WHERE patient_id = %s)', 'DELETE', None),
+    ('billed_services', 'patient_id = %s', 'DELETE', ('id', 'bill', 'bill_id', 'update', {'lines_purged': True})),
+    ('billing', 'patient_id = %s', 'DELETE', ('bill_id', 'bill', 'bill_id', 'delete', {'purged': True})),
+    ('billed_services_archive', 'patient_id = %s', 'DELETE', ('id', 'bill', 'bill_id', 'update', {'lines_purged': True})),
+    ('billing_archive', 'patient_id = %s', 'DELETE', ('bill_id', 'bill', 'bill_id', 'delete', {'purged': True})),
+    ('appointments', 'patient_id = %s', 'DELETE', ('appt_id', 'appointment', 'appt_id', 'delete', {'purged': True})),
+    ('appointments_archive', 'patient_id = %s', 'DELETE', ('appt_id', 'appointment', 'appt_id', 'delete', {'purged': True})),
+    ('pending_charges', 'patient_id = %s', 'DELETE', ('charge_id', 'charge', 'patient_id', 'delete', {'purged': True})),
+    ('pending_charge_totals', 'patient_id = %s', 'DELETE', None),
+    ('duplicate_candidates', 'patient_id = %s', 'DELETE', None),
+    ('duplicate_candidates', 'duplicate_of = %s', 'DELETE', None),
+]
+DOCTOR_PURGE_STEPS = [
+    ('appointments', 'doctor_id = %s', 'doctor_id = NULL', ('appt_id', 'appointment', 'appt_id', 'update', {'doctor_id': None})),
+    ('appointments_archive', 'doctor_id = %s', 'doctor_id = NULL', ('appt_id', 'appointment', 'appt_id', 'update', {'doctor_id': None})),
+]
+
+def _change_sql(table, change, where):
+    if change == 'DELETE':
+        return f"DELETE FROM {table} WHERE {where}"
+    return f"UPDATE {table} SET {change} WHERE {where}"
+
+def _purge_batch(conn, cursor, step, key, batch_size):
+    table, owner, change, event = step
+    if not event:
+        cursor.execute(_change_sql(table, change, owner) + " LIMIT %s", (key, batch_size))
+        return cursor.rowcount
+    row_key, entity, event_key, op, fields = event
+    cursor.execute(f"SELECT {row_key}, {event_key} FROM {table} WHERE {owner} LIMIT %s FOR UPDATE",
+                   (key, batch_size))
+    rows = cursor.fetchall()
+    if not rows:
+        return 0
+    ids = [row[0] for row in rows]
+    cursor.execute(_change_sql(table, change, f"{row_key} IN ({', '.join(['%s'] * len(ids))})"), tuple(ids))
+    record_changes(conn, [(entity, event_id, op, fields) for event_id in dict.fromkeys(row[1] for row in rows)])
+    return len(rows)
+
+def _run_step(step, key, batch_size, pause):
+    # Repeats one batched step, a transaction per batch, until it affects fewer rows than a full batch
+    total = 0
+    while True:
+        try:
+            conn = get_connection()
+            cursor = conn.cursor()
+            count = _purge_batch(conn, cursor, step, key, batch_size)
+            conn.commit()
+        finally:
+            if 'cursor' in locals(): cursor.close()
+            if 'conn' in locals(): conn.close()
+        total += count
+        if count < batch_size:
+            return total
+        time.sleep(pause)
+
+def _finish(sql, key):
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(sql, (key,))
+        conn.commit()
+        return cursor.rowcount
+    finally:
+        cursor.close()
+        conn.close()
+
+def _deleted(table, key_column, limit):
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f"SELECT {key_column} FROM {table} WHERE deleted_at IS NOT NULL ORDER BY deleted_at LIMIT %s", (limit,))
+        return [row[0] for row in cursor.fetchall()]
+    finally:
+        cursor.close()
+        conn.close()
+
+def purge_patient(patient_id, batch_size=PURGE_BATCH_SIZE, pause=PURGE_PAUSE):
+    rows = sum(_run_step(step, patient_id, batch_size, pause) for step in PATIENT_PURGE_STEPS)
+    # Only ever removes a row that is still soft-deleted
+    _finish("DELETE FROM patients WHERE patient_id = %s AND deleted_at IS NOT NULL", patient_id)
+    history.invalidate(patient_id)
+    return rows
+
+def purge_doctor(doctor_id, batch_size=PURGE_BATCH_SIZE, pause=PURGE_PAUSE):
+    rows = sum(_run_step(step, doctor_id, batch_size, pause) for step in DOCTOR_PURGE_STEPS)
+    _finish("DELETE FROM doctors WHERE doctor_id = %s AND deleted_at IS NOT NULL", doctor_id)
+    history.invalidate()
+    return rows
+
+def purge_deleted(batch_size=PURGE_BATCH_SIZE, pause=PURGE_PAUSE, limit=100):
+    # One pass over up to `limit` soft-deleted patients and doctors, oldest first
+    patients = doctors = rows = 0
+    try:
+        for patient_id in _deleted('patients', 'patient_id', limit):
+            rows += purge_patient(patient_id, batch_size, pause)
+            patients += 1
+        for doctor_id in _deleted('doctors', 'doctor_id', limit):
+            rows += purge_doctor(doctor_id, batch_size, pause)
+            doctors += 1
+    except Error as e:
+        print("Database error while purging deleted records:", e)
+    if rows:
+        load_index.invalidate()
+    if patients or doctors:
+        print(f"Purged {patients} patient(s) and {doctors} doctor(s), {rows} dependent row(s).")
+    return {'patients': patients, 'doctors': doctors, 'rows': rows}
+
+def run_worker(poll_interval=PURGE_POLL_INTERVAL, should_stop=lambda: False):
+    # Background loop: keeps purging while there is work, then waits for new soft deletes
+    while not should_stop():
+        result = purge_deleted()
+        if not (result['patients'] or result['doctors']):
+            time.sleep(poll_interval)
+
+if __name__ == "__main__":
+    if '--once' in sys.argv[1:]:
+        purge_deleted()
+    else:
+        run_worker()
@@ -0,0 +1,229 @@
+import hashlib
+import math
+import os
+import threading
+import time
+
+from db_config import get_connection
+from changelog import ChangeConsumer
+from mysql.connector import Error
+
+# Referential prechecks for ingest: which patient, doctor and service IDs exist, answered in
+# process so a feed's bad references are rejected before its rows reach the database
+# (a foreign key misses soft-deleted rows and fails the whole chunk). Each entity's live IDs
+# are held in a Bloom filter, kept current from change_log. A Bloom miss is definite and costs
+# no query; a hit is only "probably", so exact checks confirm hits with one IN query per chunk.
+REFCHECK_FP_RATE = float(os.environ.get('HOSPITAL_REFCHECK_FP_RATE', '0.01'))
+# Seconds between change_log polls; a miss always polls first, so new IDs are never rejected
+REFCHECK_REFRESH_INTERVAL = float(os.environ.get('HOSPITAL_REFCHECK_REFRESH_INTERVAL', '2'))
+# Checks of fewer keys than this go straight to the database unless the filter is already
+# loaded, so a one-off add doesn't pay for reading every ID
+REFCHECK_MIN_KEYS = int(os.environ.get('HOSPITAL_REFCHECK_MIN_KEYS', '50'))
+REFCHECK_CHUNK_SIZE = 1000
+
+# entity -> (table, key column, live-row condition)
+REFERENCE_TABLES = {
+    'patient': ('patients', 'patient_id', 'deleted_at IS NULL'),
+    'doctor': ('doctors', 'doctor_id', 'deleted_at IS NULL'),
+    'service': ('services', 'service_id', None),
+}
+
+def reference_key(entity, key):
+    # The form IDs are compared in: patient IDs as integers ('0042' is patient 42) and the
+    # VARCHAR IDs casefolded, as their columns' collation matches 'd01' to 'D01'
+    key = str(key)
+    if entity == 'patient':
+        return str(int(key)) if key.isdigit() else key
+    return key.casefold()
+
+class BloomFilter:
+    def __init__(self, capacity, fp_rate=REFCHECK_FP_RATE):
+        capacity = max(int(capacity), 1024)
+        self.capacity = capacity
+        self.bits = max(int(-capacity * math.log(fp_rate) / math.log(2) ** 2), 8)
+        self.hashes = max(int(round(self.bits / capacity * math.log(2))), 1)
+        self.array = bytearray((self.bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        # Double hashing: k positions from two 64-bit halves of one digest
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.array[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.array[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+def _existing_keys(cursor, entity, keys):
+    # Exact check: which of `keys` are live rows
+    table, column, live = REFERENCE_TABLES[entity]
+    found = set()
+    for start in range(0, len(keys), REFCHECK_CHUNK_SIZE):
+        chunk = keys[start:start + REFCHECK_CHUNK_SIZE]
+        sql = f"SELECT {column} FROM {table} WHERE {column} IN ({', '.join(['%s'] * len(chunk))})"
+        if live:
+            sql += f" AND {live}"
+        cursor.execute(sql, tuple(chunk))
+        found.update(reference_key(entity, row[0]) for row in cursor.fetchall())
+    return found
+
+class ReferenceIndex:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.filters = {}
+        self.removed = {}
+        self.consumer = None
+        self.refreshed_at = None
+        self.stats = {'checked': 0, 'filter_rejects': 0, 'exact_lookups': 0, 'false_positives': 0, 'rebuilds': 0}
+
+    def load(self):
+        started = time.perf_counter()
+        conn = get_connection(read_only=True)
+        cursor = conn.cursor()
+        try:
+            # Events after this point are replayed over the load; replaying one is harmless
+            cursor.execute("SELECT COALESCE(MAX(seq), 0) FROM change_log")
+            seq = cursor.fetchone()[0]
+            filters = {}
+            for entity, (table, column, live) in REFERENCE_TABLES.items():
+                cursor.execute(f"SELECT COUNT(*) FROM {table}" + (f" WHERE {live}" if live else ""))
+                # Headroom for inserts before the filter has to be rebuilt
+                bloom = BloomFilter(cursor.fetchone()[0] * 2)
+                cursor.execute(f"SELECT {column} FROM {table}" + (f" WHERE {live}" if live else ""))
+                while True:
+                    rows = cursor.fetchmany(10000)
+                    if not rows:
+                        break
+                    for row in rows:
+                        bloom.add(reference_key(entity, row[0]))
+                filters[entity] = bloom
+        finally:
+            cursor.close()
+            conn.close()
+        self.filters = filters
+        # Deleted keys can't be taken out of a Bloom filter, so they are remembered exactly
+        self.removed = {entity: set() for entity in REFERENCE_TABLES}
+        self.consumer = ChangeConsumer('refcheck', entities=list(REFERENCE_TABLES), persistent=False)
+        self.consumer.position = seq
+        self.refreshed_at = time.monotonic()
+        print("Reference filter loaded: " + ", ".join(f"{bloom.count} {entity}s" for entity, bloom in filters.items()) +
+              f" in {time.perf_counter() - started:.1f}s.")
+
+    def refresh(self, force=False):
+        if self.consumer is None:
+            self.load()
+            return
+        if not force and time.monotonic() - self.refreshed_at < REFCHECK_REFRESH_INTERVAL:
+            return
+        while True:
+            events = self.consumer.poll()
+            if not events:
+                break
+            for event in events:
+                key = reference_key(event['entity'], event['key'])
+                if event['op'] == 'delete':
+                    self.removed[event['entity']].add(key)
+                elif event['op'] == 'insert':
+                    self.filters[event['entity']].add(key)
+                    self.removed[event['entity']].discard(key)
+            self.consumer.commit()
+        self.refreshed_at = time.monotonic()
+        # Past capacity the false-positive rate climbs, and many deletions make the exact
+        # set large; either way start again from the tables
+        if any(bloom.count > bloom.capacity or len(self.removed[entity]) > bloom.capacity // 4
+               for entity, bloom in self.filters.items()):
+            self.stats['rebuilds'] += 1
+            self.load()
+
+    def _misses(self, entity, keys):
+        bloom, removed = self.filters[entity], self.removed[entity]
+        return {key for key in keys if key in removed or key not in bloom}
+
+    def missing(self, entity, keys, exact=True):
+        # Keys with no live row, in reference_key form. exact=False trusts filter hits, for
+        # callers that have a foreign key behind them to catch the rare false positive.
+        keys = list(dict.fromkeys(reference_key(entity, key) for key in keys))
+        self.refresh()
+        misses = self._misses(entity, keys)
+        if misses:
+            # Possibly created since the last poll; the poll may also bring deletions of hits
+            self.refresh(force=True)
+            misses = self._misses(entity, keys)
+        self.stats['checked'] += len(keys)
+        self.stats['filter_rejects'] += len(misses)
+        if not exact:
+            return misses
+        hits = [key for key in keys if key not in misses]
+        if not hits:
+            return misses
+        # The primary, since a replica may not have a patient registered a moment ago
+        conn = get_connection()
+        cursor = conn.cursor()
+        try:
+            found = _existing_keys(cursor, entity, hits)
+        finally:
+            cursor.close()
+            conn.close()
+        self.stats['exact_lookups'] += len(hits)
+        self.stats['false_positives'] += len(hits) - len(found)
+        return misses | {key for key in hits if key not in found}
+
+_index = None
+_index_lock = threading.Lock()
+
+def get_index():
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = ReferenceIndex()
+        return _index
+
+def missing_references(entity, keys, exact=True):
+    # The keys of `entity` that don't exist, as strings spelled as given. Small checks in a
+    # process that hasn't loaded the filter are answered by the database directly.
+    keys = [str(key) for key in keys if key is not None and str(key) != '']
+    if not keys:
+        return set()
+    normalized = list(dict.fromkeys(reference_key(entity, key) for key in keys))
+    index = get_index()
+    with index.lock:
+        if index.consumer is not None or len(normalized) >= REFCHECK_MIN_KEYS:
+            missing = index.missing(entity, normalized, exact)
+        else:
+            missing = None
+    if missing is None:
+        conn = get_connection()
+        cursor = conn.cursor()
+        try:
+            missing = set(normalized) - _existing_keys(cursor, entity, normalized)
+        finally:
+            cursor.close()
+            conn.close()
+    return {key for key in keys if reference_key(entity, key) in missing}
+
+def reject_unknown_references(rows, label, references, exact=True):
+    # Ingest precheck over (key, values) rows: references maps entity -> position in values.
+    # Returns the rows whose references all exist and how many were rejected.
+    try:
+        missing = {entity: missing_references(entity, [values[position] for _, values in rows], exact)
+                   for entity, position in references.items()}
+    except Error as e:
+        # Without the precheck the rows still meet the database's own constraints
+        print("Database error during reference check, writing unchecked:", e)
+        return rows, 0
+    kept, rejected = [], 0
+    for key, values in rows:
+        unknown = [f"{entity} '{values[position]}'" for entity, position in references.items()
+                   if str(values[position]) in missing[entity]]
+        if unknown:
+            print(f"Rejected {label} '{key}': unknown {', '.join(unknown)}.")
+            rejected += 1
+        else:
+            kept.append((key, values))
+    return kept, rejected
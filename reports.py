@@ -0,0 +1,155 @@
+import datetime
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from db_config import get_connection, live_patient
+from archive import ARCHIVE_TABLES
+from mysql.connector import Error
+
+REPORT_WORKERS = int(os.environ.get('HOSPITAL_REPORT_WORKERS', '4'))
+
+# Every aggregate is a SUM or COUNT, so partial results from any shard can be added together.
+# {where} receives the shard predicate; table names are placeholders so the same report can
+# run over the archive tables.
+REPORTS = {
+    'revenue_by_doctor': {
+        'title': "Consulting revenue by doctor",
+        'sql': """SELECT a.doctor_id, COALESCE(SUM(a.consulting_charge), 0), COUNT(*)
+                  FROM {appointments} a WHERE {where} GROUP BY a.doctor_id""",
+        'date_column': 'a.date', 'patient_column': 'a.patient_id', 'table': 'appointments',
+        'columns': ('Doctor ID', 'Revenue', 'Visits'),
+    },
+    'revenue_by_service': {
+        'title': "Billed revenue by service",
+        'sql': """SELECT bs.service_id, COALESCE(SUM(bs.cost), 0), COUNT(*)
+                  FROM {billed_services} bs WHERE bs.voided_at IS NULL AND {where} GROUP BY bs.service_id""",
+        'date_column': 'bs.billed_at', 'patient_column': 'bs.patient_id', 'table': 'billed_services',
+        'columns': ('Service ID', 'Revenue', 'Times Billed'),
+    },
+    'revenue_by_month': {
+        'title': "Billed revenue by month",
+        'sql': """SELECT DATE_FORMAT(b.billing_date, '%Y-%m'), COALESCE(SUM(b.total_amount), 0), COUNT(*)
+                  FROM {billing} b WHERE {where} GROUP BY 1""",
+        'date_column': 'b.billing_date', 'patient_column': 'b.patient_id', 'table': 'billing',
+        'columns': ('Month', 'Revenue', 'Bills'),
+    },
+    'monthly_visits': {
+        'title': "Visits by month",
+        'sql': """SELECT DATE_FORMAT(a.date, '%Y-%m'), COUNT(*), COALESCE(SUM(a.consulting_charge), 0)
+                  FROM {appointments} a WHERE {where} GROUP BY 1""",
+        'date_column': 'a.date', 'patient_column': 'a.patient_id', 'table': 'appointments',
+        'columns': ('Month', 'Visits', 'Consulting Revenue'),
+    },
+    'daily_visits': {
+        'title': "Visits by day",
+        'sql': """SELECT a.date, COUNT(*) FROM {appointments} a WHERE {where} GROUP BY a.date""",
+        'date_column': 'a.date', 'patient_column': 'a.patient_id', 'table': 'appointments',
+        'columns': ('Date', 'Visits'),
+    },
+}
+
+def _table_names(archived):
+    return {table: ARCHIVE_TABLES[table] if archived else table for table in ARCHIVE_TABLES}
+
+def _date_shards(start, end, count):
+    # Half-open [start, end) ranges of (nearly) equal length
+    days = max((end - start).days, 1)
+    count = max(1, min(count, days))
+    bounds = [start + datetime.timedelta(days=days * i // count) for i in range(count + 1)]
+    bounds[-1] = end
+    return [(bounds[i], bounds[i + 1]) for i in range(count) if bounds[i] < bounds[i + 1]]
+
+def _shard_tasks(report, shard_by, shards, start, end, archived):
+    sql = report['sql']
+    tables = _table_names(archived)
+    # Rows of soft-deleted patients are left out, as everywhere else
+    date_range = f"{report['date_column']} >= %s AND {report['date_column']} < %s AND {live_patient(report['patient_column'])}"
+    if shard_by == 'date':
+        return [(sql.format(where=date_range, **tables), (lo, hi)) for lo, hi in _date_shards(start, end, shards)]
+    where = f"MOD({report['patient_column']}, %s) = %s AND {date_range}"
+    return [(sql.format(where=where, **tables), (shards, i, start, end)) for i in range(shards)]
+
+def _run_shard(task):
+    # Runs in a worker thread or process; returns the partial aggregate as {key: [values]}
+    sql, params = task
+    conn = get_connection(read_only=True)
+    cursor = conn.cursor()
+    try:
+        cursor.execute(sql, params)
+        return {row[0]: list(row[1:]) for row in cursor.fetchall()}
+    finally:
+        cursor.close()
+        conn.close()
+
+def _as_date(value):
+    return value.date() if isinstance(value, datetime.datetime) else value
+
+def _date_bounds(report, include_archived):
+    column = report['date_column'].split('.')[1]
+    tables = [report['table']] + ([ARCHIVE_TABLES[report['table']]] if include_archived else [])
+    conn = get_connection(read_only=True)
+    cursor = conn.cursor()
+    try:
+        lows, highs = [], []
+        for table in tables:
+            cursor.execute(f"SELECT MIN({column}), MAX({column}) FROM {table}")
+            low, high = cursor.fetchone()
+            if low is not None:
+                lows.append(_as_date(low))
+                highs.append(_as_date(high))
+        if not lows:
+            return None, None
+        return min(lows), max(highs) + datetime.timedelta(days=1)
+    finally:
+        cursor.close()
+        conn.close()
+
+def run_report(name, start=None, end=None, workers=REPORT_WORKERS, shard_by='date',
+               include_archived=False, use_processes=False):
+    # Splits the report into `workers` shards, runs them concurrently and merges the partials.
+    # start/end are dates (end exclusive); both default to the full history.
+    report = REPORTS[name]
+    if shard_by not in ('date', 'patient'):
+        raise ValueError("shard_by must be 'date' or 'patient'")
+    if start is None or end is None:
+        low, high = _date_bounds(report, include_archived)
+        if low is None:
+            return []
+        start = start or low
+        end = end or high
+
+    tasks = _shard_tasks(report, shard_by, workers, start, end, archived=False)
+    if include_archived:
+        tasks += _shard_tasks(report, shard_by, workers, start, end, archived=True)
+    if use_processes:
+        # Spawned, not forked: a forked worker would share the parent's pooled sockets
+        executor = ProcessPoolExecutor(max_workers=max(1, workers), mp_context=multiprocessing.get_context('spawn'))
+    else:
+        executor = ThreadPoolExecutor(max_workers=max(1, workers))
+    with executor:
+        partials = list(executor.map(_run_shard, tasks))
+
+    merged = {}
+    for partial in partials:
+        for key, values in partial.items():
+            if key in merged:
+                merged[key] = [a + b for a, b in zip(merged[key], values)]
+            else:
+                merged[key] = values
+    rows = [(key, *values) for key, values in merged.items()]
+    return sorted(rows, key=lambda row: str(row[0]))
+
+def print_report(name, **options):
+    try:
+        rows = run_report(name, **options)
+        print(f"\n{REPORTS[name]['title']}")
+        print(" | ".join(REPORTS[name]['columns']))
+        if not rows:
+            print("No data for this report.")
+        for row in rows:
+            print(" | ".join(str(x) for x in row))
+    except Error as e:
+        print("Database error while running report:", e)
+    except Exception as e:
+        print("Unexpected error while running report:", e)
@@ -0,0 +1,125 @@
+import functools
+import os
+import random
+import threading
+import time
+
+from db_config import in_retry_scope, in_transaction_group, pinned_connection, reset_pinned, retry_scope, transaction
+
+# Retry policy for transactional operations: a deadlock, a lock wait timeout or a dropped
+# connection replays the whole transaction after a jittered exponential backoff, so contention
+# costs throughput rather than failed operations.
+RETRY_ATTEMPTS = int(os.environ.get('HOSPITAL_RETRY_ATTEMPTS', '5'))
+RETRY_BASE_DELAY = float(os.environ.get('HOSPITAL_RETRY_BASE_DELAY', '0.05'))
+RETRY_MAX_DELAY = float(os.environ.get('HOSPITAL_RETRY_MAX_DELAY', '2'))
+# Seconds an operation may spend in total (attempts and backoff) before it gives up
+RETRY_BUDGET = float(os.environ.get('HOSPITAL_RETRY_BUDGET', '10'))
+
+# errno -> reason. Anything else (constraint violations, bad SQL) fails at once.
+RETRYABLE_ERRORS = {
+    1213: 'deadlock',
+    1205: 'lock_wait_timeout',
+    2006: 'server_gone',
+    2013: 'connection_lost',
+    2055: 'connection_lost',
+}
+
+_stats = {'operations': 0, 'retried_operations': 0, 'retries': 0, 'gave_up': 0, 'backoff_seconds': 0.0, 'reasons': {}}
+_stats_lock = threading.Lock()
+
+def retry_reason(error):
+    return RETRYABLE_ERRORS.get(getattr(error, 'errno', None))
+
+def backoff_delay(attempt):
+    # Full jitter: uniform over [0, base * 2^attempt], capped, so colliding writers spread out
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+class _Attempt:
+    # The retry scope of one attempt: keeps the first retryable error any statement raised
+    def __init__(self):
+        self.error = None
+
+    def record(self, error):
+        if self.error is None and retry_reason(error):
+            self.error = error
+
+class _Replay(Exception):
+    pass
+
+def _with_retries(attempt_once, attempts, budget, on_retry):
+    # Calls attempt_once(scope) until an attempt ends without a retryable error, the attempts
+    # run out or the next backoff would overrun the budget. Nested inside another retrying
+    # operation it runs once: the outermost one replays.
+    if in_retry_scope() or in_transaction_group():
+        return attempt_once(_Attempt())
+    with _stats_lock:
+        _stats['operations'] += 1
+    started = time.monotonic()
+    attempt = 0
+    while True:
+        scope = _Attempt()
+        result = raised = None
+        try:
+            with retry_scope(scope):
+                if attempt:
+                    reset_pinned()
+                result = attempt_once(scope)
+        except _Replay:
+            pass
+        except Exception as e:
+            # Whatever was raised after a retryable error is a consequence of it
+            if scope.error is None:
+                raise
+            raised = e
+        error = scope.error
+        if error is None:
+            return result
+        attempt += 1
+        reason = retry_reason(error)
+        delay = backoff_delay(attempt)
+        if attempt >= attempts or time.monotonic() - started + delay > budget:
+            with _stats_lock:
+                _stats['gave_up'] += 1
+            print(f"Giving up after {attempt} attempt(s): {reason} ({error})")
+            if raised is not None:
+                raise raised
+            return result
+        with _stats_lock:
+            if attempt == 1:
+                _stats['retried_operations'] += 1
+            _stats['retries'] += 1
+            _stats['backoff_seconds'] += delay
+            _stats['reasons'][reason] = _stats['reasons'].get(reason, 0) + 1
+        print(f"Retrying after {reason} (attempt {attempt + 1} of {attempts}, in {delay * 1000:.0f} ms)")
+        if on_retry:
+            on_retry(error)
+        time.sleep(delay)
+
+def run_transaction(work, attempts=RETRY_ATTEMPTS, budget=RETRY_BUDGET, on_retry=None):
+    # Runs work() as one transaction on a pinned connection and returns its result. If any
+    # statement hits a retryable error, even one an entity method caught and printed, the
+    # transaction is rolled back and work() runs again; on_retry(error) is called before each
+    # replay. A failed COMMIT is not retried: the transaction may have been applied.
+    def attempt_once(scope):
+        with pinned_connection():
+            with transaction():
+                result = work()
+                if scope.error is not None:
+                    raise _Replay()
+        return result
+    return _with_retries(attempt_once, attempts, budget, on_retry)
+
+def retrying(method):
+    # For entity methods that run and commit one transaction each: the method keeps its own
+    # connection and commit, and an attempt that hit a retryable error (rolled back when its
+    # connection was released) is replayed whole
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        return _with_retries(lambda scope: method(*args, **kwargs), RETRY_ATTEMPTS, RETRY_BUDGET, None)
+    return wrapper
+
+def retry_stats():
+    with _stats_lock:
+        stats = dict(_stats, reasons=dict(_stats['reasons']))
+    stats['retry_rate'] = stats['retried_operations'] / stats['operations'] if stats['operations'] else 0.0
+    return stats
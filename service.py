@@ -1,34 +1,54 @@
 import re
-from db_config import get_connection
+from db_config import get_connection, prepared_cursor, row_version
+from retry import retrying
+import history
+from changelog import record_change
+from profiler import select_option
+from bulk import BULK_CHUNK_SIZE, upsert_rows, format_counts
+from refcheck import missing_references, reject_unknown_references
+from charges import add_charge, add_charges, clear_charges
+from decimal import Decimal
 import mysql.connector
 from mysql.connector import IntegrityError, Error
 
 class Service:
-    def __init__(self, service_id, service_name, cost):
+    def __init__(self, service_id, service_name, cost, version=None):
         self.service_id = service_id
         self.service_name = service_name
         self.cost = cost
+        # Row version as last read; update() only applies if the row still has it
+        self.version = version
+        self.conflict = False
+        self.current_version = None
 
-    def add(self):
+    def _validate(self):
+        # Returns the first validation error, or None if the service can be saved
         # Validate service name
         if not self.service_name or not re.match(r'^[A-Za-z0-9\s\-_]+$', self.service_name):
-            print("Invalid Service Name. Only letters, numbers, spaces, hyphens, and underscores allowed.")
-            return False
+            return "Invalid Service Name. Only letters, numbers, spaces, hyphens, and underscores allowed."
         # Validate cost
         try:
             cost_val = float(self.cost)
             if cost_val < 0 or cost_val > 5000:
-                print("Cost must be between 0 and 5000.")
-                return False
-        except ValueError:
-            print("Invalid Cost. Enter a valid number.")
+                return "Cost must be between 0 and 5000."
+        except (TypeError, ValueError):
+            return "Invalid Cost. Enter a valid number."
+        return None
+
+    @retrying
+    def add(self):
+        error = self._validate()
+        if error:
+            print(error)
             return False
+        cost_val = float(self.cost)
 
         try:
             conn = get_connection()
-            cursor = conn.cursor()
             sql = "INSERT INTO services (service_id, service_name, cost) VALUES (%s, %s, %s)"
+            cursor = prepared_cursor(conn, sql)
             cursor.execute(sql, (self.service_id, self.service_name, cost_val))
+            record_change(conn, 'service', self.service_id, 'insert', {'service_name': self.service_name, 'cost': cost_val})
             conn.commit()
             return True
         except IntegrityError:
@@ -41,36 +61,50 @@ class Service:
             print("Unexpected error while adding service:", e)
             return False
         finally:
-            if 'cursor' in locals(): cursor.close()
             if 'conn' in locals(): conn.close()
 
+    @retrying
     def update(self):
-        # Validate service name
-        if not self.service_name or not re.match(r'^[A-Za-z0-9\s\-_]+$', self.service_name):
-            print("Invalid Service Name. Only letters, numbers, spaces, hyphens, and underscores allowed.")
+        error = self._validate()
+        if error:
+            print(error)
             return False
-        # Validate cost
+        cost_val = float(self.cost)
+        # Version validation (no version means overwrite unconditionally)
         try:
-            cost_val = float(self.cost)
-            if cost_val < 0 or cost_val > 5000:
-                print("Cost must be between 0 and 5000.")
-                return False
+            version = None if self.version is None else int(self.version)
         except ValueError:
-            print("Invalid Cost. Enter a valid number.")
+            print("Invalid Version. Must be a number.")
             return False
 
+        self.conflict = False
         try:
             conn = get_connection()
-            cursor = conn.cursor()
-            sql = "UPDATE services SET service_name=%s, cost=%s WHERE service_id=%s"
-            cursor.execute(sql, (self.service_name, cost_val, self.service_id))
-            conn.commit()
+            params = (self.service_name, cost_val, self.service_id)
+            if version is None:
+                sql = "UPDATE services SET service_name=%s, cost=%s, version=version+1 WHERE service_id=%s"
+            else:
+                # Compare-and-set: matches only if nobody has updated the row since it was read
+                sql = "UPDATE services SET service_name=%s, cost=%s, version=version+1 WHERE service_id=%s AND version=%s"
+                params += (version,)
+            cursor = prepared_cursor(conn, sql)
+            cursor.execute(sql, params)
             if cursor.rowcount == 0:
-                print("Service ID not found.")
+                current = row_version(conn, 'services', 'service_id', self.service_id)
+                if current is None:
+                    print("Service ID not found.")
+                else:
+                    self.conflict = True
+                    self.current_version = current
+                    print(f"Update conflict: service '{self.service_id}' was changed by someone else "
+                          f"(your version {version}, current version {current}). Reload it and try again.")
                 return False
-            else:
-                print("Service updated successfully.")
-                return True
+            record_change(conn, 'service', self.service_id, 'update', {'service_name': self.service_name, 'cost': cost_val})
+            conn.commit()
+            if version is not None:
+                self.version = version + 1
+            print("Service updated successfully.")
+            return True
         except Error as e:
             print("Database error while updating service:", e)
             return False
@@ -78,17 +112,19 @@ class Service:
             print("Unexpected error while updating service:", e)
             return False
         finally:
-            if 'cursor' in locals(): cursor.close()
             if 'conn' in locals(): conn.close()
 
     @staticmethod
+    @retrying
     def delete(service_id):
         # No validation for service_id since it's system-generated
         try:
             conn = get_connection()
-            cursor = conn.cursor()
             sql = "DELETE FROM services WHERE service_id=%s"
+            cursor = prepared_cursor(conn, sql)
             cursor.execute(sql, (service_id,))
+            if cursor.rowcount:
+                record_change(conn, 'service', service_id, 'delete')
             conn.commit()
             if cursor.rowcount == 0:
                 print("Service ID not found.")
@@ -96,6 +132,9 @@ class Service:
             else:
                 print("Service deleted successfully.")
                 return True
+        except IntegrityError:
+            print("Service has pending charges; bill or clear them before deleting it.")
+            return False
         except Error as e:
             print("Database error while deleting service:", e)
             return False
@@ -103,17 +142,36 @@ class Service:
             print("Unexpected error while deleting service:", e)
             return False
         finally:
-            if 'cursor' in locals(): cursor.close()
             if 'conn' in locals(): conn.close()
 
+    @staticmethod
+    def bulk_upsert(rows, chunk_size=BULK_CHUNK_SIZE):
+        # Price list sync: rows are dicts with service_id, service_name and cost.
+        # Safe to re-run; returns inserted/updated/unchanged/failed/invalid counts.
+        valid, invalid = [], 0
+        for row in rows:
+            service = Service(str(row.get('service_id') or ''), row.get('service_name'), row.get('cost'))
+            error = service._validate() if service.service_id else "Missing Service ID."
+            if error:
+                print(f"Skipped service '{service.service_id}': {error}")
+                invalid += 1
+                continue
+            # Same scale as the DECIMAL(7,2) column, so an unchanged price compares equal
+            cost = Decimal(str(float(service.cost))).quantize(Decimal('0.01'))
+            valid.append((service.service_id, (service.service_name, cost)))
+        counts = upsert_rows('services', 'service', 'service_id', ('service_name', 'cost'), valid, chunk_size)
+        counts['invalid'] = invalid
+        print("Service sync:", format_counts(counts))
+        return counts
+
     @staticmethod
     def view():
         try:
-            conn = get_connection()
+            conn = get_connection(read_only=True)
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM services")
             rows = cursor.fetchall()
-            print("Service_ID | Service Name | Cost")
+            print("Service_ID | Service Name | Cost | Version")
             for row in rows:
                 print(" | ".join(str(x) for x in row))
         except Error as e:
@@ -124,11 +182,27 @@ class Service:
             if 'cursor' in locals(): cursor.close()
             if 'conn' in locals(): conn.close()
 
+    @staticmethod
+    def get(service_id):
+        try:
+            conn = get_connection()
+            sql = "SELECT service_id, service_name, cost, version FROM services WHERE service_id=%s"
+            cursor = prepared_cursor(conn, sql)
+            cursor.execute(sql, (service_id,))
+            rows = cursor.fetchall()
+            return Service(*rows[0]) if rows else None
+        except Error as e:
+            print("Database error while fetching service:", e)
+            return None
+        finally:
+            if 'conn' in locals(): conn.close()
+
 class ServiceUsageDB:
     @staticmethod
+    @retrying
     def add_service_for_patient(patient_id, service):
         # Data validation
-        if not re.match(r'^[A-Za-z0-9]+$', patient_id):
+        if not re.match(r'^[0-9]+$', str(patient_id)):
             print("Invalid Patient ID.")
             return
         if not re.match(r'^[A-Za-z0-9]+$', service.service_id):
@@ -147,28 +221,80 @@ class ServiceUsageDB:
             return
 
         try:
+            # The foreign key only catches a purged patient, not a soft-deleted one
+            if missing_references('patient', [patient_id]):
+                print(f"Patient ID {patient_id} not found.")
+                return
             conn = get_connection()
-            cursor = conn.cursor()
-            sql = "INSERT INTO temp_service_usage (patient_id, service_id, service_name, cost) VALUES (%s, %s, %s, %s)"
-            cursor.execute(sql, (patient_id, service.service_id, service.service_name, cost))
+            add_charge(conn, patient_id, service.service_id, cost)
             conn.commit()
+            history.invalidate(patient_id)
             print(f"Added {service.service_name} (ID: {service.service_id}, Cost: {cost}) for patient {patient_id}")
         except IntegrityError:
-            print(f"Error: Duplicate service usage entry for patient {patient_id} and service {service.service_id}.")
+            print(f"Error: Patient {patient_id} or service {service.service_id} no longer exists.")
         except Error as e:
             print("Database error while adding service usage:", e)
         except Exception as e:
             print("Unexpected error while adding service usage:", e)
+        finally:
+            if 'conn' in locals(): conn.close()
+
+    @staticmethod
+    def bulk_add(rows, chunk_size=BULK_CHUNK_SIZE):
+        # Usage feed ingest: rows are dicts with patient_id and service_id; the cost comes
+        # from the catalog. Rows naming an unknown patient or service are rejected before any
+        # write. Every row is a new usage, so re-running adds them again.
+        # Returns added/failed/invalid/rejected counts.
+        valid, invalid = [], 0
+        for number, row in enumerate(rows, 1):
+            patient_id = str(row.get('patient_id') or '').strip()
+            service_id = str(row.get('service_id') or '').strip()
+            if not re.match(r'^[0-9]+$', patient_id) or not re.match(r'^[A-Za-z0-9]+$', service_id):
+                print(f"Skipped usage row {number}: Invalid Patient or Service ID.")
+                invalid += 1
+                continue
+            valid.append((number, (patient_id, service_id)))
+        valid, rejected = reject_unknown_references(valid, 'usage row', {'patient': 0, 'service': 1})
+        counts = {'added': 0, 'failed': 0, 'invalid': invalid, 'rejected': rejected}
+        try:
+            conn = get_connection()
+            cursor = conn.cursor()
+            service_ids = sorted({values[1] for _, values in valid})
+            catalog = {}
+            for start in range(0, len(service_ids), chunk_size):
+                chunk = service_ids[start:start + chunk_size]
+                cursor.execute(f"SELECT service_id, cost FROM services WHERE service_id IN ({', '.join(['%s'] * len(chunk))})",
+                               tuple(chunk))
+                catalog.update(cursor.fetchall())
+            for start in range(0, len(valid), chunk_size):
+                chunk = [(int(patient_id), service_id, catalog[service_id])
+                         for _, (patient_id, service_id) in valid[start:start + chunk_size] if service_id in catalog]
+                # A service deleted since the precheck
+                counts['failed'] += min(chunk_size, len(valid) - start) - len(chunk)
+                if chunk:
+                    add_charges(conn, chunk)
+                    conn.commit()
+                    counts['added'] += len(chunk)
+        except Error as e:
+            print("Database error during service usage import:", e)
+            counts['failed'] = len(valid) - counts['added']
         finally:
             if 'cursor' in locals(): cursor.close()
             if 'conn' in locals(): conn.close()
+        if counts['added']:
+            history.invalidate()
+        print("Service usage import:", format_counts(counts))
+        return counts
 
     @staticmethod
     def get_services_for_patient(patient_id):
+        if not re.match(r'^[0-9]+$', str(patient_id)):
+            return []
         try:
             conn = get_connection()
-            cursor = conn.cursor()
-            sql = "SELECT service_id, service_name, cost FROM temp_service_usage WHERE patient_id=%s"
+            sql = ("SELECT c.service_id, s.service_name, c.cost FROM pending_charges c "
+                   "JOIN services s ON s.service_id = c.service_id WHERE c.patient_id=%s ORDER BY c.charge_id")
+            cursor = prepared_cursor(conn, sql)
             cursor.execute(sql, (patient_id,))
             rows = cursor.fetchall()
             return rows
@@ -179,24 +305,22 @@ class ServiceUsageDB:
             print("Unexpected error while fetching services:", e)
             return []
         finally:
-            if 'cursor' in locals(): cursor.close()
             if 'conn' in locals(): conn.close()
 
     @staticmethod
+    @retrying
     def clear_services_for_patient(patient_id):
         try:
             conn = get_connection()
-            cursor = conn.cursor()
-            sql = "DELETE FROM temp_service_usage WHERE patient_id=%s"
-            cursor.execute(sql, (patient_id,))
+            clear_charges(conn, patient_id)
             conn.commit()
+            history.invalidate(patient_id)
             print(f"Cleared services for patient {patient_id}")
         except Error as e:
             print("Database error while clearing services:", e)
         except Exception as e:
             print("Unexpected error while clearing services:", e)
         finally:
-            if 'cursor' in locals(): cursor.close()
             if 'conn' in locals(): conn.close()
 
 # --- ServiceUsageTracker ---
@@ -207,21 +331,14 @@ def service_usage_menu(patient_id):
         print("2. View Services Used")
         print("3. Clear Services (after billing)")
         print("4. Back to Patient Management")
-        choice = input("Select an option: ")
+        choice = select_option('service_usage_menu')
  
         if choice == '1':
             service_id = input("Enter Service ID: ")
-            # Fetch service details from DB
-            conn = get_connection()
-            cursor = conn.cursor()
-            cursor.execute("SELECT service_id, service_name, cost FROM services WHERE service_id=%s", (service_id,))
-            row = cursor.fetchone()
-            cursor.close()
-            conn.close()
-            if not row:
+            service = Service.get(service_id)
+            if not service:
                 print("Service ID not found.")
             else:
-                service = Service(*row)
                 ServiceUsageDB.add_service_for_patient(patient_id, service)
  
         elif choice == '2':
@@ -0,0 +1,323 @@
+import mmap
+import os
+import struct
+import sys
+import time
+from decimal import Decimal
+
+from contacts import normalize_contact
+
+# Read-only snapshot of the doctor directory, the services catalog and basic patient details
+# for kiosks and lookup screens. The file is memory-mapped and read in place: opening it
+# parses only the header and directory, and a lookup is a binary search over fixed-width
+# records. Strings live in a shared heap and records point at them by (offset, length).
+#
+#   header | table directory | index directory | records per table | indexes | string heap
+#
+# The exporter writes a new file beside the old one and renames it over it, so a reader sees
+# either the old snapshot or the new one, never a partial write.
+SNAPSHOT_PATH = os.environ.get('HOSPITAL_SNAPSHOT_PATH', os.path.join("output", "hospital.snapshot"))
+# Seconds between checks for a newer snapshot file
+SNAPSHOT_CHECK_INTERVAL = float(os.environ.get('HOSPITAL_SNAPSHOT_CHECK_INTERVAL', '5'))
+
+MAGIC = b'HMSNAP\x00\x01'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<8sHHIqQQ')        # magic, version, tables, indexes, created_at, heap offset, heap size
+TABLE_ENTRY = struct.Struct('<16sIIQ')     # table, record count, record size, records offset
+INDEX_ENTRY = struct.Struct('<16s16sIQ')   # table, field, entry count, entries offset
+INDEX_SLOT = struct.Struct('<I')           # record number
+
+# Field kinds and their fixed-width encodings: strings are (heap offset, byte length),
+# money is integer cents
+FIELD_FORMATS = {'str': 'IH', 'int': 'q', 'money': 'q'}
+
+# Records are sorted by `key`; each name in `indexes` gets an array of record numbers sorted
+# by that field (case-insensitively for strings)
+SNAPSHOT_TABLES = {
+    'doctors': {
+        'sql': "SELECT doctor_id, name, specialization, contact_no FROM doctors WHERE deleted_at IS NULL",
+        'fields': [('doctor_id', 'str'), ('name', 'str'), ('specialization', 'str'), ('contact_no', 'str')],
+        'key': 'doctor_id', 'indexes': ['specialization', 'name'],
+    },
+    'services': {
+        'sql': "SELECT service_id, service_name, cost FROM services",
+        'fields': [('service_id', 'str'), ('service_name', 'str'), ('cost', 'money')],
+        'key': 'service_id', 'indexes': ['service_name'],
+    },
+    'patients': {
+        'sql': "SELECT patient_id, name, gender, age, contact_no FROM patients WHERE deleted_at IS NULL",
+        'fields': [('patient_id', 'int'), ('name', 'str'), ('gender', 'str'), ('age', 'int'), ('contact_no', 'str')],
+        'key': 'patient_id', 'indexes': ['contact_no', 'name'],
+    },
+}
+
+def _record_struct(table):
+    return struct.Struct('<' + ''.join(FIELD_FORMATS[kind] for _, kind in SNAPSHOT_TABLES[table]['fields']))
+
+def _sort_key(kind, value):
+    if kind == 'str':
+        return (value or '').lower()
+    return value if value is not None else -1
+
+def _index_key(field, kind, value):
+    # Contact numbers are indexed digits only, so any spelling of a number finds it
+    return normalize_contact(value) if field == 'contact_no' else _sort_key(kind, value)
+
+# --- Export ---
+class _Heap:
+    def __init__(self):
+        self.data = bytearray()
+        self.offsets = {}
+
+    def add(self, text):
+        # Identical strings (specializations, genders) are stored once
+        raw = (text or '').encode('utf-8')[:0xFFFF]
+        offset = self.offsets.get(raw)
+        if offset is None:
+            offset = self.offsets[raw] = len(self.data)
+            self.data += raw
+        return offset, len(raw)
+
+def _read_tables():
+    from db_config import get_connection
+    conn = get_connection(read_only=True)
+    cursor = conn.cursor()
+    try:
+        tables = {}
+        for name, spec in SNAPSHOT_TABLES.items():
+            cursor.execute(spec['sql'])
+            tables[name] = cursor.fetchall()
+        return tables
+    finally:
+        cursor.close()
+        conn.close()
+
+def _encode_table(table, rows, heap):
+    spec = SNAPSHOT_TABLES[table]
+    fields = spec['fields']
+    key_index = [name for name, _ in fields].index(spec['key'])
+    key_kind = fields[key_index][1]
+    rows = sorted(rows, key=lambda row: _sort_key(key_kind, row[key_index]))
+    record = _record_struct(table)
+    out = bytearray()
+    for row in rows:
+        values = []
+        for (name, kind), value in zip(fields, row):
+            if kind == 'str':
+                values += heap.add(str(value) if value is not None else '')
+            elif kind == 'money':
+                values.append(int(round((value or 0) * 100)))
+            else:
+                values.append(int(value) if value is not None else -1)
+        out += record.pack(*values)
+    indexes = {}
+    for field in spec['indexes']:
+        position = [name for name, _ in fields].index(field)
+        kind = fields[position][1]
+        order = sorted(range(len(rows)), key=lambda i: _index_key(field, kind, rows[i][position]))
+        indexes[field] = b''.join(INDEX_SLOT.pack(i) for i in order)
+    return rows, bytes(out), record.size, indexes
+
+def export_snapshot(path=SNAPSHOT_PATH):
+    # Writes every table to `path` atomically; returns the row counts written
+    started = time.perf_counter()
+    tables = _read_tables()
+    heap = _Heap()
+    encoded = {name: _encode_table(name, rows, heap) for name, rows in tables.items()}
+    index_count = sum(len(e[3]) for e in encoded.values())
+    offset = HEADER.size + TABLE_ENTRY.size * len(encoded) + INDEX_ENTRY.size * index_count
+    table_entries, index_entries, body = [], [], bytearray()
+    for name, (rows, records, record_size, indexes) in encoded.items():
+        table_entries.append(TABLE_ENTRY.pack(name.encode(), len(rows), record_size, offset + len(body)))
+        body += records
+        for field, entries in indexes.items():
+            index_entries.append(INDEX_ENTRY.pack(name.encode(), field.encode(), len(rows), offset + len(body)))
+            body += entries
+    heap_offset = offset + len(body)
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, len(table_entries), len(index_entries), int(time.time()),
+                         heap_offset, len(heap.data))
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = path + ".tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(header)
+            f.write(b''.join(table_entries))
+            f.write(b''.join(index_entries))
+            f.write(body)
+            f.write(heap.data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+    counts = {name: len(e[0]) for name, e in encoded.items()}
+    print(f"Snapshot written to {path}: " + ", ".join(f"{n} {name}" for name, n in counts.items()) +
+          f", {heap_offset + len(heap.data)} bytes in {time.perf_counter() - started:.1f}s.")
+    return counts
+
+# --- Read ---
+class Snapshot:
+    def __init__(self, path=SNAPSHOT_PATH):
+        self.path = path
+        self.mm = None
+        self._checked_at = 0.0
+        self._open()
+
+    def _open(self):
+        with open(self.path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, table_count, index_count, created_at, heap_offset, heap_size = HEADER.unpack_from(mm, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            mm.close()
+            raise ValueError(f"{self.path} is not a snapshot this version can read.")
+        tables, indexes = {}, {}
+        position = HEADER.size
+        for _ in range(table_count):
+            name, count, record_size, offset = TABLE_ENTRY.unpack_from(mm, position)
+            name = name.rstrip(b'\0').decode()
+            position += TABLE_ENTRY.size
+            if name in SNAPSHOT_TABLES and record_size != _record_struct(name).size:
+                mm.close()
+                raise ValueError(f"{self.path} has a different layout for {name}; export it again.")
+            tables[name] = (count, record_size, offset)
+        for _ in range(index_count):
+            table, field, count, offset = INDEX_ENTRY.unpack_from(mm, position)
+            indexes[(table.rstrip(b'\0').decode(), field.rstrip(b'\0').decode())] = (count, offset)
+            position += INDEX_ENTRY.size
+        old, self.mm = self.mm, mm
+        self.tables, self.indexes = tables, indexes
+        self.created_at, self.heap_offset = created_at, heap_offset
+        self.identity = (stat.st_ino, stat.st_mtime_ns)
+        self._structs = {name: _record_struct(name) for name in tables if name in SNAPSHOT_TABLES}
+        if old is not None:
+            old.close()
+
+    def refresh(self):
+        # Switches to a newer file if the exporter has replaced it; checked at most every
+        # SNAPSHOT_CHECK_INTERVAL seconds
+        now = time.monotonic()
+        if now - self._checked_at < SNAPSHOT_CHECK_INTERVAL:
+            return False
+        self._checked_at = now
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return False
+        if (stat.st_ino, stat.st_mtime_ns) == self.identity:
+            return False
+        self._open()
+        return True
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+
+    def _string(self, offset, length):
+        start = self.heap_offset + offset
+        return self.mm[start:start + length].decode('utf-8')
+
+    def _field(self, table, number, field):
+        # One field of record `number`, decoded without touching the rest of the record
+        fields = SNAPSHOT_TABLES[table]['fields']
+        position = [name for name, _ in fields].index(field)
+        values = self._structs[table].unpack_from(self.mm, self.tables[table][2] + number * self.tables[table][1])
+        slot = sum(len(FIELD_FORMATS[kind]) for _, kind in fields[:position])
+        kind = fields[position][1]
+        if kind == 'str':
+            return self._string(values[slot], values[slot + 1])
+        return values[slot]
+
+    def _record(self, table, number):
+        values = self._structs[table].unpack_from(self.mm, self.tables[table][2] + number * self.tables[table][1])
+        record, slot = {}, 0
+        for name, kind in SNAPSHOT_TABLES[table]['fields']:
+            if kind == 'str':
+                record[name] = self._string(values[slot], values[slot + 1])
+                slot += 2
+            else:
+                record[name] = Decimal(values[slot]).scaleb(-2) if kind == 'money' else values[slot]
+                slot += 1
+        return record
+
+    def _search(self, count, value_at, target, prefix=False):
+        # First position whose value is >= target (lower bound) over a sorted sequence
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            value = value_at(mid)
+            if (value[:len(target)] if prefix and isinstance(value, str) else value) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def get(self, table, key):
+        # The record with this primary key, or None
+        self.refresh()
+        spec = SNAPSHOT_TABLES[table]
+        kind = dict(spec['fields'])[spec['key']]
+        target = _sort_key(kind, int(key) if kind == 'int' else str(key))
+        count = self.tables[table][0]
+        value_at = lambda i: _sort_key(kind, self._field(table, i, spec['key']))
+        position = self._search(count, value_at, target)
+        if position < count and value_at(position) == target:
+            return self._record(table, position)
+        return None
+
+    def find(self, table, field, value, prefix=False, limit=50):
+        # Records whose indexed `field` equals `value` (case-insensitive), or starts with it
+        self.refresh()
+        if (table, field) not in self.indexes:
+            raise ValueError(f"No index on {table}.{field}. Indexed: {', '.join(SNAPSHOT_TABLES[table]['indexes'])}")
+        count, offset = self.indexes[(table, field)]
+        kind = dict(SNAPSHOT_TABLES[table]['fields'])[field]
+        target = _index_key(field, kind, value)
+        number_at = lambda i: INDEX_SLOT.unpack_from(self.mm, offset + i * INDEX_SLOT.size)[0]
+        value_at = lambda i: _index_key(field, kind, self._field(table, number_at(i), field))
+        matches = []
+        position = self._search(count, value_at, target, prefix)
+        while position < count and len(matches) < limit:
+            value = value_at(position)
+            if not (value.startswith(target) if prefix else value == target):
+                break
+            matches.append(self._record(table, number_at(position)))
+            position += 1
+        return matches
+
+    def all(self, table):
+        # Every record in key order, like the view() listings
+        self.refresh()
+        return [self._record(table, i) for i in range(self.tables[table][0])]
+
+_snapshot = None
+
+def open_snapshot(path=SNAPSHOT_PATH):
+    # Shared reader for the process; None (with a message) if no snapshot has been exported
+    global _snapshot
+    if _snapshot is None or _snapshot.path != path:
+        try:
+            _snapshot = Snapshot(path)
+        except (OSError, ValueError) as e:
+            print("Could not open snapshot:", e)
+            return None
+    return _snapshot
+
+if __name__ == "__main__":
+    # python snapshot.py [--watch SECONDS] [PATH]: export once, or keep re-exporting
+    args = sys.argv[1:]
+    interval = float(args[args.index('--watch') + 1]) if '--watch' in args else None
+    rest = [a for i, a in enumerate(args) if a != '--watch' and (i == 0 or args[i - 1] != '--watch')]
+    path = rest[0] if rest else SNAPSHOT_PATH
+    while True:
+        try:
+            export_snapshot(path)
+        except Exception as e:
+            print("Error exporting snapshot:", e)
+        if interval is None:
+            break
+        time.sleep(interval)
@@ -0,0 +1,45 @@
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# Budget for importing hospital_main on top of a bare interpreter start, in milliseconds
+STARTUP_TARGET_MS = float(os.environ.get('HOSPITAL_STARTUP_TARGET_MS', '25'))
+RUNS = int(os.environ.get('HOSPITAL_STARTUP_RUNS', '15'))
+
+# Modules that must not be loaded before the first submenu is opened
+DEFERRED_MODULES = ['mysql', 'mysql.connector', 'patient', 'doctor', 'service', 'appointment', 'billing']
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def _time_python(code):
+    samples = []
+    for _ in range(RUNS):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], cwd=HERE, check=True)
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+def check_startup():
+    probe = ("import sys, hospital_main; "
+             f"loaded = [m for m in {DEFERRED_MODULES!r} if m in sys.modules]; "
+             "sys.exit(', '.join(loaded) if loaded else 0)")
+    result = subprocess.run([sys.executable, '-c', probe], cwd=HERE, capture_output=True, text=True)
+    if result.returncode != 0:
+        print("FAIL: loaded at startup:", result.stderr.strip())
+        return False
+
+    baseline = _time_python("pass")
+    startup = _time_python("import hospital_main")
+    overhead = startup - baseline
+    print(f"Interpreter: {baseline:.1f} ms | with hospital_main: {startup:.1f} ms | "
+          f"overhead: {overhead:.1f} ms (target {STARTUP_TARGET_MS:.0f} ms)")
+    if overhead > STARTUP_TARGET_MS:
+        print("FAIL: startup overhead above target.")
+        return False
+    print("OK")
+    return True
+
+if __name__ == "__main__":
+    sys.exit(0 if check_startup() else 1)
@@ -0,0 +1,343 @@
+import io
+import os
+import sys
+import time
+from contextlib import redirect_stdout
+
+from db_config import get_connection
+from charges import add_charges
+import history
+from mysql.connector import Error
+
+# Server-side path for the billing hot paths. With HOSPITAL_BILLING_MODE=procedure, Bill.add,
+# Bill.update and compute_total_billing validate their arguments in Python as before and then
+# make one CALL, which does the existence checks, the aggregation and every write on the
+# server. The procedures are installed with `python stored_procs.py --install`.
+BILLING_MODE = os.environ.get('HOSPITAL_BILLING_MODE', 'client').strip().lower()
+
+# Every procedure answers with one row: (status, total, extra). Charges are billed up to the
+# highest charge_id seen when the procedure started, so charges recorded meanwhile wait for next time.
+PROCEDURES = {
+    'hm_bill_add': """
+CREATE PROCEDURE hm_bill_add(IN p_bill_id VARCHAR(10), IN p_patient_id INT, IN p_billing_date DATE)
+proc: BEGIN
+    DECLARE v_max_id BIGINT;
+    DECLARE v_lines INT;
+    DECLARE v_total DECIMAL(12,2);
+    DECLARE v_services JSON;
+    -- The bill row is the first write, so a duplicate ID leaves nothing behind
+    DECLARE EXIT HANDLER FOR 1062 SELECT 'duplicate' AS status, NULL AS total, NULL AS extra;
+
+    SELECT MAX(charge_id), COUNT(*), SUM(cost), JSON_ARRAYAGG(service_id) INTO v_max_id, v_lines, v_total, v_services
+    FROM pending_charges WHERE patient_id = p_patient_id FOR UPDATE;
+    IF v_lines = 0 THEN
+        SELECT 'no_services' AS status, NULL AS total, NULL AS extra;
+        LEAVE proc;
+    END IF;
+    IF NOT EXISTS (SELECT 1 FROM patients WHERE patient_id = p_patient_id AND deleted_at IS NULL) THEN
+        SELECT 'no_patient' AS status, NULL AS total, NULL AS extra;
+        LEAVE proc;
+    END IF;
+
+    INSERT INTO billing (bill_id, patient_id, total_amount, billing_date)
+    VALUES (p_bill_id, p_patient_id, v_total, p_billing_date);
+    INSERT INTO billed_services (bill_id, patient_id, service_id, service_name, cost)
+    SELECT p_bill_id, p_patient_id, c.service_id, s.service_name, c.cost
+    FROM pending_charges c JOIN services s ON s.service_id = c.service_id
+    WHERE c.patient_id = p_patient_id AND c.charge_id <= v_max_id ORDER BY c.charge_id;
+    INSERT INTO change_log (entity, entity_key, op, changed_fields)
+    VALUES ('bill', p_bill_id, 'insert', JSON_OBJECT('patient_id', p_patient_id, 'total_amount', v_total,
+            'billing_date', p_billing_date, 'services', v_services));
+    INSERT INTO change_log (entity, entity_key, op, changed_fields)
+    VALUES ('charge', p_patient_id, 'delete', JSON_OBJECT('count', v_lines, 'up_to', v_max_id));
+    DELETE FROM pending_charges WHERE patient_id = p_patient_id AND charge_id <= v_max_id;
+    UPDATE pending_charge_totals SET charge_count = charge_count - v_lines, total_amount = total_amount - v_total
+    WHERE patient_id = p_patient_id;
+    DELETE FROM pending_charge_totals WHERE patient_id = p_patient_id AND charge_count <= 0;
+    SELECT 'ok' AS status, v_total AS total, v_lines AS extra;
+END""",
+    'hm_bill_update': """
+CREATE PROCEDURE hm_bill_update(IN p_bill_id VARCHAR(10), IN p_patient_id INT, IN p_billing_date DATE, IN p_version INT)
+proc: BEGIN
+    DECLARE v_max_id BIGINT;
+    DECLARE v_lines INT;
+    DECLARE v_total DECIMAL(12,2);
+    DECLARE v_bill_patient INT;
+    DECLARE v_bill_total DECIMAL(12,2);
+    DECLARE v_current INT;
+    DECLARE v_first_line INT;
+
+    SELECT MAX(charge_id), COUNT(*), SUM(cost) INTO v_max_id, v_lines, v_total
+    FROM pending_charges WHERE patient_id = p_patient_id FOR UPDATE;
+    IF v_lines = 0 THEN
+        SELECT 'no_services' AS status, NULL AS total, NULL AS extra;
+        LEAVE proc;
+    END IF;
+    IF NOT EXISTS (SELECT 1 FROM patients WHERE patient_id = p_patient_id AND deleted_at IS NULL) THEN
+        SELECT 'no_patient' AS status, NULL AS total, NULL AS extra;
+        LEAVE proc;
+    END IF;
+
+    -- Same lock and checks as Bill.update; with a version this is a compare-and-set against
+    -- the row as it was read
+    SELECT patient_id, version INTO v_bill_patient, v_current FROM billing WHERE bill_id = p_bill_id FOR UPDATE;
+    IF v_current IS NULL THEN
+        SELECT 'not_found' AS status, NULL AS total, NULL AS extra;
+        LEAVE proc;
+    END IF;
+    IF v_bill_patient <> p_patient_id THEN
+        SELECT 'other_patient' AS status, NULL AS total, v_bill_patient AS extra;
+        LEAVE proc;
+    END IF;
+    IF p_version IS NOT NULL AND v_current <> p_version THEN
+        SELECT 'conflict' AS status, NULL AS total, v_current AS extra;
+        LEAVE proc;
+    END IF;
+
+    -- Each charge becomes a line with its audited adjustment, as Bill._apply_adjustment writes
+    -- them (one version per adjustment), so the total stays the sum of the live lines
+    INSERT INTO billed_services (bill_id, patient_id, service_id, service_name, cost)
+    SELECT p_bill_id, p_patient_id, c.service_id, s.service_name, c.cost
+    FROM pending_charges c JOIN services s ON s.service_id = c.service_id
+    WHERE c.patient_id = p_patient_id AND c.charge_id <= v_max_id ORDER BY c.charge_id;
+    -- The bill is locked, so its lines from this statement are the ones from the first new ID on
+    SET v_first_line = LAST_INSERT_ID();
+    INSERT INTO bill_adjustments (bill_id, line_id, action, service_id, amount, reason)
+    SELECT p_bill_id, id, 'add', service_id, cost, 'Billed pending charges'
+    FROM billed_services WHERE bill_id = p_bill_id AND id >= v_first_line ORDER BY id;
+    INSERT INTO change_log (entity, entity_key, op, changed_fields)
+    SELECT 'bill', p_bill_id, 'update', JSON_OBJECT('adjustment', 'add', 'line_id', id, 'service_id', service_id,
+           'total_delta', cost)
+    FROM billed_services WHERE bill_id = p_bill_id AND id >= v_first_line ORDER BY id;
+    UPDATE billing SET total_amount = COALESCE(total_amount, 0) + v_total, billing_date = p_billing_date,
+           version = version + 1 + v_lines
+    WHERE bill_id = p_bill_id;
+    SELECT total_amount, version INTO v_bill_total, v_current FROM billing WHERE bill_id = p_bill_id;
+    INSERT INTO change_log (entity, entity_key, op, changed_fields)
+    VALUES ('bill', p_bill_id, 'update', JSON_OBJECT('patient_id', p_patient_id, 'total_amount', v_bill_total,
+            'billing_date', p_billing_date));
+    INSERT INTO change_log (entity, entity_key, op, changed_fields)
+    VALUES ('charge', p_patient_id, 'delete', JSON_OBJECT('count', v_lines, 'up_to', v_max_id));
+    DELETE FROM pending_charges WHERE patient_id = p_patient_id AND charge_id <= v_max_id;
+    UPDATE pending_charge_totals SET charge_count = charge_count - v_lines, total_amount = total_amount - v_total
+    WHERE patient_id = p_patient_id;
+    DELETE FROM pending_charge_totals WHERE patient_id = p_patient_id AND charge_count <= 0;
+    SELECT 'ok' AS status, v_bill_total AS total, v_current AS extra;
+END""",
+    'hm_compute_total_billing': """
+CREATE PROCEDURE hm_compute_total_billing(IN p_patient_id INT, IN p_include_archived BOOLEAN)
+BEGIN
+    SELECT 'ok' AS status,
+           COALESCE((SELECT total_amount FROM pending_charge_totals WHERE patient_id = p_patient_id), 0) AS total,
+           (SELECT COALESCE(SUM(consulting_charge), 0) FROM appointments WHERE patient_id = p_patient_id)
+           + IF(p_include_archived,
+                (SELECT COALESCE(SUM(consulting_charge), 0) FROM appointments_archive WHERE patient_id = p_patient_id),
+                0) AS extra;
+END""",
+}
+
+def procedure_mode():
+    return BILLING_MODE == 'procedure'
+
+def install_procedures():
+    # (Re)creates every procedure; needs the CREATE ROUTINE and ALTER ROUTINE privileges
+    try:
+        conn = get_connection()
+        cursor = conn.cursor()
+        for name, body in PROCEDURES.items():
+            cursor.execute(f"DROP PROCEDURE IF EXISTS {name}")
+            cursor.execute(body.strip())
+        conn.commit()
+        print(f"Installed {len(PROCEDURES)} stored procedure(s): {', '.join(PROCEDURES)}")
+        return True
+    except Error as e:
+        print("Database error while installing stored procedures:", e)
+        return False
+    finally:
+        if 'cursor' in locals(): cursor.close()
+        if 'conn' in locals(): conn.close()
+
+def call_procedure(cursor, name, params):
+    # One round trip: the CALL's single-row result set, then its status packet
+    sql = f"CALL {name}({', '.join(['%s'] * len(params))})"
+    if hasattr(cursor, 'nextset'):
+        # Connector/Python 9.2 and later
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+        while cursor.nextset():
+            pass
+        return rows[0] if rows else None
+    row = None
+    for result in cursor.execute(sql, params, multi=True):
+        if result.with_rows:
+            rows = result.fetchall()
+            row = row or (rows[0] if rows else None)
+    return row
+
+def bill_add(bill):
+    # Procedure path of Bill.add, after its argument validation; same messages and result
+    try:
+        conn = get_connection()
+        cursor = conn.cursor()
+        status, total, lines = call_procedure(cursor, 'hm_bill_add', (bill.bill_id, bill.patient_id, bill.billing_date))
+        if status == 'no_services':
+            print("No services to bill for this patient.")
+            return False
+        if status == 'no_patient':
+            print("Patient ID does not exist.")
+            return False
+        if status == 'duplicate':
+            print(f"Error: Duplicate Bill ID '{bill.bill_id}'. Please use a unique ID.")
+            return False
+        conn.commit()
+        history.invalidate(bill.patient_id)
+        print(f"Bill added successfully. Total amount: {float(total)}")
+        print(f"Billed services recorded. Cleared services for patient {bill.patient_id}")
+        return True
+    except Error as e:
+        print("Database error while adding bill:", e)
+        return False
+    finally:
+        if 'cursor' in locals(): cursor.close()
+        if 'conn' in locals(): conn.close()
+
+def bill_update(bill, version):
+    # Procedure path of Bill.update, after its argument validation; same messages and result
+    try:
+        conn = get_connection()
+        cursor = conn.cursor()
+        status, total, current = call_procedure(cursor, 'hm_bill_update',
+                                                (bill.bill_id, bill.patient_id, bill.billing_date, version))
+        if status == 'no_services':
+            print("No services to bill for this patient.")
+            return False
+        if status == 'no_patient':
+            print("Patient ID does not exist.")
+            return False
+        if status == 'not_found':
+            print("Bill ID not found.")
+            return False
+        if status == 'other_patient':
+            print(f"Bill '{bill.bill_id}' belongs to patient {current}, not {bill.patient_id}.")
+            return False
+        if status == 'conflict':
+            bill.conflict = True
+            bill.current_version = current
+            print(f"Update conflict: bill '{bill.bill_id}' was changed by someone else "
+                  f"(your version {version}, current version {current}). Reload it and try again.")
+            return False
+        conn.commit()
+        history.invalidate()
+        if version is not None:
+            bill.version = current
+        print("Bill updated successfully. Total amount:", float(total))
+        print(f"Cleared services for patient {bill.patient_id}")
+        return True
+    except Error as e:
+        print("Database error while updating bill:", e)
+        return False
+    finally:
+        if 'cursor' in locals(): cursor.close()
+        if 'conn' in locals(): conn.close()
+
+def compute_totals(patient_id, include_archived=False):
+    # (service total, consulting total) in one call; errors propagate to compute_total_billing
+    conn = get_connection(read_only=True)
+    cursor = conn.cursor()
+    try:
+        _, service_total, consulting_total = call_procedure(cursor, 'hm_compute_total_billing',
+                                                            (patient_id, bool(include_archived)))
+        return service_total, consulting_total
+    finally:
+        cursor.close()
+        conn.close()
+
+# --- Benchmark ---
+def _timed(fn, *args):
+    # Milliseconds for one call, with the entity method's messages kept off the screen
+    with redirect_stdout(io.StringIO()):
+        started = time.perf_counter()
+        result = fn(*args)
+        return (time.perf_counter() - started) * 1000, result
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values) // 2] if values else 0.0
+
+def benchmark(bills=50, services_per_bill=5):
+    # Bills the same usage through both modes against the configured database: a throwaway
+    # patient gets `services_per_bill` pending charges before every Bill.add and Bill.update.
+    # The bills are deleted and the patient soft-deleted afterwards.
+    global BILLING_MODE
+    from billing import Bill, compute_total_billing, generate_next_bill_id
+    from patient import Patient
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT service_id, cost FROM services ORDER BY service_id LIMIT %s", (services_per_bill,))
+        catalog = cursor.fetchall()
+        if not catalog:
+            print("The benchmark needs at least one service in the catalog.")
+            return None
+        cursor.execute("INSERT INTO patients (name, age, gender, admission_date, contact_no) "
+                       "VALUES ('Benchmark Patient', 40, 'Other', CURDATE(), NULL)")
+        patient_id = str(cursor.lastrowid)
+        conn.commit()
+    finally:
+        cursor.close()
+        conn.close()
+
+    def record_usage():
+        conn = get_connection()
+        try:
+            add_charges(conn, [(patient_id, *service) for service in catalog])
+            conn.commit()
+        finally:
+            conn.close()
+
+    previous_mode = BILLING_MODE
+    results = {}
+    created = []
+    try:
+        for mode in ('client', 'procedure'):
+            BILLING_MODE = mode
+            timings = {'bill.add': [], 'bill.update': [], 'compute_total': []}
+            for _ in range(bills):
+                record_usage()
+                timings['compute_total'].append(_timed(compute_total_billing, patient_id)[0])
+                bill = Bill(generate_next_bill_id(), patient_id)
+                elapsed, ok = _timed(bill.add)
+                if not ok:
+                    print(f"Bill.add failed in {mode} mode; are the procedures installed?")
+                    return None
+                created.append(bill.bill_id)
+                timings['bill.add'].append(elapsed)
+                record_usage()
+                timings['bill.update'].append(_timed(bill.update)[0])
+            results[mode] = timings
+    finally:
+        BILLING_MODE = previous_mode
+        with redirect_stdout(io.StringIO()):
+            for bill_id in created:
+                Bill.delete(bill_id)
+            Patient.delete(patient_id)
+
+    print(f"\n{bills} bill(s) of {len(catalog)} service(s) per mode")
+    print("Operation | client median ms | procedure median ms | client mean ms | procedure mean ms | speedup")
+    for op in results['client']:
+        client, procedure = results['client'][op], results['procedure'][op]
+        speedup = _median(client) / _median(procedure) if _median(procedure) else 0.0
+        print(f"{op} | {_median(client):.2f} | {_median(procedure):.2f} | {sum(client) / len(client):.2f} | "
+              f"{sum(procedure) / len(procedure):.2f} | {speedup:.1f}x")
+    return results
+
+if __name__ == "__main__":
+    # python stored_procs.py --install | --benchmark [BILLS]
+    args = sys.argv[1:]
+    if '--install' in args:
+        sys.exit(0 if install_procedures() else 1)
+    if '--benchmark' in args:
+        position = args.index('--benchmark')
+        count = int(args[position + 1]) if len(args) > position + 1 else 50
+        sys.exit(0 if benchmark(count) else 1)
+    print("Usage: python stored_procs.py --install | --benchmark [BILLS]")